@@ -0,0 +1,154 @@
+"""
+Throughput of the proxy relaying plain HTTP requests with the event loop
+and socket options under test.
+
+Runs a local origin, an in-process ProxyServer and concurrent keep-alive
+clients, prints requests per second and latency percentiles:
+
+    python -m benchmarks.bench_loop --loop uvloop --tuned
+    python -m benchmarks.bench_loop --compare
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.harness import free_port
+from proxy.server import ProxyServer
+from proxy.tuning import EVENT_LOOPS, SocketOptions, install_event_loop
+
+TUNED = SocketOptions(nodelay=True,
+                      send_buffer=2 ** 18,
+                      receive_buffer=2 ** 18,
+                      stream_limit=2 ** 18)
+
+
+async def start_origin(size: int) -> asyncio.Server:
+    response = (f'HTTP/1.1 200 OK\r\n'
+                f'Content-Type: application/octet-stream\r\n'
+                f'Content-Length: {size}\r\n\r\n').encode() + b'x' * size
+
+    async def handle(reader, writer):
+        try:
+            while await reader.readuntil(b'\r\n\r\n'):
+                writer.write(response)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host='127.0.0.1', port=0)
+
+
+async def client(proxy_port: int, origin_port: int, requests: int,
+                 latencies: list[float]):
+    reader, writer = await asyncio.open_connection('127.0.0.1', proxy_port)
+    request = (f'GET http://127.0.0.1:{origin_port}/ HTTP/1.1\r\n'
+               f'Host: 127.0.0.1:{origin_port}\r\n\r\n').encode()
+    try:
+        for _ in range(requests):
+            started = time.perf_counter()
+            writer.write(request)
+            head = await reader.readuntil(b'\r\n\r\n')
+            length = next(int(line.split(b':')[1])
+                          for line in head.split(b'\r\n')
+                          if line.lower().startswith(b'content-length:'))
+            await reader.readexactly(length)
+            latencies.append(time.perf_counter() - started)
+    finally:
+        writer.close()
+
+
+async def bench(clients: int, requests: int, size: int,
+                socket_options: SocketOptions) -> dict:
+    origin = await start_origin(size)
+    origin_port = origin.sockets[0].getsockname()[1]
+    proxy_port = free_port()
+    server = ProxyServer(host='127.0.0.1', port=proxy_port,
+                         buffer_size=2 ** 16, users=clients,
+                         pool_size=clients, cache_size=0, coalesce_size=0,
+                         socket_options=socket_options)
+    running = asyncio.create_task(server.run())
+    await asyncio.sleep(0.2)
+    latencies = []
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(
+            client(proxy_port, origin_port, requests, latencies)
+            for _ in range(clients)))
+        elapsed = time.perf_counter() - started
+    finally:
+        running.cancel()
+        await server.close()
+        origin.close()
+    quantiles = statistics.quantiles(latencies, n=100)
+    return {
+        'requests': len(latencies),
+        'rps': round(len(latencies) / elapsed),
+        'p50_ms': round(quantiles[49] * 1000, 2),
+        'p99_ms': round(quantiles[98] * 1000, 2)
+    }
+
+
+def compare(args):
+    """
+    Runs every configuration in a new process,
+    the event loop policy is installed once per process.
+    """
+    print(f'{"loop":8} {"sockets":8} {"req/s":>8} {"p50 ms":>8} {"p99 ms":>8}')
+    for loop in ('asyncio', 'uvloop'):
+        for tuned in (False, True):
+            command = [sys.executable, '-m', 'benchmarks.bench_loop',
+                       '--loop', loop, '--json',
+                       '--clients', str(args.clients),
+                       '--requests', str(args.requests),
+                       '--size', str(args.size)]
+            if tuned:
+                command.append('--tuned')
+            output = subprocess.run(command, capture_output=True, text=True,
+                                    check=True).stdout
+            result = json.loads(output)
+            print(f'{result["loop"]:8} {"tuned" if tuned else "default":8} '
+                  f'{result["rps"]:>8} {result["p50_ms"]:>8} '
+                  f'{result["p99_ms"]:>8}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--loop', default='asyncio', choices=EVENT_LOOPS)
+    parser.add_argument('--tuned', action='store_true',
+                        help='Use larger socket buffers and stream limit')
+    parser.add_argument('--clients', default=50, type=int)
+    parser.add_argument('--requests', default=200, type=int,
+                        help='Requests per client')
+    parser.add_argument('--size', default=16384, type=int,
+                        help='Bytes of a response body')
+    parser.add_argument('--compare', action='store_true',
+                        help='Run all loops with default and tuned sockets')
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+    if args.compare:
+        compare(args)
+        return
+
+    logging.basicConfig(level=logging.ERROR)
+    loop = install_event_loop(args.loop)
+    socket_options = TUNED if args.tuned else SocketOptions()
+    # The proxy writes its passwords and certificates to the working dir.
+    with tempfile.TemporaryDirectory() as work_dir:
+        os.chdir(work_dir)
+        result = asyncio.run(bench(args.clients, args.requests, args.size,
+                                   socket_options))
+    result['loop'] = loop
+    print(json.dumps(result) if args.json else result)
+
+
+if __name__ == '__main__':
+    main()
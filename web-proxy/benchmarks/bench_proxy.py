@@ -0,0 +1,182 @@
+"""
+Throughput, latency and resources of the proxy under load.
+
+Starts a local origin over plain HTTP and TLS with a throwaway CA
+and, for every scenario, a new proxy in-process or as a subprocess.
+Concurrent keep-alive clients send requests through the proxy:
+
+    plain      GET with a Content-Length body
+    chunked    GET with a chunked body
+    gzip       GET with a gzip compressed body
+    tunnel     CONNECT spliced without interception, TLS to the origin
+    intercept  CONNECT intercepted with a certificate of the proxy
+
+Prints a JSON report with requests per second, p50/p99 latency,
+CPU seconds and peak RSS of each scenario. Reports of two commits
+are compared with --baseline:
+
+    python -m benchmarks.bench_proxy --output before.json
+    python -m benchmarks.bench_proxy --baseline before.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from typing import Optional
+
+from benchmarks.harness import ORIGIN_HOST, ROOT, InProcessProxy, Origin, \
+    Results, SubprocessProxy, ThrowawayCA, free_port, http_client, \
+    tunnel_client
+from proxy.policy import InterceptPolicy
+from proxy.tuning import EVENT_LOOPS, install_event_loop
+
+SCENARIOS = ('plain', 'chunked', 'gzip', 'tunnel', 'intercept')
+MODES = ('subprocess', 'inprocess')
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def start_proxy(scenario: str, args, cafile: str, work_dir: str):
+    port = free_port()
+    bypass = scenario == 'tunnel'
+    if args.mode == 'inprocess':
+        policy = InterceptPolicy.from_rules([ORIGIN_HOST]) \
+            if bypass else None
+        return InProcessProxy(port, args.clients, cafile, policy)
+    options = ['--loop', args.loop]
+    if args.workers > 1:
+        options += ['--workers', str(args.workers)]
+    if bypass:
+        options += ['--bypass', ORIGIN_HOST]
+    return SubprocessProxy(port, args.clients, cafile, work_dir, options)
+
+
+async def run_scenario(scenario: str, args, ca: ThrowawayCA,
+                       origin: Origin, tls_origin: Origin,
+                       work_dir: str) -> dict:
+    proxy = start_proxy(scenario, args, ca.cafile, work_dir)
+    await proxy.start()
+    results = Results()
+    if scenario in ('tunnel', 'intercept'):
+        context = ca.client_context()
+        clients = [tunnel_client(proxy.port, tls_origin.port, context,
+                                 args.requests, results)
+                   for _ in range(args.clients)]
+    else:
+        clients = [http_client(proxy.port, origin.port, f'/{scenario}',
+                               args.requests, results)
+                   for _ in range(args.clients)]
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*clients)
+        elapsed = time.perf_counter() - started
+    finally:
+        usage = await proxy.stop()
+    return dict(results.summary(elapsed), **usage)
+
+
+async def bench(args, work_dir: str) -> dict:
+    ca = ThrowawayCA(work_dir)
+    origin = Origin(args.size)
+    tls_origin = Origin(args.size, ssl_context=ca.server_context())
+    await origin.start()
+    await tls_origin.start()
+    try:
+        scenarios = dict()
+        for scenario in args.scenarios:
+            scenarios[scenario] = await run_scenario(
+                scenario, args, ca, origin, tls_origin, work_dir)
+    finally:
+        await origin.close()
+        await tls_origin.close()
+    return scenarios
+
+
+def compare(report: dict, baseline: dict):
+    """
+    Prints changes of the report against the baseline.
+    """
+    print(f'{"scenario":10} {"req/s":>8} {"change":>8} {"p99 ms":>8} '
+          f'{"change":>8}')
+    for scenario, result in report['scenarios'].items():
+        before = baseline.get('scenarios', dict()).get(scenario)
+        changes = []
+        for key in ('rps', 'p99_ms'):
+            if before and before.get(key):
+                change = (result[key] - before[key]) / before[key] * 100
+                changes.append(f'{change:+.1f}%')
+            else:
+                changes.append('-')
+        print(f'{scenario:10} {result["rps"]:>8} {changes[0]:>8} '
+              f'{result["p99_ms"]:>8} {changes[1]:>8}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--scenarios', nargs='+', default=list(SCENARIOS),
+                        choices=SCENARIOS)
+    parser.add_argument('--mode', default='subprocess', choices=MODES,
+                        help='Run the proxy as python -m proxy '
+                             'or on the event loop of the clients')
+    parser.add_argument('--loop', default='asyncio', choices=EVENT_LOOPS)
+    parser.add_argument('--workers', default=1, type=int,
+                        help='Worker processes of a subprocess proxy')
+    parser.add_argument('--clients', default=50, type=int)
+    parser.add_argument('--requests', default=200, type=int,
+                        help='Requests per client')
+    parser.add_argument('--size', default=16384, type=int,
+                        help='Bytes of a response body')
+    parser.add_argument('--output', type=str,
+                        help='Write the report to a file')
+    parser.add_argument('--baseline', type=str,
+                        help='Compare with a report of an earlier run')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    loop = install_event_loop(args.loop) \
+        if args.mode == 'inprocess' else args.loop
+    # The proxy writes its passwords and certificates to the working dir.
+    with tempfile.TemporaryDirectory() as work_dir:
+        cwd = os.getcwd()
+        os.chdir(work_dir)
+        try:
+            scenarios = asyncio.run(bench(args, work_dir))
+        finally:
+            os.chdir(cwd)
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'mode': args.mode,
+        'loop': loop,
+        'workers': args.workers,
+        'clients': args.clients,
+        'requests': args.requests,
+        'size': args.size,
+        'cpu_scope': InProcessProxy.scope if args.mode == 'inprocess'
+        else SubprocessProxy.scope,
+        'scenarios': scenarios
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    print(text)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
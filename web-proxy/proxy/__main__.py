@@ -2,8 +2,17 @@ import argparse
 import asyncio
 import logging
 
+from features.collector import PasswordCollector
+from proxy.connection import ProxyConnection
+from proxy.dns import RESOLVERS, Resolver
 from proxy.errors import ProxyError
+from proxy.logs import ACCESS_LOGGER, sample, start_queue_logging, \
+    stop_queue_logging
+from proxy.policy import InterceptPolicy
 from proxy.server import ProxyServer
+from proxy.timeouts import Timeouts
+from proxy.tuning import EVENT_LOOPS, SocketOptions, install_event_loop
+from proxy.workers import Supervisor
 
 parser = argparse.ArgumentParser(prefix_chars='-',
                                  description='Web-proxy')
@@ -12,27 +21,185 @@ parser.add_argument('--host', default='localhost', type=str,
 parser.add_argument('-p', '--port', default=8080, type=int,
                     help='Start proxy on port, default=8080')
 parser.add_argument('-u', '--users', default=100, type=int,
-                    help='Set count of users, default=100')
+                    help='Set listen backlog of connections not accepted '
+                         'yet, default=100')
 parser.add_argument('-b', '--buffer', default=4096, type=int,
                     help='Set buffer size, default=4096')
-parser.add_argument('-t', '--timeout', default=1, type=int,
-                    help='Set timeout wait request, default=1')
+parser.add_argument('-t', '--timeout', default=10.0, type=float,
+                    help='Set seconds to receive the head of a request, '
+                         '0 disables, default=10')
+parser.add_argument('--body-timeout', default=30.0, type=float,
+                    help='Set seconds between reads or writes of a message '
+                         'content, 0 disables, default=30')
+parser.add_argument('--idle-timeout', default=60.0, type=float,
+                    help='Set seconds a client connection is kept '
+                         'without a new request, 0 disables, default=60')
+parser.add_argument('--connect-timeout', default=10.0, type=float,
+                    help='Set seconds to connect to an origin and '
+                         'to complete TLS handshakes, 0 disables, '
+                         'default=10')
+parser.add_argument('--response-timeout', default=60.0, type=float,
+                    help='Set seconds to receive the head of a response, '
+                         '0 disables, default=60')
+parser.add_argument('--max-connections', default=1024, type=int,
+                    help='Set count of client connections served at once, '
+                         '0 disables the cap, default=1024')
+parser.add_argument('--max-queue', default=256, type=int,
+                    help='Set count of connections waiting for a slot, '
+                         'others get 503, default=256')
+parser.add_argument('--queue-timeout', default=5.0, type=float,
+                    help='Set seconds a connection waits for a slot, '
+                         'default=5')
+parser.add_argument('--per-client', default=128, type=int,
+                    help='Set count of connections of one client address, '
+                         'others get 429, 0 disables, default=128')
+parser.add_argument('--pool-size', default=8, type=int,
+                    help='Set count of idle upstream connections '
+                         'kept per host, default=8')
+parser.add_argument('--pool-idle', default=30.0, type=float,
+                    help='Set seconds an idle upstream connection '
+                         'is kept, default=30')
+parser.add_argument('--pool-active', default=256, type=int,
+                    help='Set count of upstream connections in use per host, '
+                         'others wait, 0 disables, default=256')
+parser.add_argument('--resolver', default='auto', choices=RESOLVERS,
+                    help='Resolve origin hosts with resolver, auto is aiodns '
+                         'if installed, default=auto')
+parser.add_argument('--dns-cache', default=1024, type=int,
+                    help='Set count of hosts with cached addresses, '
+                         '0 disables the cache, default=1024')
+parser.add_argument('--dns-ttl', default=60.0, type=float,
+                    help='Set seconds addresses from the system resolver '
+                         'are cached, default=60')
+parser.add_argument('--dns-negative-ttl', default=5.0, type=float,
+                    help='Set seconds a failed resolution is cached, '
+                         'default=5')
+parser.add_argument('--happy-eyeballs-delay', default=0.25, type=float,
+                    help='Set seconds before connecting to the next address '
+                         'of a host, 0 tries addresses one by one, '
+                         'default=0.25')
+parser.add_argument('--bypass', action='append', default=[], type=str,
+                    help='Tunnel CONNECT to matching hosts without '
+                         'interception: host, *.pattern, .domain or CIDR. '
+                         'Can be repeated')
+parser.add_argument('--bypass-file', type=str,
+                    help='Read bypass rules from file, one per line')
+parser.add_argument('--intercept-ports', nargs='+', type=int,
+                    help='Intercept CONNECT only to these ports, default=all')
+parser.add_argument('--tunnel-buffer', default=65536, type=int,
+                    help='Set buffer size of raw tunnels, default=65536')
+parser.add_argument('--tunnel-idle', default=600.0, type=float,
+                    help='Set seconds a tunnel or an upgraded connection '
+                         'is kept without data, 0 disables, default=600')
+parser.add_argument('--cert-cache', default=1024, type=int,
+                    help='Set count of TLS contexts kept in memory, '
+                         'default=1024')
+parser.add_argument('--cert-cache-ttl', default=3600.0, type=float,
+                    help='Set seconds a TLS context is kept in memory, '
+                         'default=3600')
+parser.add_argument('--cert-workers', default=2, type=int,
+                    help='Set count of processes issuing certificates, '
+                         'default=2')
+parser.add_argument('--spare-keys', default=0, type=int,
+                    help='Keep this count of pre-generated keys '
+                         'for new hosts, default=0')
+parser.add_argument('--cert-key', default='ecdsa', choices=('ecdsa', 'rsa'),
+                    help='Set key algorithm of issued certificates, '
+                         'default=ecdsa')
+parser.add_argument('--upstream-cafile', type=str,
+                    help='Verify origins with CA certificates from file, '
+                         'default=system store')
+parser.add_argument('--cache-size', default=64, type=int,
+                    help='Set MiB of HTTP responses cached in memory, '
+                         '0 disables the cache, default=64')
+parser.add_argument('--cache-object-size', default=1024, type=int,
+                    help='Set KiB of the largest cached response, '
+                         'default=1024')
+parser.add_argument('--cache-dir', type=str,
+                    help='Also cache HTTP responses on disk in directory')
+parser.add_argument('--cache-disk-size', default=1024, type=int,
+                    help='Set MiB of HTTP responses cached on disk, '
+                         'default=1024')
+parser.add_argument('--workers', default=1, type=int,
+                    help='Run proxy in this count of processes sharing '
+                         'the port, default=1')
+parser.add_argument('--loop', default='auto', choices=EVENT_LOOPS,
+                    help='Set event loop, auto is uvloop if installed, '
+                         'default=auto')
+parser.add_argument('--tcp-nodelay', default=True,
+                    action=argparse.BooleanOptionalAction,
+                    help='Disable Nagle\'s algorithm on sockets, default=on')
+parser.add_argument('--sndbuf', type=int,
+                    help='Set SO_SNDBUF bytes of sockets, default=system')
+parser.add_argument('--rcvbuf', type=int,
+                    help='Set SO_RCVBUF bytes of sockets, default=system')
+parser.add_argument('--stream-limit', default=64, type=int,
+                    help='Set KiB buffered by a stream reader before '
+                         'reading pauses, default=64')
+parser.add_argument('--keepalive', type=int,
+                    help='Enable TCP keepalive after seconds of idle, '
+                         'default=off')
+parser.add_argument('--keepalive-interval', type=int,
+                    help='Set seconds between TCP keepalive probes, '
+                         'default=system')
+parser.add_argument('--keepalive-count', type=int,
+                    help='Set count of unanswered TCP keepalive probes, '
+                         'default=system')
+parser.add_argument('--coalesce-size', default=8, type=int,
+                    help='Set MiB of a response replayed to identical '
+                         'concurrent requests, 0 disables coalescing, '
+                         'default=8')
+parser.add_argument('--metrics-port', type=int,
+                    help='Serve metrics in the Prometheus text format '
+                         'on GET /metrics of this port, default=off')
+parser.add_argument('--metrics-host', default='127.0.0.1', type=str,
+                    help='Serve metrics on host, default=127.0.0.1')
+parser.add_argument('--slow-request', default=0.0, type=float,
+                    help='Log stages of requests taking more seconds '
+                         'from the head to the end of the response, '
+                         '0 disables, default=0')
+parser.add_argument('--profile-dir', default='./profiles', type=str,
+                    help='Write profiles sampled on SIGUSR1 to directory, '
+                         'default=./profiles')
+parser.add_argument('--profile-duration', default=10.0, type=float,
+                    help='Set seconds a profile is sampled, default=10')
+parser.add_argument('--log-queue', action='store_true',
+                    help='Format and write log records in a separate '
+                         'thread')
+parser.add_argument('--log-sample', default=1.0, type=float,
+                    help='Log a share of info lines about requests, '
+                         'warnings are always logged, default=1')
+parser.add_argument('--access-log', action='store_true',
+                    help='Log a line with the fields of each exchange')
+parser.add_argument('--access-log-sample', default=1.0, type=float,
+                    help='Log a share of access log lines, default=1')
+parser.add_argument('--export-passwords', action='store_true',
+                    help='Write collected credentials to '
+                         'passwords/passwords.json and exit')
 
-logging.basicConfig(format='%(levelname)s - %(name)s - '
-                           '%(asctime)s - %(message)s',
-                    datefmt='%Y-%m-%d %H:%M:%S',
+LOG_FORMAT = '%(levelname)s - %(name)s - %(asctime)s - %(message)s'
+WORKERS_LOG_FORMAT = '%(levelname)s - %(processName)s - %(name)s - ' \
+                     '%(asctime)s - %(message)s'
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+logging.basicConfig(format=LOG_FORMAT,
+                    datefmt=DATE_FORMAT,
                     level=logging.INFO)
 
 logger = logging.getLogger('main')
 
 
-async def main(host: str, port: int, users: int, buffer_size: int):
+async def main(host: str, port: int, users: int, buffer_size: int,
+               **options):
+    """
+    :param options: optional keyword arguments of ProxyServer
+    """
     proxy_server = None
     try:
         proxy_server = ProxyServer(host=host,
                                    port=port,
                                    users=users,
-                                   buffer_size=buffer_size)
+                                   buffer_size=buffer_size,
+                                   **options)
         await proxy_server.run()
     except ProxyError as exception:
         logger.warning(f'{exception.message}')
@@ -42,12 +209,109 @@ async def main(host: str, port: int, users: int, buffer_size: int):
             await proxy_server.close()
 
 
+def run_workers(workers: int, **options):
+    """
+    :param options: keyword arguments of ProxyServer
+    """
+    try:
+        Supervisor(workers=workers, **options).run()
+    except ProxyError as exception:
+        logger.warning(f'{exception.message}')
+        exit(1)
+
+
+def setup_logging(args: argparse.Namespace):
+    """
+    Sets the log format, sampling and the access log,
+    starts the listener thread of queued records.
+    """
+    if args.workers > 1:
+        for handler in logging.getLogger().handlers:
+            handler.setFormatter(logging.Formatter(WORKERS_LOG_FORMAT,
+                                                   datefmt=DATE_FORMAT))
+    try:
+        sample(ProxyConnection._logger.name, args.log_sample)
+        sample(ACCESS_LOGGER, args.access_log_sample)
+    except ValueError as e:
+        parser.error(str(e))
+    if not args.access_log:
+        logging.getLogger(ACCESS_LOGGER).setLevel(logging.WARNING)
+    if args.log_queue:
+        start_queue_logging()
+
+
 if __name__ == '__main__':
     try:
         args = parser.parse_args()
-        asyncio.run(main(host=args.host,
-                         port=args.port,
-                         users=args.users,
-                         buffer_size=args.buffer))
+        setup_logging(args)
+        if args.export_passwords:
+            filename = PasswordCollector().export_json()
+            logger.info(f'Credentials exported to {filename}')
+            exit(0)
+        rules = args.bypass
+        if args.bypass_file:
+            rules += InterceptPolicy.read_rules(args.bypass_file)
+        intercept_policy = None
+        if rules or args.intercept_ports:
+            intercept_policy = InterceptPolicy.from_rules(
+                rules, intercept_ports=args.intercept_ports)
+        server_options = dict(
+            host=args.host,
+            port=args.port,
+            users=args.users,
+            buffer_size=args.buffer,
+            pool_size=args.pool_size,
+            pool_idle_timeout=args.pool_idle,
+            pool_active=args.pool_active,
+            policy=intercept_policy,
+            tunnel_buffer_size=args.tunnel_buffer,
+            tunnel_idle_timeout=args.tunnel_idle or None,
+            cert_cache_size=args.cert_cache,
+            cert_cache_ttl=args.cert_cache_ttl,
+            cert_workers=args.cert_workers,
+            spare_keys=args.spare_keys,
+            cert_key=args.cert_key,
+            upstream_cafile=args.upstream_cafile,
+            cache_size=args.cache_size * 2 ** 20,
+            cache_object_size=args.cache_object_size * 2 ** 10,
+            cache_dir=args.cache_dir,
+            cache_disk_size=args.cache_disk_size * 2 ** 20,
+            coalesce_size=args.coalesce_size * 2 ** 20,
+            socket_options=SocketOptions(
+                nodelay=args.tcp_nodelay,
+                send_buffer=args.sndbuf,
+                receive_buffer=args.rcvbuf,
+                keepalive_idle=args.keepalive,
+                keepalive_interval=args.keepalive_interval,
+                keepalive_count=args.keepalive_count,
+                stream_limit=args.stream_limit * 2 ** 10),
+            timeouts=Timeouts(
+                header=args.timeout or None,
+                body=args.body_timeout or None,
+                idle=args.idle_timeout or None,
+                connect=args.connect_timeout or None,
+                response=args.response_timeout or None),
+            max_connections=args.max_connections,
+            max_queue=args.max_queue,
+            queue_timeout=args.queue_timeout,
+            per_client_connections=args.per_client,
+            metrics_host=args.metrics_host,
+            metrics_port=args.metrics_port,
+            slow_request=args.slow_request or None,
+            profile_dir=args.profile_dir,
+            profile_duration=args.profile_duration,
+            resolver=Resolver(
+                max_entries=args.dns_cache,
+                ttl=args.dns_ttl,
+                negative_ttl=args.dns_negative_ttl,
+                happy_eyeballs_delay=args.happy_eyeballs_delay or None,
+                backend=args.resolver))
+        logger.info(f'Event loop: {install_event_loop(args.loop)}')
+        if args.workers > 1:
+            run_workers(workers=args.workers, **server_options)
+        else:
+            asyncio.run(main(**server_options))
     except KeyboardInterrupt:
         logger.warning(f'KeyboardInterrupt')
+    finally:
+        stop_queue_logging()
@@ -0,0 +1,115 @@
+import asyncio
+from collections import deque
+
+
+class AdmissionControl:
+    """
+    Caps concurrent client connections. Over max_connections a new
+    connection waits in a FIFO queue of max_queue places for queue_timeout
+    seconds, a connection that gets no place or no slot in time is shed.
+    A client address already holding per_client connections, queued ones
+    included, is shed at once, so one client can not take
+    the whole capacity or the whole queue.
+    Worker processes have their own limits.
+    """
+
+    def __init__(self, max_connections: int = 1024, max_queue: int = 256,
+                 queue_timeout: float = 5.0, per_client: int = 128):
+        """
+        :param max_connections: 0 disables the cap
+        :param per_client: 0 disables the limit of a client address
+        """
+        self._max_connections = max_connections
+        self._max_queue = max_queue
+        self._queue_timeout = queue_timeout
+        self._per_client = per_client
+        self._active = 0
+        self._clients: dict[str, int] = dict()
+        # Cancelled waiters are skipped when a slot is handed over.
+        self._waiters: deque[asyncio.Future] = deque()
+        self._waiting = 0
+        self.admitted = 0
+        self.queued = 0
+        self.shed = 0
+        self.shed_client = 0
+
+    def limited(self, client: str) -> bool:
+        """
+        :return: True if the client can not open one more connection
+        """
+        return bool(self._per_client) \
+            and self._clients.get(client, 0) >= self._per_client
+
+    async def admit(self, client: str) -> bool:
+        """
+        Takes a slot for a connection of the client, waiting in the queue
+        if all slots are taken. An admitted connection is released
+        by release.
+        :return: False if the connection is shed
+        """
+        if self.limited(client):
+            self.shed_client += 1
+            return False
+        self._clients[client] = self._clients.get(client, 0) + 1
+        if not self._max_connections or \
+                self._active < self._max_connections and not self._waiting:
+            self._active += 1
+            self.admitted += 1
+            return True
+        if self._waiting >= self._max_queue:
+            self._forget(client)
+            self.shed += 1
+            return False
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self._waiting += 1
+        self.queued += 1
+        try:
+            async with asyncio.timeout(self._queue_timeout):
+                await waiter
+        except TimeoutError:
+            # The slot may be handed over as the timeout expires.
+            if not waiter.done() or waiter.cancelled():
+                self._forget(client)
+                self.shed += 1
+                return False
+        except BaseException:
+            if waiter.done() and not waiter.cancelled():
+                self.release(client)
+            else:
+                self._forget(client)
+            raise
+        finally:
+            self._waiting -= 1
+        self.admitted += 1
+        return True
+
+    def release(self, client: str):
+        """
+        Frees the slot of an admitted connection,
+        the first waiting connection takes it.
+        """
+        self._forget(client)
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self._active -= 1
+
+    def _forget(self, client: str):
+        count = self._clients[client] - 1
+        if count:
+            self._clients[client] = count
+        else:
+            del self._clients[client]
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'active': self._active,
+            'waiting': self._waiting,
+            'admitted': self.admitted,
+            'queued': self.queued,
+            'shed': self.shed,
+            'shed_client': self.shed_client
+        }
@@ -0,0 +1,586 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from asyncio import StreamReader, StreamWriter
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+from proxy.httpparser import HTTPRequest, HTTPResponse
+
+# Codes a response may be stored with without explicit freshness.
+HEURISTIC_CODES = frozenset((200, 203, 204, 300, 301, 308, 404, 405, 410,
+                             414, 501))
+CACHEABLE_CODES = HEURISTIC_CODES | {302, 307}
+SAFE_METHODS = frozenset(('GET', 'HEAD', 'OPTIONS', 'TRACE'))
+HOP_BY_HOP = frozenset(('connection', 'keep-alive', 'proxy-connection',
+                        'proxy-authenticate', 'te', 'trailer', 'upgrade'))
+# Headers of a 304 response that must not replace the stored ones.
+NOT_UPDATED = frozenset(('content-length', 'transfer-encoding',
+                         'content-encoding', 'content-range'))
+# Headers sent with a 304 answered from the cache.
+NOT_MODIFIED_HEADERS = ('cache-control', 'content-location', 'date', 'etag',
+                        'expires', 'last-modified', 'vary')
+MAX_HEURISTIC_LIFETIME = 86400.0
+
+
+def parse_cache_control(headers: dict[str, str]) -> dict[str, Optional[str]]:
+    directives = dict()
+    for directive in headers.get('cache-control', '').split(','):
+        name, _, value = directive.strip().partition('=')
+        if name:
+            directives[name.lower()] = value.strip('"') if value else None
+    return directives
+
+
+def _seconds(value: Optional[str]) -> Optional[int]:
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def _timestamp(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def _etags(value: str) -> list[str]:
+    return [etag.strip().removeprefix('W/') for etag in value.split(',')]
+
+
+def cache_key(request: HTTPRequest, https: bool) -> str:
+    """
+    Absolute URL of the request. Paths of intercepted HTTPS requests
+    and of transparent requests are relative.
+    """
+    if not request.path.startswith('/'):
+        return request.path
+    scheme = 'https' if https else 'http'
+    return f'{scheme}://{request.headers.get("host", request.host)}' \
+           f'{request.path}'
+
+
+def vary_names(headers: dict[str, str]) -> list[str]:
+    return sorted({name.strip().lower()
+                   for name in headers.get('vary', '').split(',')
+                   if name.strip()})
+
+
+def vary_values(names: list[str], request: HTTPRequest) -> dict[str, str]:
+    return {name: ' '.join(request.headers.get(name, '').split())
+            for name in names}
+
+
+@dataclass
+class CacheEntry:
+    key: str
+    proto: str
+    code: int
+    message: str
+    headers: dict[str, str]
+    body: bytes = field(repr=False)
+    vary: dict[str, str] = field(default_factory=dict)
+    request_time: float = 0.0
+    response_time: float = 0.0
+
+    @property
+    def size(self) -> int:
+        return len(self.body) + sum(len(name) + len(value)
+                                    for name, value in self.headers.items())
+
+    @property
+    def etag(self) -> Optional[str]:
+        return self.headers.get('etag')
+
+    @property
+    def last_modified(self) -> Optional[str]:
+        return self.headers.get('last-modified')
+
+    def matches(self, request: HTTPRequest) -> bool:
+        """
+        :return: True if the request selects this variant
+        """
+        return self.vary == vary_values(list(self.vary), request)
+
+    def _date(self) -> float:
+        date = _timestamp(self.headers.get('date'))
+        return self.response_time if date is None else date
+
+    def freshness_lifetime(self) -> float:
+        cache_control = parse_cache_control(self.headers)
+        for directive in ('s-maxage', 'max-age'):
+            lifetime = _seconds(cache_control.get(directive, ''))
+            if lifetime is not None:
+                return lifetime
+        date = self._date()
+        expires = self.headers.get('expires')
+        if expires is not None:
+            expires = _timestamp(expires)
+            return 0.0 if expires is None else max(0.0, expires - date)
+        last_modified = _timestamp(self.last_modified)
+        if last_modified is not None and self.code in HEURISTIC_CODES:
+            # 10% of the time since the last modification (RFC 7234 4.2.2)
+            heuristic = 0.1 * max(0.0, date - last_modified)
+            return min(MAX_HEURISTIC_LIFETIME, heuristic)
+        return 0.0
+
+    def current_age(self, now: float) -> float:
+        date = self._date()
+        apparent_age = max(0.0, self.response_time - date)
+        age = _seconds(self.headers.get('age')) or 0
+        response_delay = self.response_time - self.request_time
+        initial_age = max(apparent_age, age + response_delay)
+        return initial_age + now - self.response_time
+
+    def is_fresh(self, request_directives: dict[str, Optional[str]],
+                 now: float) -> bool:
+        if 'no-cache' in parse_cache_control(self.headers):
+            return False
+        age = self.current_age(now)
+        lifetime = self.freshness_lifetime()
+        max_age = _seconds(request_directives.get('max-age', ''))
+        if max_age is not None:
+            lifetime = min(lifetime, max_age)
+        min_fresh = _seconds(request_directives.get('min-fresh', '')) or 0
+        return lifetime - age > min_fresh
+
+    def not_modified_for(self, conditions: dict[str, str]) -> bool:
+        """
+        :param conditions: conditional headers of the client request
+        :return: True if the client already has this entry,
+                 so 304 can be sent
+        """
+        if_none_match = conditions.get('if-none-match')
+        if if_none_match is not None:
+            if self.etag is None:
+                return False
+            etags = _etags(if_none_match)
+            return '*' in etags or _etags(self.etag)[0] in etags
+        since = _timestamp(conditions.get('if-modified-since'))
+        modified = _timestamp(self.last_modified)
+        return since is not None and modified is not None \
+            and modified <= since
+
+    def to_response(self, conditions: dict[str, str],
+                    now: float) -> HTTPResponse:
+        """
+        Response of the entry to a request: 304 if the client
+        already has it, the whole entry otherwise.
+        """
+        age = str(int(self.current_age(now)))
+        if self.not_modified_for(conditions):
+            headers = {name: self.headers[name]
+                       for name in NOT_MODIFIED_HEADERS
+                       if name in self.headers}
+            headers['age'] = age
+            return HTTPResponse(proto=self.proto, code=304,
+                                message='Not Modified', headers=headers)
+        headers = dict(self.headers)
+        headers['age'] = age
+        headers['content-length'] = str(len(self.body))
+        return HTTPResponse(proto=self.proto, code=self.code,
+                            message=self.message, headers=headers,
+                            raw_content=self.body)
+
+    def to_bytes(self) -> bytes:
+        meta = json.dumps({
+            'key': self.key, 'proto': self.proto, 'code': self.code,
+            'message': self.message, 'headers': self.headers,
+            'vary': self.vary, 'request_time': self.request_time,
+            'response_time': self.response_time
+        }).encode()
+        return len(meta).to_bytes(4, 'big') + meta + self.body
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'CacheEntry':
+        length = int.from_bytes(data[:4], 'big')
+        meta = json.loads(data[4:4 + length])
+        return cls(body=data[4 + length:], **meta)
+
+
+@dataclass
+class CacheLookup:
+    """
+    State of one request between the lookup and the response.
+    """
+    key: str
+    entry: Optional[CacheEntry] = None
+    fresh: bool = False
+    revalidating: bool = False
+    conditions: dict[str, str] = field(default_factory=dict)
+    request_time: float = field(default_factory=time.time)
+
+    def to_response(self, now: float) -> HTTPResponse:
+        return self.entry.to_response(self.conditions, now)
+
+
+class CacheSink:
+    """
+    Writer passed to stream_content: forwards the content to the client
+    and keeps a copy up to max_size bytes.
+    """
+
+    def __init__(self, target: StreamWriter, max_size: int):
+        self._target = target
+        self._max_size = max_size
+        self._chunks = []
+        self._size = 0
+        self.overflowed = False
+
+    def write(self, data: bytes):
+        self._target.write(data)
+        if self.overflowed:
+            return
+        self._size += len(data)
+        if self._size > self._max_size:
+            self.overflowed = True
+            self._chunks.clear()
+        else:
+            self._chunks.append(data)
+
+    async def drain(self):
+        await self._target.drain()
+
+    def is_closing(self) -> bool:
+        return self._target.is_closing()
+
+    @property
+    def content(self) -> bytes:
+        return b''.join(self._chunks)
+
+
+class DiskTier:
+    """
+    Entries saved as files named by the hash of the key, one variant
+    per key. Methods block, they are called in a thread.
+    """
+
+    def __init__(self, directory: str, max_size: int):
+        self._directory = directory
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._files: Optional[OrderedDict[str, int]] = None
+        self._size = 0
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self._directory,
+                            hashlib.sha256(key.encode()).hexdigest())
+
+    def _index(self) -> OrderedDict[str, int]:
+        """
+        Sizes of saved files from the oldest used, read on first use.
+        """
+        if self._files is None:
+            os.makedirs(self._directory, exist_ok=True)
+            entries = []
+            for name in os.listdir(self._directory):
+                path = os.path.join(self._directory, name)
+                if name.endswith('.tmp'):
+                    os.unlink(path)
+                    continue
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, path, stat.st_size))
+            self._files = OrderedDict(
+                (path, size) for _, path, size in sorted(entries))
+            self._size = sum(self._files.values())
+        return self._files
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        path = self._path(key)
+        with self._lock:
+            files = self._index()
+            if path not in files:
+                return None
+            files.move_to_end(path)
+        try:
+            with open(path, 'rb') as f:
+                entry = CacheEntry.from_bytes(f.read())
+            os.utime(path)
+        except (OSError, ValueError, TypeError):
+            self.delete(key)
+            return None
+        return entry if entry.key == key else None
+
+    def put(self, entry: CacheEntry):
+        path = self._path(entry.key)
+        data = entry.to_bytes()
+        if len(data) > self._max_size:
+            return
+        with self._lock:
+            files = self._index()
+            with open(f'{path}.tmp', 'wb') as f:
+                f.write(data)
+            os.replace(f'{path}.tmp', path)
+            self._size += len(data) - files.pop(path, 0)
+            files[path] = len(data)
+            while self._size > self._max_size:
+                old, size = files.popitem(last=False)
+                self._size -= size
+                try:
+                    os.unlink(old)
+                except FileNotFoundError:
+                    pass
+
+    def delete(self, key: str):
+        path = self._path(key)
+        with self._lock:
+            size = self._index().pop(path, None)
+            if size is None:
+                return
+            self._size -= size
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {'disk_entries': len(self._files or ()),
+                    'disk_bytes': self._size}
+
+
+class HTTPCache:
+    """
+    Shared HTTP cache (RFC 7234) of GET responses: a memory LRU
+    in front of an optional disk tier.
+    Requests with credentials and responses that are private or set
+    cookies are never stored, since all clients share the cache.
+    """
+    _logger = logging.getLogger('httpCache')
+
+    def __init__(self, max_size: int = 64 * 2 ** 20,
+                 max_object_size: int = 2 ** 20,
+                 disk_dir: Optional[str] = None,
+                 disk_max_size: int = 2 ** 30,
+                 max_variants: int = 4):
+        """
+        :param max_size: bytes of entries kept in memory
+        :param max_object_size: bytes of the largest stored response
+        :param disk_dir: directory of the disk tier, no disk tier if None
+        :param disk_max_size: bytes of entries kept on disk
+        :param max_variants: count of Vary variants kept per URL in memory
+        """
+        self._max_size = max_size
+        self._max_object_size = max_object_size
+        self._max_variants = max_variants
+        self._memory: OrderedDict[str, list[CacheEntry]] = OrderedDict()
+        self._memory_size = 0
+        self._disk = DiskTier(disk_dir, disk_max_size) if disk_dir else None
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.revalidated = 0
+        self.stored = 0
+        self.invalidated = 0
+
+    @staticmethod
+    def is_cacheable_request(request: HTTPRequest) -> bool:
+        if request.method != 'GET' or 'authorization' in request.headers \
+                or 'upgrade' in request.headers:
+            return False
+        if request.chunked or request.headers.get('content-length',
+                                                  '0') != '0':
+            return False
+        return 'no-store' not in parse_cache_control(request.headers)
+
+    async def lookup(self, request: HTTPRequest,
+                     https: bool) -> Optional[CacheLookup]:
+        """
+        :return: None if the request bypasses the cache
+        """
+        if not self.is_cacheable_request(request):
+            return None
+        lookup = CacheLookup(
+            key=cache_key(request, https),
+            conditions={name: request.headers[name]
+                        for name in ('if-none-match', 'if-modified-since')
+                        if name in request.headers})
+        entry = self._get_memory(lookup.key, request)
+        if entry is None and self._disk:
+            entry = await asyncio.to_thread(self._disk.get, lookup.key)
+            if entry is not None and entry.matches(request):
+                self._put_memory(entry)
+            else:
+                entry = None
+        if entry is None:
+            self.misses += 1
+            return lookup
+        lookup.entry = entry
+        directives = parse_cache_control(request.headers)
+        force = 'no-cache' in directives \
+            or 'no-cache' in request.headers.get('pragma', '')
+        lookup.fresh = not force and entry.is_fresh(directives, time.time())
+        if lookup.fresh:
+            self.hits += 1
+        else:
+            self.stale += 1
+        return lookup
+
+    @staticmethod
+    def add_validators(lookup: CacheLookup, request: HTTPRequest) -> bool:
+        """
+        Replaces conditional headers of the request with validators
+        of the stale entry.
+        :return: False if the entry has no validators
+        """
+        entry = lookup.entry
+        if entry is None or not (entry.etag or entry.last_modified):
+            return False
+        request.headers.pop('if-none-match', None)
+        request.headers.pop('if-modified-since', None)
+        if entry.etag:
+            request.headers['if-none-match'] = entry.etag
+        if entry.last_modified:
+            request.headers['if-modified-since'] = entry.last_modified
+        lookup.revalidating = True
+        return True
+
+    def sink(self, target: StreamWriter) -> CacheSink:
+        return CacheSink(target, self._max_object_size)
+
+    def is_storable(self, request: HTTPRequest,
+                    response: HTTPResponse) -> bool:
+        if response.code not in CACHEABLE_CODES or not response.framed:
+            return False
+        if int(response.headers.get('content-length', 0) or 0) \
+                > self._max_object_size:
+            return False
+        directives = parse_cache_control(response.headers)
+        if 'no-store' in directives or 'private' in directives \
+                or 'set-cookie' in response.headers \
+                or '*' in vary_names(response.headers) \
+                or 'no-store' in parse_cache_control(request.headers):
+            return False
+        explicit = 's-maxage' in directives or 'max-age' in directives \
+            or 'expires' in response.headers
+        validators = 'etag' in response.headers \
+            or 'last-modified' in response.headers
+        return explicit or validators or 'public' in directives
+
+    async def store(self, lookup: CacheLookup, request: HTTPRequest,
+                    response: HTTPResponse, content: bytes,
+                    response_time: float):
+        """
+        :param content: content as it was sent, chunked framing included
+        """
+        headers = self._end_to_end(response.headers)
+        if response.chunked:
+            stored = HTTPResponse(headers=headers)
+            source = StreamReader()
+            source.feed_data(content)
+            source.feed_eof()
+            await stored.read_content(source)
+            content = stored.raw_content
+        headers.pop('content-length', None)
+        entry = CacheEntry(
+            key=lookup.key,
+            proto=response.proto,
+            code=response.code,
+            message=response.message,
+            headers=headers,
+            body=content,
+            vary=vary_values(vary_names(headers), request),
+            request_time=lookup.request_time,
+            response_time=response_time)
+        self._put_memory(entry)
+        self.stored += 1
+        if self._disk:
+            await asyncio.to_thread(self._disk.put, entry)
+
+    async def refresh(self, lookup: CacheLookup, response: HTTPResponse,
+                      response_time: float) -> CacheEntry:
+        """
+        Updates the stale entry by the 304 response of revalidation.
+        """
+        entry = lookup.entry
+        size = entry.size
+        entry.headers.update({
+            name: value
+            for name, value in self._end_to_end(response.headers).items()
+            if name not in NOT_UPDATED
+        })
+        entry.request_time = lookup.request_time
+        entry.response_time = response_time
+        if any(old is entry for old in self._memory.get(entry.key, [])):
+            self._memory_size += entry.size - size
+            self._evict()
+        self.revalidated += 1
+        if self._disk:
+            await asyncio.to_thread(self._disk.put, entry)
+        return entry
+
+    async def invalidate(self, key: str):
+        """
+        Drops the entries of the URL changed by an unsafe method.
+        """
+        entries = self._memory.pop(key, [])
+        self._memory_size -= sum(entry.size for entry in entries)
+        self.invalidated += 1
+        if self._disk:
+            await asyncio.to_thread(self._disk.delete, key)
+
+    @staticmethod
+    def _end_to_end(headers: dict[str, str]) -> dict[str, str]:
+        connection = {name.strip().lower()
+                      for name in headers.get('connection', '').split(',')}
+        return {name: value for name, value in headers.items()
+                if name not in HOP_BY_HOP and name not in connection}
+
+    def _get_memory(self, key: str,
+                    request: HTTPRequest) -> Optional[CacheEntry]:
+        entries = self._memory.get(key)
+        if not entries:
+            return None
+        self._memory.move_to_end(key)
+        for entry in entries:
+            if entry.matches(request):
+                return entry
+        return None
+
+    def _put_memory(self, entry: CacheEntry):
+        if entry.size > self._max_size:
+            return
+        old_entries = self._memory.get(entry.key, [])
+        # Variants of other Vary headers are outdated.
+        entries = [old for old in old_entries
+                   if old is not entry and old.vary != entry.vary
+                   and old.vary.keys() == entry.vary.keys()]
+        entries = [entry] + entries[:self._max_variants - 1]
+        self._memory_size += sum(new.size for new in entries) \
+            - sum(old.size for old in old_entries)
+        self._memory[entry.key] = entries
+        self._memory.move_to_end(entry.key)
+        self._evict()
+
+    def _evict(self):
+        """
+        Drops the least recently used URLs until the entries fit.
+        """
+        while self._memory_size > self._max_size:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_size -= sum(old.size for old in evicted)
+
+    def stats(self) -> dict[str, int]:
+        stats = {
+            'hits': self.hits,
+            'misses': self.misses,
+            'stale': self.stale,
+            'revalidated': self.revalidated,
+            'stored': self.stored,
+            'invalidated': self.invalidated,
+            'entries': sum(len(entries) for entries in self._memory.values()),
+            'memory_bytes': self._memory_size
+        }
+        if self._disk:
+            stats.update(self._disk.stats())
+        return stats
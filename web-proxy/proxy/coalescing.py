@@ -0,0 +1,341 @@
+import asyncio
+import logging
+import time
+from asyncio import StreamWriter
+from dataclasses import replace
+from typing import AsyncIterator, Optional
+
+from proxy.cache import cache_key, parse_cache_control, vary_names, \
+    vary_values
+from proxy.errors import CloseConnection
+from proxy.httpparser import HTTPRequest, HTTPResponse
+
+COALESCED_METHODS = frozenset(('GET', 'HEAD'))
+# Requests with credentials, conditions or ranges are answered per client.
+NOT_COALESCED_HEADERS = frozenset(('authorization', 'cookie', 'upgrade',
+                                   'if-match', 'if-none-match',
+                                   'if-modified-since', 'if-unmodified-since',
+                                   'if-range', 'range'))
+# Request headers responses commonly vary on. Other headers named by Vary
+# are compared when the response arrives.
+NEGOTIATION_HEADERS = ('accept', 'accept-encoding', 'accept-language')
+# Cache-Control directives of responses that are not shared by clients.
+NOT_SHARED_DIRECTIVES = ('private', 'no-store', 'no-cache')
+
+
+def coalescing_key(request: HTTPRequest, https: bool) -> Optional[str]:
+    """
+    Method, absolute URL and negotiation headers of the request.
+    :return: None if the request is always sent on its own
+    """
+    if request.method not in COALESCED_METHODS:
+        return None
+    if request.chunked or request.headers.get('content-length',
+                                              '0') != '0':
+        return None
+    if any(name in request.headers for name in NOT_COALESCED_HEADERS):
+        return None
+    negotiation = vary_values(list(NEGOTIATION_HEADERS), request)
+    return '\n'.join((request.method, cache_key(request, https),
+                      *(f'{name}: {value}'
+                        for name, value in negotiation.items())))
+
+
+class Flight:
+    """
+    One upstream request shared by identical requests of other clients.
+    The leader publishes the response head and the content while it
+    streams them to its own client, followers replay both from the start.
+    Chunks are kept while a follower can join or has not read them,
+    at most max_size bytes: a follower left further behind is closed.
+    """
+
+    def __init__(self, key: str, leader: int, request: HTTPRequest,
+                 max_size: int):
+        """
+        :param leader: id of the connection sending the request
+        :param max_size: bytes of content after which no one can join
+                         and which are kept for followers
+        """
+        self.key = key
+        self.leader = leader
+        self._request = replace(request, headers=request.headers.copy())
+        self._max_size = max_size
+        self._response: Optional[HTTPResponse] = None
+        self._chunks: list[bytes] = []
+        # Index of the first kept chunk among all fed chunks.
+        self._first = 0
+        self._kept = 0
+        self._size = 0
+        # Index of the next chunk of each follower reading the content.
+        self._readers: dict[object, int] = dict()
+        self._changed = asyncio.Event()
+        self.followers = 0
+        self.shared = False
+        self.joinable = True
+        self.done = False
+        self.failed = False
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def publish(self, response: HTTPResponse):
+        """
+        Keeps a copy of the response head before callbacks change it.
+        """
+        self._response = replace(response, headers=response.headers.copy())
+        directives = parse_cache_control(response.headers)
+        self.shared = response.code != 304 \
+            and 'set-cookie' not in response.headers \
+            and not any(name in directives
+                        for name in NOT_SHARED_DIRECTIVES) \
+            and '*' not in vary_names(response.headers)
+        if not self.shared:
+            self.joinable = False
+            self._release()
+        self._notify()
+
+    @property
+    def needs_content(self) -> bool:
+        """
+        :return: False if no follower can replay the content
+        """
+        return self.shared and (self.joinable or self.followers > 0
+                                or bool(self._readers))
+
+    @property
+    def replayable(self) -> bool:
+        """
+        :return: True if the content is kept from its start
+        """
+        return self._first == 0
+
+    def feed(self, data: bytes):
+        self._size += len(data)
+        if self._size > self._max_size:
+            self.joinable = False
+        if self.needs_content:
+            self._chunks.append(data)
+            self._kept += len(data)
+        self._release()
+        self._notify()
+
+    def leave(self):
+        """
+        A follower does not read the content anymore.
+        """
+        self.followers -= 1
+        self._release()
+
+    def _release(self):
+        """
+        Drops the chunks no follower reads anymore
+        and the oldest ones beyond max_size.
+        """
+        if self.joinable:
+            return
+        end = self._first + len(self._chunks)
+        if not self.needs_content:
+            start = end
+        elif self.followers > len(self._readers):
+            # A follower has not started reading.
+            start = self._first
+        else:
+            start = min(self._readers.values(), default=end)
+        count = start - self._first
+        dropped = sum(map(len, self._chunks[:count]))
+        while count < len(self._chunks) \
+                and self._kept - dropped > self._max_size:
+            dropped += len(self._chunks[count])
+            count += 1
+        if count:
+            del self._chunks[:count]
+            self._kept -= dropped
+            self._first += count
+
+    def sink(self, target: StreamWriter) -> 'FlightSink':
+        return FlightSink(target, self)
+
+    def finish(self):
+        self.done = True
+        self.joinable = False
+        self._release()
+        self._notify()
+
+    def abort(self):
+        if not self.done:
+            self.failed = True
+            self.joinable = False
+            self._release()
+            self._notify()
+
+    async def response(self) -> Optional[HTTPResponse]:
+        """
+        :return: copy of the response head, None if the leader failed
+                 before receiving it
+        """
+        while self._response is None and not self.failed:
+            await self._changed.wait()
+        if self._response is None:
+            return None
+        return replace(self._response, headers=self._response.headers.copy())
+
+    def is_shared_with(self, request: HTTPRequest) -> bool:
+        """
+        :return: True if the response answers the request of a follower
+        """
+        if not self.shared:
+            return False
+        names = vary_names(self._response.headers)
+        return vary_values(names, request) == vary_values(names,
+                                                          self._request)
+
+    async def content(self) -> AsyncIterator[bytes]:
+        """
+        :raise CloseConnection if the leader failed during the content
+                               or the follower fell behind the kept chunks
+        """
+        reader = object()
+        index = 0
+        self._readers[reader] = index
+        try:
+            while True:
+                if index < self._first:
+                    raise CloseConnection('Coalesced response was not kept.')
+                if index < self._first + len(self._chunks):
+                    data = self._chunks[index - self._first]
+                    index += 1
+                    self._readers[reader] = index
+                    self._release()
+                    yield data
+                    continue
+                if self.done:
+                    return
+                if self.failed:
+                    raise CloseConnection('Coalesced response was aborted.')
+                await self._changed.wait()
+        finally:
+            del self._readers[reader]
+            self._release()
+
+
+class FlightSink:
+    """
+    Writer passed to stream_content: forwards the content to the leader's
+    client and feeds it to the followers.
+    If the leader's client goes away, the content is still received
+    for the followers.
+    """
+
+    def __init__(self, target: StreamWriter, flight: Flight):
+        self._target = target
+        self._flight = flight
+        self.detached = False
+
+    def write(self, data: bytes):
+        if not self.detached:
+            self._target.write(data)
+        self._flight.feed(data)
+
+    async def drain(self):
+        if self.detached:
+            return
+        try:
+            await self._target.drain()
+        except ConnectionError:
+            if not self._flight.followers:
+                raise
+            self.detached = True
+
+    def is_closing(self) -> bool:
+        return self._target.is_closing()
+
+
+class RequestCoalescer:
+    """
+    Single-flight of identical requests from all clients: while a request
+    is sent to the origin, the same requests wait for its response
+    instead of being sent again.
+    A URL whose response cannot be shared is not coalesced for pass_ttl,
+    so its requests do not wait for each other.
+    """
+    _logger = logging.getLogger('requestCoalescer')
+
+    def __init__(self, max_size: int = 8 * 2 ** 20, pass_ttl: float = 30.0,
+                 max_passes: int = 4096):
+        """
+        :param max_size: bytes of content a flight keeps for followers
+        :param pass_ttl: seconds a URL is not coalesced after a private
+                         response
+        :param max_passes: count of such URLs kept
+        """
+        self._max_size = max_size
+        self._pass_ttl = pass_ttl
+        self._max_passes = max_passes
+        self._flights: dict[str, Flight] = dict()
+        self._passes: dict[str, float] = dict()
+        self.flights = 0
+        self.coalesced = 0
+        self.alone = 0
+        self.aborted = 0
+
+    def follow(self, key: str) -> Optional[Flight]:
+        """
+        :return: the flight of the key if it can still be joined
+        """
+        flight = self._flights.get(key)
+        if flight is None or not flight.joinable:
+            return None
+        flight.followers += 1
+        self.coalesced += 1
+        return flight
+
+    def lead(self, key: str, leader: int,
+             request: HTTPRequest) -> Optional[Flight]:
+        """
+        :return: None if responses of the key are not shared
+        """
+        expires = self._passes.get(key)
+        if expires is not None:
+            if expires > time.monotonic():
+                return None
+            del self._passes[key]
+        flight = Flight(key, leader, request, self._max_size)
+        self._flights[key] = flight
+        self.flights += 1
+        return flight
+
+    def publish(self, flight: Flight, response: HTTPResponse):
+        flight.publish(response)
+        if not flight.shared:
+            self._forget(flight)
+            self._passes[flight.key] = time.monotonic() + self._pass_ttl
+            while len(self._passes) > self._max_passes:
+                del self._passes[next(iter(self._passes))]
+
+    def finish(self, flight: Flight):
+        flight.finish()
+        self._forget(flight)
+
+    def abort(self, flight: Flight):
+        if not flight.done and not flight.failed:
+            self.aborted += 1
+            request = ' '.join(flight.key.split('\n')[:2])
+            self._logger.warning(f'Shared request {request} was aborted.')
+        flight.abort()
+        self._forget(flight)
+
+    def _forget(self, flight: Flight):
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'flights': self.flights,
+            'in_flight': len(self._flights),
+            'coalesced': self.coalesced,
+            'alone': self.alone,
+            'aborted': self.aborted,
+            'passes': len(self._passes)
+        }
@@ -1,11 +1,24 @@
 import asyncio
-import socket
 import ssl
 import logging
+import time
 from asyncio import StreamReader, StreamWriter
+from collections import deque
+from typing import Optional
 
+from proxy.cache import HTTPCache, CacheLookup, cache_key, SAFE_METHODS
+from proxy.coalescing import RequestCoalescer, Flight, coalescing_key
+from proxy.dns import Resolver
 from proxy.errors import *
 from proxy.httpparser import HTTPRequest, HTTPResponse, HTTPCode200
+from proxy.logs import ACCESS_LOGGER, format_fields
+from proxy.metrics import Metrics, Timeline
+from proxy.policy import InterceptPolicy
+from proxy.pool import UpstreamPool, UpstreamConnection
+from proxy.tls import ClientSSLContext
+from proxy.tuning import SocketOptions
+from proxy.timeouts import Activity, Timeouts
+from proxy.tunnel import splice
 from sslcert.sslcreator import CertificateCreator
 from sslcert.errors import SSlContextError
 
@@ -20,13 +33,38 @@ def get_id():
 class ProxyConnection:
     _iter_id = iter(get_id())
     _logger = logging.getLogger('proxyConnection')
+    _access_logger = logging.getLogger(ACCESS_LOGGER)
 
     def __init__(self,
                  buffer_size: int,
                  client_reader: StreamReader,
                  client_writer: StreamWriter,
                  password_collector,
-                 close_hook):
+                 close_hook,
+                 upstream_pool: Optional[UpstreamPool] = None,
+                 policy: Optional[InterceptPolicy] = None,
+                 tunnel_buffer_size: int = 65536,
+                 cert_creator: Optional[CertificateCreator] = None,
+                 client_context: Optional[ClientSSLContext] = None,
+                 cache: Optional[HTTPCache] = None,
+                 coalescer: Optional[RequestCoalescer] = None,
+                 socket_options: Optional[SocketOptions] = None,
+                 tunnel_idle_timeout: Optional[float] = None,
+                 timeouts: Optional[Timeouts] = None,
+                 metrics: Optional[Metrics] = None,
+                 slow_request: Optional[float] = None,
+                 resolver: Optional[Resolver] = None):
+        """
+        :param tunnel_idle_timeout: seconds without data after which
+                                    a tunnel or an upgraded connection
+                                    is closed, None disables it
+        :param timeouts: timeouts of HTTP messages and upstream connections
+        :param metrics: metrics of the server the connection counts in
+        :param slow_request: seconds from the head of a request to the end
+                             of its response after which the stages
+                             of the request are logged, None disables it
+        :param resolver: resolver of origin hosts
+        """
         self._id = next(self._iter_id)
         self._buffer_size = buffer_size
         self._close_hook = close_hook
@@ -34,10 +72,46 @@ class ProxyConnection:
         self._writer: StreamWriter = client_writer
         self._r_target: StreamReader = None
         self._w_target: StreamWriter = None
+        self._target: Optional[tuple[str, int]] = None
         self._https = False
-        self._cert_creator = CertificateCreator()
+        self._cert_creator = cert_creator
+        self._client_context = client_context
+        self._tls_host: Optional[str] = None
         self._closed = False
         self._password_collector = password_collector
+        self._upstream_pool = upstream_pool
+        self._policy = policy
+        self._tunnel_buffer_size = tunnel_buffer_size
+        self._tunnel_idle_timeout = tunnel_idle_timeout
+        self._upstream: Optional[UpstreamConnection] = None
+        self._upstream_reusable = True
+        self._cache = cache
+        self._coalescer = coalescer
+        self._socket_options = socket_options or SocketOptions()
+        self._timeouts = timeouts or Timeouts()
+        self._metrics = metrics or Metrics()
+        self._slow_request = slow_request
+        self._resolver = resolver or Resolver()
+        # Stages of opening the connection, the first request goes on.
+        self._timeline: Optional[Timeline] = Timeline()
+        # Watchdogs of messages from the client and to the client.
+        self._requests_activity = Activity()
+        self._responses_activity = Activity()
+        self._pending: deque[tuple[HTTPRequest, Optional[CacheLookup],
+                                   Optional[Flight], Timeline]] = deque()
+        self._request_sent = asyncio.Event()
+        self._client_done = False
+        # True after a request which does not keep the connection alive,
+        # the client sends no more requests.
+        self._last_request = False
+        # Result of the sent Upgrade request: True if protocols switched.
+        self._upgrade: Optional[asyncio.Future] = None
+        self._switched = False
+        # True after a 1xx response until the final one.
+        self._interim = False
+        self._peer = None
+        # Code, size and source of the last response sent to the client.
+        self._sent: tuple[int, int, str] = (0, 0, '-')
 
     @property
     def id(self):
@@ -66,34 +140,173 @@ class ProxyConnection:
         :return:
         """
         addr = self._writer.get_extra_info('peername')
+        self._peer = addr
         self._logger.info(f'({self.id}) New client {addr}')
-        request = await HTTPRequest().from_stream(source=self._reader)
-        if request.method is None and request.path is None:
-            raise UnresolvedRequest('')
-        self._logger.info(f'({self.id}) {request.method} {request.path}')
-        self._r_target, self._w_target = await asyncio.open_connection(
+        activity = self._requests_activity
+        timeline = self._timeline
+        async with activity.expect(self._timeouts.header, 'header'):
+            request = await HTTPRequest().from_stream(source=self._reader,
+                                                      read_content=False)
+            if request.method is None and request.path is None:
+                raise UnresolvedRequest('')
+            self._logger.info(f'({self.id}) {request.method} {request.path}')
+            self._https = b'CONNECT' == request.method.encode()
+            timeline.mark('tunnel_header' if self._https else 'header')
+            self._target = (request.host, request.port)
+            tunnel = False
+            if self._https:
+                await self._open_upstream(timeline)
+                tunnel = not self._should_intercept(request)
+                if not tunnel:
+                    await self._open_tls(target_host=request.host)
+            else:
+                # The upstream is opened by the first request
+                # the cache or a flight does not answer.
+                self._timeline = None
+                self._expect_upgrade(request)
+                activity.expect(self._timeouts.body, 'body')
+                await self._send_request(request, source=self._reader,
+                                         timeline=timeline)
+        if tunnel:
+            await self._open_tunnel()
+            return
+        await self._relay()
+
+    async def _relay(self):
+        """
+        Runs client->origin and origin->client pumps until the client
+        has no more requests and all responses are sent,
+        or either side closes the connection.
+        """
+        requests = asyncio.create_task(self._pump_requests())
+        responses = asyncio.create_task(self._pump_responses())
+        try:
+            await asyncio.wait({requests, responses},
+                               return_when=asyncio.FIRST_COMPLETED)
+            if requests.done() and not requests.exception():
+                await responses
+        finally:
+            requests.cancel()
+            responses.cancel()
+            results = await asyncio.gather(requests, responses,
+                                           return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        if self._switched:
+            await self._splice_upgraded()
+
+    async def _pump_requests(self):
+        activity = self._requests_activity
+        try:
+            async with activity:
+                if not await self._await_upgrade() \
+                        and not self._last_request:
+                    while await self._http_exchange(source=self._reader,
+                                                    target=self._w_target,
+                                                    server_side=True):
+                        pass
+        except ConnectionTimeout:
+            if activity.phase != 'idle':
+                raise
+            self._logger.info(
+                f'({self.id}) No request for {activity.timeout} s')
+        self._client_done = True
+        self._request_sent.set()
+
+    def _expect_upgrade(self, request: HTTPRequest):
+        if 'upgrade' in request.headers:
+            self._upgrade = asyncio.get_running_loop().create_future()
+
+    async def _await_upgrade(self) -> bool:
+        """
+        Waits for the response to the sent Upgrade request, if any.
+        Bytes after the request belong to the new protocol
+        if the origin switches to it.
+        :return: True if protocols switched
+        """
+        if self._upgrade is None:
+            return False
+        self._requests_activity.expect(None, 'upgrade')
+        switched = await self._upgrade
+        self._upgrade = None
+        return switched
+
+    async def _pump_responses(self):
+        async with self._responses_activity:
+            while await self._http_exchange(source=self._r_target,
+                                            target=self._writer,
+                                            server_side=False):
+                pass
+
+    async def _open_upstream(self, timeline: Timeline):
+        """
+        Connects to the target. Plain HTTP connections are taken
+        from the upstream pool, TLS tunnels always get a new one.
+        :param timeline: stages of the request opening the connection
+        """
+        host, port = self._target
+        self._requests_activity.expect(self._timeouts.connect, 'connect')
+        if self._upstream_pool is not None and not self._https:
+            self._upstream = await self._upstream_pool.acquire(host, port,
+                                                               timeline)
+            self._r_target = self._upstream.reader
+            self._w_target = self._upstream.writer
+        else:
+            self._r_target, self._w_target = await self._connect(
+                host=host, port=port, timeline=timeline)
+        timeline.mark('connect')
+        self._logger.info(f'({self.id}) Open TCP connection to {host}:{port}')
+
+    async def _connect(self, **kwargs) -> tuple[StreamReader, StreamWriter]:
+        """
+        Opens a new upstream connection.
+        :param kwargs: keyword arguments of open_connection
+        """
+        started = time.monotonic()
+        streams = await self._socket_options.open_connection(
+            resolver=self._resolver, **kwargs)
+        self._metrics.upstream_connect.observe(time.monotonic() - started)
+        return streams
+
+    def _should_intercept(self, request: HTTPRequest) -> bool:
+        if self._policy is None:
+            return True
+        address = self._w_target.get_extra_info('peername')
+        return self._policy.should_intercept(
             host=request.host,
             port=request.port,
-            family=socket.AF_INET
-        )
-        self._logger.info(f'({self.id}) Open TCP connection to {request.path}')
-        if b'CONNECT' == request.method.encode():
-            self._https = True
-            await self._open_tls(target_host=request.host)
-        else:
-            self._https = False
-            self._w_target.write(bytes(request))
-            await self._w_target.drain()
-
-        while True:
-            results = await asyncio.gather(
-                self._http_exchange(source=self._r_target,
-                                    target=self._writer, server_side=False),
-                self._http_exchange(source=self._reader,
-                                    target=self._w_target, server_side=True)
-            )
-            if not any(results):
-                break
+            address=address[0] if address else None)
+
+    async def _open_tunnel(self):
+        """
+        Splices the client and the target without interception.
+        """
+        self._writer.write(bytes(HTTPCode200))
+        await self._writer.drain()
+        self._logger.info(f'({self.id}) Tunnel opened without interception')
+        await self._splice('Tunnel')
+
+    async def _splice_upgraded(self):
+        """
+        Relays the protocol the origin switched to as raw bytes.
+        Bytes the client sent after the Upgrade request and bytes the origin
+        sent after 101 are still buffered by the readers.
+        """
+        self._logger.info(f'({self.id}) Switched protocols')
+        await self._splice('Upgraded connection')
+
+    async def _splice(self, name: str):
+        activity = Activity(self._tunnel_idle_timeout)
+        sent, received = await splice(self._reader, self._writer,
+                                      self._r_target, self._w_target,
+                                      self._tunnel_buffer_size, activity)
+        self._metrics.received_bytes += sent
+        self._metrics.sent_bytes += received
+        reason = ', idle' if activity.timed_out else ''
+        self._logger.info(
+            f'({self.id}) {name} closed '
+            f'(sent={sent}, received={received}{reason})')
 
     async def _open_tls(self, target_host):
         """
@@ -103,9 +316,16 @@ class ProxyConnection:
         :raise SSLContextError
         :return:
         """
+        context = self._client_context or ssl.create_default_context()
         await self._start_tls(stream=self._w_target,
-                              context=ssl.create_default_context(),
-                              server_side=False)
+                              context=context,
+                              server_side=False,
+                              server_hostname=target_host)
+        self._timeline.mark('origin_tls')
+        if self._client_context:
+            self._tls_host = target_host
+            self._client_context.handshake_done(
+                target_host, self._w_target.get_extra_info('ssl_object'))
         try:
             cert: dict = self._w_target.get_extra_info('peercert')
         except ValueError:
@@ -113,40 +333,54 @@ class ProxyConnection:
         if not cert:
             raise IllegalCertificate('Certificate is null or empty')
 
-        self._writer.write(bytes(HTTPCode200))
-        await self._writer.drain()
-        self._logger.info(
-            f'({self.id}) HTTP/1.1 200 has been sent to the client')
-
+        # The context is ready before 200 is sent: a ClientHello received
+        # while waiting would be buffered by the plain reader and lost.
         try:
-            context = self._cert_creator.create_sslcontext(target_host, cert)
+            if self._cert_creator is None:
+                raise SSlContextError('Root CA certificate is not loaded.')
+            context = await self._cert_creator.get_sslcontext(
+                target_host, cert)
         except SSlContextError as e:
             self._logger.warning(f'({self.id}) {e.message}')
             raise
+        self._timeline.mark('certificate')
+
+        self._writer.write(bytes(HTTPCode200))
+        await self._writer.drain()
+        self._logger.info(
+            f'({self.id}) HTTP/1.1 200 has been sent to the client')
 
         await self._start_tls(self._writer, context=context, server_side=True)
+        self._timeline.mark('client_tls')
 
     async def _start_tls(self, stream: StreamWriter,
                          context: ssl.SSLContext,
-                         server_side: bool):
+                         server_side: bool,
+                         server_hostname: Optional[str] = None):
         """
         :param stream:
         :param context:
         :param server_side:
+        :param server_hostname: origin host checked by the client side
         :raise IllegalCertificate
         :return:
         """
+        peer = 'client' if server_side else 'origin'
         try:
-            await stream.start_tls(sslcontext=context)
+            await stream.start_tls(sslcontext=context,
+                                   server_hostname=server_hostname)
         except ssl.SSLCertVerificationError as exc:
+            self._metrics.handshake(peer, ok=False)
             side = 'server_side' if server_side else 'client_side'
             self._logger.warning(
                 f'({self.id}) SSLCertVerificationError was occurred ({side}).')
             raise IllegalCertificate(exc.verify_message)
         except ssl.SSLError as e:
+            self._metrics.handshake(peer, ok=False)
             side = 'server_side' if server_side else 'client_side'
             self._logger.warning(f'({self.id}) SSLError was occured ({side})')
             raise SSLHandshakeError(f'{e.reason}')
+        self._metrics.handshake(peer, ok=True)
 
     def _request_cb(self, request: HTTPRequest) -> HTTPRequest:
         addr = self._writer.get_extra_info('peername')
@@ -156,45 +390,464 @@ class ProxyConnection:
     def _response_cb(self, response: HTTPResponse) -> HTTPResponse:
         return response
 
+    def _needs_content(self, package: HTTPRequest | HTTPResponse) -> bool:
+        """
+        :return: True if a callback inspects the content of the package,
+                 so it has to be buffered instead of streamed
+        """
+        if isinstance(package, HTTPRequest):
+            return self._password_collector.needs_content(package)
+        return False
+
+    async def _forward(self, package: HTTPRequest | HTTPResponse,
+                       source: StreamReader, target: StreamWriter, callback,
+                       with_content: bool = True,
+                       sink: Optional[StreamWriter] = None):
+        """
+        :param sink: writer the streamed content goes through to target
+        """
+        if with_content and self._needs_content(package):
+            await package.read_content(source)
+            package = callback(package)
+            buffers = package.to_buffers()
+            target.writelines(buffers)
+            await target.drain()
+            size = sum(map(len, buffers))
+        else:
+            package = callback(package)
+            head = package.head_bytes()
+            target.write(head)
+            await target.drain()
+            size = len(head)
+            if with_content:
+                size += await package.stream_content(
+                    source, sink or target, self._buffer_size,
+                    self._requests_activity
+                    if isinstance(package, HTTPRequest)
+                    else self._responses_activity)
+        if isinstance(package, HTTPRequest):
+            self._metrics.request(size)
+        else:
+            self._count_response(package.code, size, 'origin')
+        return package
+
+    def _count_response(self, code: int, size: int, source: str):
+        """
+        :param source: 'origin', 'cache' or 'coalesced'
+        """
+        self._metrics.response(code, size)
+        self._sent = (code, size, source)
+
+    def _prepare_request(self, request: HTTPRequest) -> HTTPRequest:
+        request = self._request_cb(request)
+        request.del_proxy_head()
+        return request
+
+    async def _send_request(self, request: HTTPRequest,
+                            source: StreamReader, timeline: Timeline):
+        """
+        Sends the request to the origin, the upstream is opened
+        if it is not yet. A request answered from the cache
+        or by the flight of another connection is only queued,
+        the response pump sends its response.
+        :param timeline: stages of the request, the head is received
+        """
+        lookup = None
+        if self._cache is not None:
+            lookup = await self._cache.lookup(request, self._https)
+        flight = None
+        if not (lookup and lookup.fresh):
+            flight = self._join_flight(request)
+        if not request.keep_alive:
+            self._last_request = True
+        if lookup and lookup.fresh or flight and flight.leader != self.id:
+            self._pending.append((request, lookup, flight, timeline))
+            self._request_sent.set()
+            self._prepare_request(request)
+            reason = 'cache hit' if lookup and lookup.fresh else 'coalesced'
+            self._logger.info(
+                f'({self.id}) HTTP: {request.method} {request.host} '
+                f'({reason})')
+            return
+        if self._w_target is None:
+            try:
+                await self._open_upstream(timeline)
+            except BaseException:
+                if flight:
+                    self._coalescer.abort(flight)
+                raise
+            self._requests_activity.expect(self._timeouts.body, 'body')
+        # The response pump reads the response once the request is queued.
+        self._pending.append((request, lookup, flight, timeline))
+        self._request_sent.set()
+        if lookup:
+            self._cache.add_validators(lookup, request)
+        request = await self._forward(request, source, self._w_target,
+                                      self._prepare_request)
+        timeline.mark('request')
+        self._logger.info(
+            f'({self.id}) '
+            f'HTTP: {request.method} {request.host}')
+
+    def _join_flight(self, request: HTTPRequest) -> Optional[Flight]:
+        """
+        Follows the flight of an identical request or leads a new one.
+        A connection waiting for a flight does not lead another one,
+        or two pipelines could wait for each other.
+        """
+        if self._coalescer is None:
+            return None
+        key = coalescing_key(request, self._https)
+        if key is None:
+            return None
+        flight = self._coalescer.follow(key)
+        if flight is None and not any(
+                waiting and waiting.leader != self.id
+                for _, _, waiting, _ in self._pending):
+            flight = self._coalescer.lead(key, self.id, request)
+        return flight
+
     async def _http_exchange(self,
                              source: StreamReader,
                              target: StreamWriter,
                              server_side: bool) -> bool:
-        if target.is_closing():
+        """
+        Forwards one message from source to target.
+        The upstream side is None until a request opens it.
+        :return: False if no more messages can be forwarded
+        """
+        if target is not None and target.is_closing():
             return False
         if server_side:
-            package = self._request_cb(await HTTPRequest().from_stream(source))
-            package.del_proxy_head()
-            self._logger.info(
-                f'({self.id}) '
-                f'HTTP: {package.method} {package.host}')
-        else:
-            package = self._response_cb(
-                await HTTPResponse().from_stream(source))
-            self._logger.info(
-                f'({self.id}) '
-                f'HTTP: {package.proto} {package.code} {package.message}')
+            activity = self._requests_activity.expect(self._timeouts.idle,
+                                                      'idle')
+            try:
+                request = await HTTPRequest().from_stream(
+                    source, read_content=False,
+                    activity=activity, timeout=self._timeouts.header)
+            except EndOfStream:
+                return False
+            target = self._w_target
+            if target is not None and target.is_closing():
+                return False
+            # The header phase started with the first byte of the request.
+            timeline = self._timeline or Timeline(activity.started)
+            self._timeline = None
+            timeline.mark('header')
+            self._expect_upgrade(request)
+            activity.expect(self._timeouts.body, 'body')
+            await self._send_request(request, source, timeline)
+            return not await self._await_upgrade() and not self._last_request
+
+        activity = self._responses_activity.expect(None, 'request')
+        pending = await self._next_request()
+        if pending is None:
+            return False
+        request, lookup, flight, timeline = pending
+        if lookup and lookup.fresh:
+            self._pending.popleft()
+            activity.expect(self._timeouts.body, 'body')
+            await self._send_cached(lookup, target, request.keep_alive)
+            self._finish(request, timeline)
+            return request.keep_alive
+        activity.expect(self._timeouts.response, 'response')
+        if source is None:
+            # The request opened the upstream while the pump waited.
+            source = self._r_target
+        if flight and flight.leader != self.id:
+            self._pending.popleft()
+            try:
+                keep_alive = await self._send_coalesced(request, flight,
+                                                        target)
+            finally:
+                flight.leave()
+            self._finish(request, timeline)
+            return keep_alive
+        started = time.monotonic()
+        response = await HTTPResponse().from_stream(source,
+                                                    read_content=False)
+        # The first byte of a response preceded by 1xx came with 1xx.
+        if not self._interim:
+            self._metrics.first_byte.observe(time.monotonic() - started)
+            timeline.mark('first_byte')
+        self._interim = response.code < 200
+        response_time = time.time()
+        activity.expect(self._timeouts.body, 'body')
         if target.is_closing():
             return False
-        target.write(bytes(package))
+        upgrade = self._upgrade if 'upgrade' in request.headers else None
+        if upgrade and response.code == 101:
+            await self._forward(response, source, target, self._response_cb,
+                                with_content=False)
+            self._pending.popleft()
+            self._finish(request, timeline)
+            self._upstream_reusable = False
+            self._switched = True
+            upgrade.set_result(True)
+            return False
+        if lookup and lookup.revalidating and response.code == 304:
+            self._track_response(response)
+            await self._cache.refresh(lookup, response, response_time)
+            if flight:
+                self._coalescer.publish(flight, response)
+                self._coalescer.finish(flight)
+            await self._send_cached(lookup, target, request.keep_alive)
+            self._finish(request, timeline)
+            return self._answered(request)
+        with_content = response.has_content(request.method)
+        cache_sink = None
+        if lookup and with_content \
+                and self._cache.is_storable(request, response):
+            cache_sink = self._cache.sink(target)
+        sink = cache_sink
+        if flight and response.code >= 200:
+            self._coalescer.publish(flight, response)
+            if with_content and flight.needs_content:
+                sink = flight.sink(sink or target)
+        response = await self._forward(
+            response, source, target, self._response_cb,
+            with_content=with_content, sink=sink)
+        self._track_response(response)
+        if response.code >= 200:
+            self._finish(request, timeline)
+        if upgrade and response.code >= 200:
+            upgrade.set_result(False)
+        if flight and response.code >= 200:
+            self._coalescer.finish(flight)
+        if cache_sink and not cache_sink.overflowed:
+            await self._cache.store(lookup, request, response,
+                                    cache_sink.content, response_time)
+        elif self._cache and request.method not in SAFE_METHODS \
+                and response.code < 400:
+            await self._cache.invalidate(cache_key(request, self._https))
+        self._logger.info(
+            f'({self.id}) '
+            f'HTTP: {response.proto} {response.code} {response.message}')
+        if response.code < 200:
+            return self._upstream_reusable
+        return self._answered(request)
+
+    def _answered(self, request: HTTPRequest) -> bool:
+        """
+        Ends the exchange of a request answered by the origin. The origin
+        closes the connection after a request which does not keep it alive.
+        :return: False if no more messages can be forwarded
+        """
+        if not request.keep_alive:
+            self._upstream_reusable = False
+        return self._upstream_reusable
+
+    def _finish(self, request: HTTPRequest, timeline: Timeline):
+        """
+        Ends the stages of the request as its response is sent,
+        writes the access log line and logs the stages
+        if the request is slow.
+        """
+        timeline.mark('response')
+        if self._access_logger.isEnabledFor(logging.INFO):
+            self._access_logger.info(self._access_line(request, timeline))
+        if self._slow_request is not None \
+                and timeline.elapsed >= self._slow_request:
+            self._logger.warning(
+                f'({self.id}) Slow request {request.method} {request.host} '
+                f'{request.path}: {timeline.elapsed * 1000:.0f} ms '
+                f'({timeline})')
+
+    def _access_line(self, request: HTTPRequest, timeline: Timeline) -> str:
+        code, size, source = self._sent
+        client = None
+        if self._peer:
+            client = f'{self._peer[0]}:{self._peer[1]}'
+        return format_fields({
+            'conn': self.id,
+            'client': client,
+            'method': request.method,
+            'scheme': 'https' if self._https else 'http',
+            'host': request.host,
+            'path': request.path,
+            'status': code,
+            'bytes': size,
+            'source': source,
+            'duration_ms': round(timeline.elapsed * 1000, 1)
+        })
+
+    async def _send_cached(self, lookup: CacheLookup, target: StreamWriter,
+                           keep_alive: bool = True):
+        """
+        :param keep_alive: False if the client connection is closed
+                           after the response
+        """
+        response = lookup.to_response(time.time())
+        if not keep_alive:
+            response.headers['connection'] = 'close'
+        response = self._response_cb(response)
+        buffers = response.to_buffers()
+        target.writelines(buffers)
         await target.drain()
+        self._count_response(response.code, sum(map(len, buffers)), 'cache')
+        self._logger.info(
+            f'({self.id}) '
+            f'HTTP: {response.proto} {response.code} {response.message} '
+            f'(cache)')
+
+    async def _send_coalesced(self, request: HTTPRequest, flight: Flight,
+                              target: StreamWriter) -> bool:
+        """
+        Sends the response of a flight led by another connection.
+        The request is sent on its own if the response is not shared
+        or its start is not kept anymore.
+        :return: False if the client connection can not be kept
+        """
+        response = await flight.response()
+        activity = self._responses_activity.expect(self._timeouts.body,
+                                                   'body')
+        if response is not None and response.code == 304 and self._cache:
+            lookup = await self._cache.lookup(request, self._https)
+            if lookup and lookup.fresh:
+                await self._send_cached(lookup, target, request.keep_alive)
+                return request.keep_alive
+        if response is None or not flight.is_shared_with(request) \
+                or not flight.replayable:
+            self._coalescer.alone += 1
+            return await self._fetch_alone(request, target)
+        response = self._response_cb(response)
+        head = response.head_bytes()
+        target.write(head)
+        await target.drain()
+        size = len(head)
+        if response.has_content(request.method):
+            async for data in flight.content():
+                target.write(data)
+                size += len(data)
+                activity.touch()
+                await target.drain()
+                activity.touch()
+        self._count_response(response.code, size, 'coalesced')
+        self._logger.info(
+            f'({self.id}) '
+            f'HTTP: {response.proto} {response.code} {response.message} '
+            f'(coalesced)')
+        return request.keep_alive and self._keeps_alive(response)
+
+    async def _fetch_alone(self, request: HTTPRequest,
+                           target: StreamWriter) -> bool:
+        """
+        Sends the request on a separate upstream connection,
+        the connection of the client may carry its next requests already.
+        :return: False if the client connection can not be kept
+        """
+        host, port = self._target
+        upstream = None
+        activity = self._responses_activity.expect(self._timeouts.connect,
+                                                   'connect')
+        if self._https:
+            reader, writer = await self._connect(
+                host=host, port=port,
+                ssl=self._client_context or ssl.create_default_context(),
+                server_hostname=host)
+        elif self._upstream_pool is not None:
+            upstream = await self._upstream_pool.acquire(host, port)
+            reader, writer = upstream.reader, upstream.writer
+        else:
+            reader, writer = await self._connect(host=host, port=port)
+        keep_alive = False
+        try:
+            activity.expect(self._timeouts.response, 'response')
+            writer.write(request.head_bytes())
+            await writer.drain()
+            started = time.monotonic()
+            response = await HTTPResponse().from_stream(reader,
+                                                        read_content=False)
+            self._metrics.first_byte.observe(time.monotonic() - started)
+            while response.code < 200:
+                response = await HTTPResponse().from_stream(
+                    reader, read_content=False)
+            activity.expect(self._timeouts.body, 'body')
+            response = await self._forward(
+                response, reader, target, self._response_cb,
+                with_content=response.has_content(request.method))
+            keep_alive = request.keep_alive and self._keeps_alive(response)
+        finally:
+            if upstream is not None:
+                self._upstream_pool.release(upstream, reusable=keep_alive)
+            else:
+                writer.close()
+        self._logger.info(
+            f'({self.id}) '
+            f'HTTP: {response.proto} {response.code} {response.message} '
+            f'(alone)')
+        return keep_alive
+
+    async def _next_request(
+            self) -> Optional[tuple[HTTPRequest, Optional[CacheLookup],
+                                    Optional[Flight]]]:
+        """
+        Waits for a request sent to the origin and not answered yet.
+        :return: None if the client will not send more requests
+        """
+        while not self._pending:
+            if self._client_done:
+                return None
+            self._request_sent.clear()
+            await self._request_sent.wait()
+        return self._pending[0]
+
+    @staticmethod
+    def _keeps_alive(response: HTTPResponse) -> bool:
+        """
+        :return: True if the connection can carry the next message
+        """
+        return response.code != 101 and response.keep_alive \
+            and (response.framed or response.bodiless)
+
+    def _track_response(self, response: HTTPResponse):
+        if response.code >= 200 and self._pending:
+            self._pending.popleft()
+        if not self._keeps_alive(response):
+            self._upstream_reusable = False
+
+    def _release_upstream(self) -> bool:
+        """
+        Returns the upstream connection to the pool if no response
+        is expected on it.
+        :return: True if the connection was released
+        """
+        if self._upstream is None:
+            return False
+        self._upstream_pool.release(
+            self._upstream,
+            reusable=self._upstream_reusable and not self._pending)
+        self._upstream = None
         return True
 
+    def _abort_flights(self):
+        """
+        Followers of flights whose responses will not be received
+        send their requests on their own, or are closed if they
+        received a part of the response.
+        """
+        if self._coalescer is None:
+            return
+        for _, _, flight, _ in self._pending:
+            if flight and flight.leader == self.id:
+                self._coalescer.abort(flight)
+
     async def _close_connections(self):
+        if self._tls_host and self._w_target:
+            self._client_context.save_session(
+                self._tls_host, self._w_target.get_extra_info('ssl_object'))
         self._writer.close()
-        if self._w_target:
+        closing = [self._writer.wait_closed()]
+        if self._w_target and not self._release_upstream():
             self._w_target.close()
-            await asyncio.gather(
-                self._writer.wait_closed(),
-                self._w_target.wait_closed()
-            )
-        else:
-            await self._writer.wait_closed()
+            closing.append(self._w_target.wait_closed())
+        await asyncio.gather(*closing)
         self._logger.info(f'({self.id}) Disconnected.')
 
     async def close(self):
         if not self._closed:
             self._closed = True
+            self._abort_flights()
             await self._close_connections()
             self._close_hook(self)
             self._logger.info(f'({self.id}) Close connection object.')
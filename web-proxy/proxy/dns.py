@@ -0,0 +1,280 @@
+import asyncio
+import ipaddress
+import logging
+import socket
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from proxy.errors import UnresolvedHost
+from proxy.metrics import Timeline
+
+RESOLVERS = ('auto', 'system', 'aiodns')
+
+# Family and socket address of a resolved host.
+Address = tuple[int, tuple]
+
+
+def _interleave(addresses: list[Address]) -> list[Address]:
+    """
+    Alternates address families starting with the family of the first
+    address, as RFC 8305 orders connection attempts.
+    """
+    families: OrderedDict[int, list[Address]] = OrderedDict()
+    for address in addresses:
+        families.setdefault(address[0], []).append(address)
+    ordered = []
+    groups = list(families.values())
+    for index in range(max(map(len, groups), default=0)):
+        ordered += [group[index] for group in groups if index < len(group)]
+    return ordered
+
+
+class Resolver:
+    """
+    Resolves hosts of upstream connections and caches their addresses.
+    aiodns is optional: it queries A and AAAA records and entries expire
+    with the records, the system resolver of the event loop is used
+    if it is not installed or does not answer, its entries live ttl
+    seconds. Failures are cached for negative_ttl seconds, least recently
+    used entries are evicted over max_entries.
+    Concurrent lookups of a host share one query.
+    """
+    _logger = logging.getLogger('resolver')
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 60.0,
+                 negative_ttl: float = 5.0, max_ttl: float = 3600.0,
+                 happy_eyeballs_delay: Optional[float] = 0.25,
+                 backend: str = 'auto'):
+        """
+        :param max_entries: 0 disables the cache
+        :param ttl: seconds addresses from the system resolver are kept
+        :param max_ttl: most seconds addresses from DNS records are kept
+        :param happy_eyeballs_delay: seconds before the next address is
+                                     tried while the previous one is
+                                     connecting, None tries them one
+                                     after another
+        :param backend: 'auto' is aiodns if installed
+        """
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._negative_ttl = negative_ttl
+        self._max_ttl = max_ttl
+        self._delay = happy_eyeballs_delay
+        self.backend = self._select_backend(backend)
+        self._aiodns = None
+        self._entries: OrderedDict[tuple[str, int],
+                                   tuple[Optional[list[Address]], float]] = \
+            OrderedDict()
+        self._queries: dict[tuple[str, int], asyncio.Future] = dict()
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.failures = 0
+        self.connects = 0
+        self.fallbacks = 0
+
+    def _select_backend(self, name: str) -> str:
+        """
+        'auto' falls back to the system resolver silently,
+        'aiodns' with a warning.
+        :return: name of the used resolver
+        """
+        if name not in RESOLVERS:
+            raise ValueError(f'Unknown resolver: {name}')
+        if name == 'system':
+            return name
+        try:
+            import aiodns
+        except ImportError:
+            if name == 'aiodns':
+                self._logger.warning(
+                    'aiodns is not installed, the system resolver is used.')
+            return 'system'
+        return 'aiodns'
+
+    async def resolve(self, host: str, port: int) -> list[Address]:
+        """
+        :return: addresses in the order they are tried
+        :raise UnresolvedHost
+        """
+        if not host:
+            raise UnresolvedHost('Request without a host.')
+        literal = self._literal(host, port)
+        if literal is not None:
+            return literal
+        key = (host, port)
+        cached = self._entries.get(key)
+        if cached is not None:
+            addresses, expires = cached
+            if expires > time.monotonic():
+                self._entries.move_to_end(key)
+                if addresses is None:
+                    self.negative_hits += 1
+                    raise UnresolvedHost(f'{host} (cached)')
+                self.hits += 1
+                return addresses
+            del self._entries[key]
+        future = self._queries.get(key)
+        if future is None:
+            self.misses += 1
+            future = asyncio.ensure_future(self._query(host, port))
+            self._queries[key] = future
+            future.add_done_callback(lambda _: self._queries.pop(key, None))
+        return await asyncio.shield(future)
+
+    @staticmethod
+    def _literal(host: str, port: int) -> Optional[list[Address]]:
+        try:
+            ip = ipaddress.ip_address(host.strip('[]'))
+        except ValueError:
+            return None
+        if ip.version == 6:
+            return [(socket.AF_INET6, (str(ip), port, 0, 0))]
+        return [(socket.AF_INET, (str(ip), port))]
+
+    async def _query(self, host: str, port: int) -> list[Address]:
+        addresses, ttl = [], self._ttl
+        try:
+            if self.backend == 'aiodns':
+                addresses, ttl = await self._query_dns(host, port)
+            if not addresses:
+                addresses, ttl = await self._getaddrinfo(host, port), \
+                    self._ttl
+        except OSError as e:
+            self.failures += 1
+            self._store((host, port), None, self._negative_ttl)
+            raise UnresolvedHost(f'{host}: {e}') from e
+        self._store((host, port), addresses, ttl)
+        return addresses
+
+    async def _getaddrinfo(self, host: str, port: int) -> list[Address]:
+        infos = await asyncio.get_running_loop().getaddrinfo(
+            host, port, type=socket.SOCK_STREAM)
+        return _interleave([(family, sockaddr)
+                            for family, _, _, _, sockaddr in infos])
+
+    async def _query_dns(self, host: str,
+                         port: int) -> tuple[list[Address], float]:
+        """
+        Queries AAAA and A records, names the DNS does not know,
+        such as names of the hosts file, get no addresses.
+        :return: addresses and the least TTL of the records
+        """
+        if self._aiodns is None:
+            import aiodns
+            self._aiodns = aiodns.DNSResolver()
+        results = await asyncio.gather(self._aiodns.query(host, 'AAAA'),
+                                       self._aiodns.query(host, 'A'),
+                                       return_exceptions=True)
+        addresses, ttls = [], []
+        for family, records in zip((socket.AF_INET6, socket.AF_INET),
+                                   results):
+            if isinstance(records, Exception):
+                continue
+            for record in records:
+                sockaddr = (record.host, port, 0, 0) \
+                    if family == socket.AF_INET6 else (record.host, port)
+                addresses.append((family, sockaddr))
+                ttls.append(record.ttl)
+        ttl = min(max(min(ttls, default=0), 1), self._max_ttl)
+        return _interleave(addresses), ttl
+
+    def _store(self, key: tuple[str, int],
+               addresses: Optional[list[Address]], ttl: float):
+        if not self._max_entries:
+            return
+        self._entries[key] = (addresses, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    async def connect(self, host: str, port: int,
+                      timeline: Optional[Timeline] = None) -> socket.socket:
+        """
+        Connects to the first answering address of the host.
+        Attempts are started happy_eyeballs_delay seconds apart,
+        or at once when the previous one fails, the first connected
+        socket wins and the other attempts are cancelled (RFC 8305).
+        :param timeline: stages of the request, the 'dns' stage
+                         ends when the host is resolved
+        :return: connected non-blocking socket
+        :raise UnresolvedHost
+        :raise OSError if no address can be connected
+        """
+        addresses = await self.resolve(host, port)
+        if timeline is not None:
+            timeline.mark('dns')
+        self.connects += 1
+        attempts: list[asyncio.Task] = []
+        winner = None
+        try:
+            for address in addresses:
+                attempts.append(asyncio.create_task(self._attempt(address)))
+                winner = await self._wait_attempts(attempts, self._delay)
+                if winner is not None:
+                    break
+            else:
+                winner = await self._wait_attempts(attempts, None)
+        finally:
+            for attempt in attempts:
+                if not attempt.done():
+                    attempt.cancel()
+                elif attempt is not winner and not attempt.cancelled() \
+                        and attempt.exception() is None:
+                    attempt.result().close()
+        if winner is None:
+            errors = ', '.join(str(attempt.exception())
+                               for attempt in attempts)
+            raise OSError(f'Could not connect to {host}:{port}: {errors}')
+        if winner is not attempts[0]:
+            self.fallbacks += 1
+        return winner.result()
+
+    @staticmethod
+    async def _wait_attempts(attempts: list[asyncio.Task],
+                             delay: Optional[float]) -> \
+            Optional[asyncio.Task]:
+        """
+        Waits until an attempt connects, all of them fail,
+        or delay seconds pass.
+        :param delay: None waits without a limit
+        :return: the first connected attempt
+        """
+        loop = asyncio.get_running_loop()
+        deadline = None if delay is None else loop.time() + delay
+        while True:
+            for attempt in attempts:
+                if attempt.done() and attempt.exception() is None:
+                    return attempt
+            running = [attempt for attempt in attempts if not attempt.done()]
+            if not running:
+                return None
+            timeout = None if deadline is None else deadline - loop.time()
+            if timeout is not None and timeout <= 0:
+                return None
+            await asyncio.wait(running, timeout=timeout,
+                               return_when=asyncio.FIRST_COMPLETED)
+
+    @staticmethod
+    async def _attempt(address: Address) -> socket.socket:
+        family, sockaddr = address
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            sock.setblocking(False)
+            await asyncio.get_running_loop().sock_connect(sock, sockaddr)
+        except BaseException:
+            sock.close()
+            raise
+        return sock
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'negative_hits': self.negative_hits,
+            'failures': self.failures,
+            'connects': self.connects,
+            'fallbacks': self.fallbacks
+        }
@@ -2,59 +2,50 @@
 class ProxyError(Exception):
     message = 'ProxyError.'
 
+    def __init__(self, message=''):
+        # Only the template of the class is formatted, braces
+        # in the message are kept as they are.
+        self.message = type(self).message.format(message)
+        super().__init__(self.message)
+
 
 class ProxyOpenError(ProxyError):
     message = 'ProxyOpenError (ProxyError): could not open proxy. {}'
 
-    def __init__(self, message):
-        self.message = self.message.format(message)
-        super().__init__(self.message)
-
 
 class ConnectionException(ProxyError):
     message = 'ConnectionException(ProxyError): connection exception. {}'
 
-    def __init__(self, message):
-        self.message = self.message.format(message)
-        super().__init__(self.message)
-
 
 class CloseConnection(ConnectionException):
     message = 'CloseConnection (ConnectionException). ' \
               'Unplanned connection close. {}'
 
-    def __init__(self, message):
-        self.message = self.message.format(message)
-        super().__init__(self.message)
+
+class ConnectionTimeout(ConnectionException):
+    message = 'ConnectionTimeout (ConnectionException). {}'
 
 
 class UnresolvedRequest(ConnectionException):
     message = 'UnresolvedRequest (ConnectionException). {}'
 
-    def __init__(self, message):
-        self.message = self.message.format(message)
-        super().__init__(self.message)
+
+class UnresolvedHost(ConnectionException):
+    message = 'UnresolvedHost (ConnectionException). {}'
 
 
 class IllegalCertificate(ConnectionException):
     message = 'IllegalCertificate (ConnectionException). {}'
 
-    def __init__(self, message):
-        self.message = self.message.format(message)
-        super().__init__(self.message)
-
 
 class SSLHandshakeError(ConnectionException):
     message = 'SSLHandshakeError (ConnectionException). {}'
 
-    def __init__(self, message):
-        self.message = self.message.format(message)
-        super().__init__(self.message)
-
 
 class HTTPParsingException(ConnectionException):
     message = 'HTTPParsingException (ConnectionException). {}'
 
-    def __init__(self, message):
-        self.message = self.message.format(message)
-        super().__init__(self.message)
+
+class EndOfStream(HTTPParsingException):
+    message = 'EndOfStream (HTTPParsingException). ' \
+              'Connection closed before a new message. {}'
@@ -1,15 +1,264 @@
+import re
 import zlib
 from abc import ABC
-from asyncio import StreamReader
+from asyncio import StreamReader, StreamWriter
+from collections.abc import Iterable, Iterator, Mapping, MutableMapping
 from dataclasses import dataclass, field
-from typing import Dict, Optional
-from asyncio.exceptions import IncompleteReadError
+from typing import Optional, Union
+from asyncio.exceptions import IncompleteReadError, LimitOverrunError
 import brotli
 
-from proxy.errors import HTTPParsingException
+from proxy.errors import HTTPParsingException, EndOfStream
+from proxy.timeouts import Activity
 
 
 CRLF = b'\r\n'
+MAX_HEAD_SIZE = 2 ** 16
+MAX_HEADER_FIELDS = 100
+# The empty line ending the head, bare LF is tolerated.
+_HEAD_END = re.compile(rb'\n\r?\n')
+# A whole field line: the name, a colon and the value. Trailing whitespace
+# of the value is stripped when it is decoded, a lazy match is much slower.
+_FIELD = re.compile(rb'^([^\s:]+):[ \t]*([^\r\n]*)\r?\n', re.MULTILINE)
+
+
+def _decode(value: Union[str, bytes]) -> str:
+    # Bytes that are not UTF-8 are kept as surrogates and encoded back.
+    return value if isinstance(value, str) \
+        else value.rstrip(b' \t').decode(errors='surrogateescape')
+
+
+def _encode(value: Union[str, bytes]) -> bytes:
+    return value.encode(errors='surrogateescape') if isinstance(value, str) \
+        else value
+
+
+class Headers(MutableMapping[str, str]):
+    """
+    Header fields in the order they were received.
+    Fields of a parsed head are raw bytes: names are decoded on the first
+    lookup, values when they are read, unread fields are written back
+    as they were received.
+    Lookups are case-insensitive. Values of a repeated field are joined
+    with ', ', except Set-Cookie, which can not be joined and gives
+    the last value; get_all returns each value.
+    """
+
+    def __init__(self, fields: Union[Mapping[str, str],
+                                     Iterable[tuple]] = ()):
+        """
+        :param fields: mapping or (name, value) pairs of str or bytes
+        """
+        if isinstance(fields, Mapping):
+            fields = fields.items()
+        # [name, value] of each field
+        self._fields = list(map(list, fields))
+        # Fields by lowercase name, built on the first lookup.
+        self._index: Optional[dict[str, list[list]]] = None
+        # Fields were added, changed or removed.
+        self.modified = False
+
+    def _entries(self, name: str) -> list[list]:
+        if self._index is None:
+            self._index = index = dict()
+            for entry in self._fields:
+                key = entry[0]
+                key = key.lower() if isinstance(key, str) \
+                    else key.decode('latin-1').lower()
+                if key in index:
+                    index[key].append(entry)
+                else:
+                    index[key] = [entry]
+        return self._index.get(name.lower(), [])
+
+    def get_all(self, name: str) -> list[str]:
+        values = []
+        for entry in self._entries(name):
+            entry[1] = _decode(entry[1])
+            values.append(entry[1])
+        return values
+
+    def add(self, name: str, value: str):
+        """
+        Appends a field without replacing fields of the same name.
+        """
+        entry = [name, value]
+        self._fields.append(entry)
+        self.modified = True
+        if self._index is not None:
+            self._index.setdefault(name.lower(), []).append(entry)
+
+    def fields(self) -> Iterator[tuple[str, str]]:
+        """
+        :return: (name, value) of each field in order, names in their case
+        """
+        for entry in self._fields:
+            entry[1] = _decode(entry[1])
+            yield _decode(entry[0]), entry[1]
+
+    def copy(self) -> 'Headers':
+        return Headers(self._fields)
+
+    def __getitem__(self, name: str) -> str:
+        values = self.get_all(name)
+        if not values:
+            raise KeyError(name)
+        if len(values) == 1:
+            return values[0]
+        if name.lower() == 'set-cookie':
+            return values[-1]
+        return ', '.join(values)
+
+    def __setitem__(self, name: str, value: str):
+        entries = self._entries(name)
+        if not entries:
+            self.add(name, value)
+            return
+        entries[0][1] = value
+        self.modified = True
+        if len(entries) > 1:
+            self._remove(entries[1:])
+            del entries[1:]
+
+    def __delitem__(self, name: str):
+        entries = self._entries(name)
+        if not entries:
+            raise KeyError(name)
+        self._remove(entries)
+        del self._index[name.lower()]
+        self.modified = True
+
+    def _remove(self, entries: list[list]):
+        removed = set(map(id, entries))
+        self._fields = [entry for entry in self._fields
+                        if id(entry) not in removed]
+
+    def __contains__(self, name) -> bool:
+        return isinstance(name, str) and bool(self._entries(name))
+
+    def __iter__(self) -> Iterator[str]:
+        self._entries('')
+        return iter(list(self._index))
+
+    def __len__(self) -> int:
+        self._entries('')
+        return len(self._index)
+
+    def __bytes__(self) -> bytes:
+        """
+        :return: field lines, raw bytes of the fields are written as is
+        """
+        lines = []
+        for name, value in self._fields:
+            lines += (_encode(name), b': ', _encode(value), CRLF)
+        return b''.join(lines)
+
+    def __repr__(self) -> str:
+        return f'Headers({list(self.fields())})'
+
+
+class HTTPHeadParser:
+    """
+    Incremental parser of the start line and the header section.
+    Data may be fed in pieces of any size: pieces of an incomplete head
+    are collected in a reused bytearray, a head that arrives in one piece
+    is kept without copying. The head is scanned by regular expressions,
+    so lines are not split in Python; names and values stay raw bytes
+    until Headers decodes them.
+    """
+
+    def __init__(self, max_size: int = MAX_HEAD_SIZE,
+                 max_fields: int = MAX_HEADER_FIELDS):
+        """
+        :param max_size: most bytes of the start line and the header section
+        :param max_fields: most header fields
+        """
+        self.max_size = max_size
+        self.max_fields = max_fields
+        self._buffer = bytearray()
+        self.reset()
+
+    def reset(self):
+        """
+        Prepares the parser for the next head.
+        """
+        self._buffer.clear()
+        self._scanned = 0
+        self.done = False
+        self.start_line: Optional[tuple[str, str, str]] = None
+        self.headers: Optional[Headers] = None
+        self.head = b''
+
+    def feed(self, data: bytes) -> int:
+        """
+        :return: count of consumed bytes, it is less than len(data)
+                 if the head ends before the end of data
+        :raise HTTPParsingException
+        """
+        if self.done:
+            return 0
+        skipped = 0
+        if not self._buffer:
+            # Empty lines before the request line are ignored.
+            while skipped < len(data) and data[skipped] in CRLF:
+                skipped += 1
+            if skipped:
+                data = data[skipped:]
+        source = data
+        buffered = len(self._buffer)
+        if buffered:
+            self._buffer += data
+            source = self._buffer
+        match = _HEAD_END.search(source, self._scanned, self.max_size)
+        if match is None:
+            if len(source) >= self.max_size:
+                raise HTTPParsingException(
+                    f'Head is larger than {self.max_size} bytes')
+            # The empty line may be split between pieces.
+            self._scanned = max(0, len(source) - 2)
+            if source is data:
+                self._buffer += data
+            return skipped + len(data)
+        end = match.end()
+        if source is data:
+            self.head = data if end == len(data) else data[:end]
+        else:
+            self.head = bytes(source[:end])
+            self._buffer.clear()
+        self._parse(self.head)
+        self.done = True
+        return skipped + end - buffered
+
+    def _parse(self, head: bytes):
+        fields_start = head.find(b'\n') + 1
+        line = head[:fields_start].rstrip()
+        parts = [part.decode() for part in line.split(b' ', 2)]
+        if len(parts) < 2 or not all(parts[:2]):
+            raise HTTPParsingException(f'Invalid start line: {line!r}')
+        self.start_line = (*parts, '')[:3]
+        fields = _FIELD.findall(head, fields_start)
+        # Each line but the last empty one must be a field.
+        if len(fields) != head.count(b'\n', fields_start) - 1:
+            self._raise_invalid_field(head[fields_start:])
+        if len(fields) > self.max_fields:
+            raise HTTPParsingException(
+                f'More than {self.max_fields} header fields')
+        self.headers = Headers(fields)
+        lengths = self.headers.get_all('content-length')
+        if len(set(lengths)) > 1:
+            raise HTTPParsingException(
+                f'Conflicting content-length: {lengths}')
+        if len(lengths) > 1:
+            self.headers['content-length'] = lengths[0]
+
+    @staticmethod
+    def _raise_invalid_field(lines: bytes):
+        for line in lines.splitlines(keepends=True):
+            if not _FIELD.match(line):
+                if line[:1] in (b' ', b'\t'):
+                    raise HTTPParsingException(
+                        'Obsolete line folding of a header field')
+                raise HTTPParsingException(f'Invalid header field: {line!r}')
 
 
 def _parse_headers(data: bytes) -> dict[str, str]:
@@ -23,30 +272,193 @@ def _parse_headers(data: bytes) -> dict[str, str]:
     return headers
 
 
+def _chunk_size(line: bytes) -> int:
+    try:
+        return int(line.split(b';', maxsplit=1)[0], 16)
+    except ValueError as e:
+        raise HTTPParsingException(f'Invalid chunk size: {line!r}') from e
+
+
 async def _read_chunked_content(source: StreamReader) -> bytes:
-    content = b''
+    chunks = []
     try:
-        count = int(await source.readuntil(CRLF), 16)
+        count = _chunk_size(await source.readuntil(CRLF))
         while count != 0:
-            content += await source.readexactly(count)
+            chunks.append(await source.readexactly(count))
             await source.readuntil(CRLF)
-            count = int(await source.readuntil(CRLF), 16)
-        return content
+            count = _chunk_size(await source.readuntil(CRLF))
+        return b''.join(chunks)
     except IncompleteReadError as e:
         raise HTTPParsingException(e) from e
 
 
-async def _read_first_line_and_headers(source: StreamReader) -> (bytes, bytes):
+async def _read_trailers(source: StreamReader) -> bytes:
+    """
+    Reads the trailer section that follows the last chunk.
+    The terminating empty line is consumed but not returned.
+    :raise HTTPParsingException
+    """
+    lines = []
+    while True:
+        try:
+            line = await source.readuntil(CRLF)
+        except IncompleteReadError as e:
+            if e.partial:
+                raise HTTPParsingException(e) from e
+            break
+        if line == CRLF:
+            break
+        lines.append(line)
+    return b''.join(lines)
+
+
+async def _relay_content(source: StreamReader, target: StreamWriter,
+                         length: int, buffer_size: int,
+                         activity: Activity) -> int:
+    total = length
+    while length > 0:
+        data = await source.read(min(buffer_size, length))
+        if not data:
+            raise HTTPParsingException(
+                f'Connection closed, {length} bytes of content are missing')
+        length -= len(data)
+        target.write(data)
+        activity.touch()
+        await target.drain()
+        activity.touch()
+    return total
+
+
+async def _relay_chunked_content(source: StreamReader, target: StreamWriter,
+                                 buffer_size: int, activity: Activity) -> int:
+    total = 0
     try:
-        headers_bytes = await source.readuntil(CRLF * 2)
+        line = await source.readuntil(CRLF)
+        count = _chunk_size(line)
+        while count != 0:
+            target.write(line)
+            total += len(line)
+            total += await _relay_content(source, target, count, buffer_size,
+                                          activity)
+            line = await source.readuntil(CRLF)
+            target.write(line)
+            total += len(line)
+            line = await source.readuntil(CRLF)
+            activity.touch()
+            count = _chunk_size(line)
     except IncompleteReadError as e:
         raise HTTPParsingException(e) from e
-    return headers_bytes.split(CRLF, maxsplit=1)
+    line += await _read_trailers(source) + CRLF
+    target.write(line)
+    await target.drain()
+    return total + len(line)
+
+
+async def _relay_until_eof(source: StreamReader, target: StreamWriter,
+                           buffer_size: int, activity: Activity) -> int:
+    total = 0
+    while data := await source.read(buffer_size):
+        target.write(data)
+        total += len(data)
+        activity.touch()
+        await target.drain()
+        activity.touch()
+    return total
+
+
+async def _read_head(source: StreamReader,
+                     parser: HTTPHeadParser,
+                     activity: Optional[Activity] = None,
+                     timeout: Optional[float] = None) -> HTTPHeadParser:
+    """
+    Reads the start line and the header section into the parser.
+    Reads stop at the end of the head, so the content and the next message
+    stay in the stream. A head whose start line ends with CRLF is read
+    in one piece up to its empty line, a head with bare LF line endings
+    is read line by line.
+    :param activity: activity in the idle phase, it is switched
+                     to the header phase of timeout seconds
+                     when the first byte arrives
+    :raise EndOfStream if the stream ends before the first byte
+    :raise HTTPParsingException
+    """
+    first = b''
+    if activity is not None:
+        try:
+            first = await source.readexactly(1)
+        except IncompleteReadError as e:
+            raise EndOfStream(e) from e
+        activity.expect(timeout, 'header')
+    try:
+        line = first + await source.readuntil(b'\n')
+        # Empty lines before the start line are ignored.
+        while line in (CRLF, b'\n'):
+            line = await source.readuntil(b'\n')
+        if line.endswith(CRLF):
+            # The empty line is either the next one or after a field line.
+            rest = await source.readexactly(2)
+            if rest != CRLF and rest[:1] != b'\n':
+                rest += await source.readuntil(b'\n' + CRLF)
+            data = line + rest
+        else:
+            data = await _read_lines(source, line, parser.max_size)
+    except IncompleteReadError as e:
+        if not e.partial and not first:
+            raise EndOfStream(e) from e
+        raise HTTPParsingException(e) from e
+    except LimitOverrunError as e:
+        raise HTTPParsingException(
+            f'Head is larger than the stream limit: {e}') from e
+    if parser.feed(data) != len(data) or not parser.done:
+        raise HTTPParsingException('Head ends with a bare LF '
+                                   'after lines ending with CRLF')
+    return parser
+
+
+async def _read_lines(source: StreamReader, line: bytes,
+                      max_size: int) -> bytes:
+    """
+    :param line: the start line
+    :return: the head up to its empty line
+    """
+    lines = [line]
+    size = len(line)
+    while line not in (CRLF, b'\n'):
+        line = await source.readuntil(b'\n')
+        lines.append(line)
+        size += len(line)
+        if size > max_size:
+            raise HTTPParsingException(
+                f'Head is larger than {max_size} bytes')
+    return b''.join(lines)
 
 
 @dataclass
 class HTTPProperty(ABC):
-    headers: Dict[str, str] = field(default_factory=dict)
+    headers: MutableMapping[str, str] = field(default_factory=dict)
+    raw_content: bytes = field(default=b'', repr=False)
+    _content: Optional[bytes] = field(default=None, init=False,
+                                      repr=False, compare=False)
+    _content_changed: bool = field(default=False, init=False,
+                                   repr=False, compare=False)
+    # The head as it was received with its start line and headers.
+    _received: Optional[tuple[bytes, tuple[str, str, str], Headers]] = \
+        field(default=None, init=False, repr=False, compare=False)
+
+    @property
+    def content(self) -> bytes:
+        """
+        Content decoded according to content-encoding.
+        It is decoded from raw_content on first access.
+        """
+        if self._content is None:
+            self._content = self._decompress_content()
+        return self._content
+
+    @content.setter
+    def content(self, value: bytes):
+        self._content = value
+        self._content_changed = True
 
     @property
     def type(self) -> Optional[str]:
@@ -60,31 +472,83 @@ class HTTPProperty(ABC):
     def length(self, value: int):
         self.headers['content-length'] = str(value)
 
-    async def _read_content(self, source: StreamReader):
+    @property
+    def chunked(self) -> bool:
+        return 'chunked' in self.headers.get('transfer-encoding', '').lower()
+
+    @property
+    def keep_alive(self) -> bool:
+        connection = self.headers.get('connection', '').lower()
+        if self.proto == 'HTTP/1.0':
+            return 'keep-alive' in connection
+        return 'close' not in connection
+
+    @property
+    def _content_until_eof(self) -> bool:
+        return False
+
+    @property
+    def framed(self) -> bool:
+        """
+        :return: True if the end of content is known without closing
+                 the connection
+        """
+        return self.chunked or 'content-length' in self.headers
+
+    async def read_content(self, source: StreamReader):
+        """
+        Reads the whole content into memory.
+        :raise HTTPParsingException
+        """
         if 'transfer-encoding' in self.headers:
-            self.content = await _read_chunked_content(source)
+            self.raw_content = await _read_chunked_content(source)
+            self.headers.update(_parse_headers(await _read_trailers(source)))
             if 'trailer' in self.headers:
-                foot_headers_count = len(self.headers['trailer'].split(','))
-                foot = b''
-                for i in range(foot_headers_count):
-                    foot += await source.readuntil(CRLF)
-                self.headers.update(_parse_headers(foot))
                 del self.headers['trailer']
-            self.headers['content-length'] = f'{len(self.content)}'
+            self.headers['content-length'] = f'{len(self.raw_content)}'
             del self.headers['transfer-encoding']
         else:
             if 'content-length' in self.headers:
-                self.content = await source.readexactly(int(self.length))
-        self._decompress_content()
+                try:
+                    self.raw_content = await source.readexactly(
+                        int(self.length))
+                except IncompleteReadError as e:
+                    raise HTTPParsingException(e) from e
+            elif self._content_until_eof:
+                self.raw_content = await source.read()
+        self._content = None
+        self._content_changed = False
 
-    def _decompress_content(self):
+    async def stream_content(self, source: StreamReader, target: StreamWriter,
+                             buffer_size: int,
+                             activity: Optional[Activity] = None) -> int:
+        """
+        Relays the content from source to target by chunks of buffer_size
+        without keeping it. Chunked framing is passed as is.
+        :param activity: touched by every read and write
+        :raise HTTPParsingException
+        :return: count of relayed bytes with the chunked framing
+        """
+        activity = activity or Activity()
+        if self.chunked:
+            return await _relay_chunked_content(source, target, buffer_size,
+                                                activity)
+        elif 'content-length' in self.headers:
+            return await _relay_content(source, target, int(self.length),
+                                        buffer_size, activity)
+        elif self._content_until_eof:
+            return await _relay_until_eof(source, target, buffer_size,
+                                          activity)
+        return 0
+
+    def _decompress_content(self) -> bytes:
         if 'content-encoding' in self.headers:
             encode = self.headers['content-encoding']
             if 'gzip' == encode:
-                self.content = zlib.decompress(self.content,
-                                               16 + zlib.MAX_WBITS)
+                return zlib.decompress(self.raw_content, 16 + zlib.MAX_WBITS)
             elif 'br' == encode:
-                self.content = brotli.decompress(self.content)
+                return brotli.decompress(self.raw_content)
+        return self.raw_content
 
     def _compress_content(self) -> bytes:
         if 'content-encoding' in self.headers:
@@ -95,19 +559,57 @@ class HTTPProperty(ABC):
                 return brotli.compress(self.content)
         return self.content
 
-    def _to_bytes(self, first: str, second: str, third: str) -> bytes:
-        if not all((first, second, third)):
+    def _receive_head(self, parser: HTTPHeadParser):
+        self.headers = parser.headers
+        # A head with bare LF line ends is not forwarded as is.
+        if parser.head.count(b'\n') == parser.head.count(CRLF):
+            self._received = (parser.head, parser.start_line, parser.headers)
+
+    def _head_to_bytes(self, first: str, second: str,
+                       third: Optional[str]) -> bytes:
+        """
+        :param third: the protocol of a request or the reason phrase
+                      of a response, it may be empty
+        :return: the received head if the start line and the headers
+                 were not changed, a new one otherwise,
+                 empty if the start line is incomplete
+        """
+        if self._received is not None:
+            head, start_line, headers = self._received
+            if start_line == (first, second, third) \
+                    and self.headers is headers and not headers.modified:
+                return head
+        if not (first and second):
             return b''
-        bytes_list = [
-            f'{first} {second} {third}'.strip().encode(),
-            *(
-                f'{name}: {value}'.encode()
-                for name, value in self.headers.items()
-            ),
-            b'',
-            self._compress_content()
-        ]
-        return b'\r\n'.join(bytes_list)
+        headers = self.headers if isinstance(self.headers, Headers) \
+            else Headers(self.headers)
+        return b''.join((f'{first} {second} {third or ""}'.encode(), CRLF,
+                         bytes(headers), CRLF))
+
+    def _encoded_content(self) -> bytes:
+        """
+        :return: content as it is sent. The content is encoded again
+                 only if it was changed after reading.
+        """
+        if self._content_changed:
+            self.raw_content = self._compress_content()
+            self._content_changed = False
+            if 'content-length' in self.headers:
+                self.length = len(self.raw_content)
+        return self.raw_content
+
+    def _to_buffers(self, first: str, second: str,
+                    third: Optional[str]) -> list[bytes]:
+        if not (first and second):
+            return []
+        # Encoding the content may change content-length of the head.
+        content = self._encoded_content()
+        head = self._head_to_bytes(first, second, third)
+        return [head, content] if content else [head]
+
+    def _to_bytes(self, first: str, second: str,
+                  third: Optional[str]) -> bytes:
+        return b''.join(self._to_buffers(first, second, third))
 
 
 @dataclass
@@ -117,18 +619,24 @@ class HTTPRequest(HTTPProperty):
     proto: str = None
     host: str = None
     port: int = None
-    headers: Dict[str, str] = field(default_factory=dict)
-    content: bytes = field(default_factory=(lambda: b''))
-
-    async def from_stream(self, source: StreamReader) -> 'HTTPRequest':
-        line, headers_bytes = await _read_first_line_and_headers(source)
-        (self.method,
-         self.path,
-         self.proto) = [data.decode() for data in line.split(b' ', maxsplit=2)]
-        self.headers = _parse_headers(headers_bytes)
+    headers: MutableMapping[str, str] = field(default_factory=dict)
+
+    async def from_stream(self, source: StreamReader,
+                          read_content: bool = True,
+                          activity: Optional[Activity] = None,
+                          timeout: Optional[float] = None) -> 'HTTPRequest':
+        """
+        :param activity: activity of the idle phase
+                         between requests, see _read_head
+        :param timeout: seconds to receive the head after its first byte
+        """
+        parser = await _read_head(source, HTTPHeadParser(), activity, timeout)
+        self.method, self.path, self.proto = parser.start_line
+        self._receive_head(parser)
         self._extract_host_port()
 
-        await self._read_content(source)
+        if read_content:
+            await self.read_content(source)
         return self
 
     def _extract_host_port(self):
@@ -146,6 +654,16 @@ class HTTPRequest(HTTPProperty):
             if header in self.headers.keys():
                 del self.headers[header]
 
+    def head_bytes(self) -> bytes:
+        return self._head_to_bytes(self.method, self.path, self.proto)
+
+    def to_buffers(self) -> list[bytes]:
+        """
+        :return: the head and the content for StreamWriter.writelines,
+                 the content is not copied into the head
+        """
+        return self._to_buffers(self.method, self.path, self.proto)
+
     def __bytes__(self) -> bytes:
         return self._to_bytes(self.method, self.path, self.proto)
 
@@ -155,21 +673,50 @@ class HTTPResponse(HTTPProperty):
     proto: str = None
     code: int = None
     message: str = None
-    headers: Dict[str, str] = field(default_factory=dict)
-    content: bytes = field(default_factory=(lambda: b''))
-
-    async def from_stream(self, source: StreamReader) -> 'HTTPResponse':
-        line, headers_bytes = await _read_first_line_and_headers(source)
-        (self.proto,
-         code,
-         self.message) = [v.decode() for v in line.split(b' ', maxsplit=2)]
-        self.code = int(code)
-        self.headers = _parse_headers(headers_bytes)
-        await self._read_content(source)
+    headers: MutableMapping[str, str] = field(default_factory=dict)
+
+    async def from_stream(self, source: StreamReader,
+                          read_content: bool = True) -> 'HTTPResponse':
+        parser = await _read_head(source, HTTPHeadParser())
+        self.proto, code, self.message = parser.start_line
+        try:
+            self.code = int(code)
+        except ValueError as e:
+            raise HTTPParsingException(f'Invalid status code: {code}') from e
+        self._receive_head(parser)
+        if read_content:
+            await self.read_content(source)
         return self
 
+    def _status(self) -> Optional[str]:
+        return None if self.code is None else str(self.code)
+
+    def head_bytes(self) -> bytes:
+        return self._head_to_bytes(self.proto, self._status(), self.message)
+
+    def to_buffers(self) -> list[bytes]:
+        """
+        :return: the head and the content for StreamWriter.writelines,
+                 the content is not copied into the head
+        """
+        return self._to_buffers(self.proto, self._status(), self.message)
+
+    @property
+    def bodiless(self) -> bool:
+        return self.code < 200 or self.code in (204, 304)
+
+    @property
+    def _content_until_eof(self) -> bool:
+        return not self.framed
+
+    def has_content(self, method: str) -> bool:
+        """
+        :param method: method of the request answered by the response
+        """
+        return method != 'HEAD' and not self.bodiless
+
     def __bytes__(self) -> bytes:
-        return self._to_bytes(self.proto, str(self.code), self.message)
+        return self._to_bytes(self.proto, self._status(), self.message)
 
 
 HTTPCode200 = HTTPResponse(
@@ -182,3 +729,16 @@ HTTPCode502 = HTTPResponse(
     code=502,
     message='Bad Gateway'
 )
+HTTPCode429 = HTTPResponse(
+    proto='HTTP/1.1',
+    code=429,
+    message='Too Many Requests',
+    headers={'Connection': 'close', 'Content-Length': '0'}
+)
+HTTPCode503 = HTTPResponse(
+    proto='HTTP/1.1',
+    code=503,
+    message='Service Unavailable',
+    headers={'Connection': 'close', 'Content-Length': '0',
+             'Retry-After': '1'}
+)
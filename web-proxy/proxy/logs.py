@@ -0,0 +1,118 @@
+import logging
+import os
+import random
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+from typing import Optional
+
+# Logger of the access log, a line per exchange.
+ACCESS_LOGGER = 'accessLog'
+
+_listener: Optional[QueueListener] = None
+_forked_hook = False
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Passes a random share of records up to the level,
+    records of higher levels always pass.
+    """
+
+    def __init__(self, rate: float, level: int = logging.INFO):
+        """
+        :param rate: share of passed records from 0 to 1
+        """
+        super().__init__()
+        if not 0 <= rate <= 1:
+            raise ValueError(f'Sampling rate out of [0, 1]: {rate}')
+        self.rate = rate
+        self.level = level
+        self.dropped = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > self.level or self.rate >= 1 \
+                or random.random() < self.rate:
+            return True
+        self.dropped += 1
+        return False
+
+
+def sample(logger: str, rate: float, level: int = logging.INFO):
+    """
+    Samples records of the logger up to the level, does nothing
+    if all of them pass.
+    """
+    if rate < 1:
+        logging.getLogger(logger).addFilter(SamplingFilter(rate, level))
+
+
+def format_fields(fields: dict[str, object]) -> str:
+    """
+    Formats the fields as key=value pairs separated by spaces (logfmt),
+    values with spaces, quotes or '=' are quoted, None is '-'.
+    """
+    pairs = []
+    for key, value in fields.items():
+        value = '-' if value is None else str(value)
+        if not value or any(c in value for c in ' "='):
+            value = '"' + value.replace('\\', '\\\\').replace('"', '\\"') \
+                    + '"'
+        pairs.append(f'{key}={value}')
+    return ' '.join(pairs)
+
+
+def start_queue_logging():
+    """
+    Moves the handlers of the root logger to a listener thread,
+    logging calls only put records to a queue, the thread formats
+    and writes them. A forked process starts its own listener.
+    """
+    global _listener, _forked_hook
+    if _listener is not None:
+        return
+    root = logging.getLogger()
+    handlers = root.handlers[:]
+    queue = SimpleQueue()
+    for handler in handlers:
+        root.removeHandler(handler)
+    root.addHandler(QueueHandler(queue))
+    _listener = QueueListener(queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    if not _forked_hook and hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=_restart_after_fork)
+        _forked_hook = True
+
+
+def _restart_after_fork():
+    """
+    The listener thread of the parent does not exist in the child,
+    records go to a new queue and thread.
+    """
+    global _listener
+    if _listener is None:
+        return
+    queue = SimpleQueue()
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, QueueHandler):
+            handler.queue = queue
+    _listener = QueueListener(queue, *_listener.handlers,
+                              respect_handler_level=True)
+    _listener.start()
+
+
+def stop_queue_logging():
+    """
+    Writes the queued records and gives the handlers back
+    to the root logger.
+    """
+    global _listener
+    if _listener is None:
+        return
+    listener, _listener = _listener, None
+    listener.stop()
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        if isinstance(handler, QueueHandler):
+            root.removeHandler(handler)
+    for handler in listener.handlers:
+        root.addHandler(handler)
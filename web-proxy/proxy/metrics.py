@@ -0,0 +1,273 @@
+import asyncio
+import logging
+import time
+from asyncio import StreamReader, StreamWriter
+from bisect import bisect_left
+from typing import Callable, Optional
+
+from proxy.errors import ConnectionException
+from proxy.httpparser import HTTPRequest, HTTPResponse
+
+# Upper bounds of latency buckets in seconds.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+TLS_PEERS = ('client', 'origin')
+TLS_RESULTS = ('ok', 'failed')
+
+_COUNTERS = (
+    ('connections', 'proxy_connections_total',
+     'Client connections served.'),
+    ('received_bytes', 'proxy_received_bytes_total',
+     'Bytes received from clients.'),
+    ('sent_bytes', 'proxy_sent_bytes_total',
+     'Bytes sent to clients.')
+)
+_GAUGES = (
+    ('active_connections', 'proxy_active_connections',
+     'Client connections being served.'),
+)
+_HISTOGRAMS = (
+    ('upstream_connect', 'proxy_upstream_connect_seconds',
+     'Time to open a new upstream connection.'),
+    ('first_byte', 'proxy_first_byte_seconds',
+     'Time from sending a request to the origin '
+     'to receiving the head of its response.')
+)
+
+
+class Histogram:
+    """
+    Counts of observed values by buckets preallocated for the bounds,
+    the last bucket has no upper bound.
+    """
+
+    def __init__(self, bounds: tuple[float, ...] = LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def export(self, name: str, stats: dict[str, float]):
+        """
+        Adds cumulative counts of the buckets to stats,
+        so counts of several processes can be summed.
+        """
+        total = 0
+        for bound, count in zip(self.bounds, self.counts):
+            total += count
+            stats[f'{name}_le_{bound}'] = total
+        total += self.counts[-1]
+        stats[f'{name}_le_+Inf'] = total
+        stats[f'{name}_sum'] = self.sum
+        stats[f'{name}_count'] = total
+
+
+class Metrics:
+    """
+    Counters and latency histograms updated by connections.
+    Recording a value only changes numbers of preallocated
+    attributes and lists, the text is built when metrics are scraped.
+    """
+
+    def __init__(self):
+        self.connections = 0
+        self.active_connections = 0
+        self.received_bytes = 0
+        self.sent_bytes = 0
+        self.responses: dict[int, int] = dict()
+        self.handshakes = {(peer, result): 0
+                           for peer in TLS_PEERS for result in TLS_RESULTS}
+        self.upstream_connect = Histogram()
+        self.first_byte = Histogram()
+
+    def request(self, size: int):
+        """
+        Counts a request forwarded from a client.
+        :param size: bytes of the head and the content
+        """
+        self.received_bytes += size
+
+    def response(self, code: int, size: int):
+        """
+        Counts a response sent to a client.
+        :param size: bytes of the head and the content
+        """
+        self.responses[code] = self.responses.get(code, 0) + 1
+        self.sent_bytes += size
+
+    def handshake(self, peer: str, ok: bool):
+        """
+        :param peer: 'client' or 'origin'
+        """
+        self.handshakes[peer, 'ok' if ok else 'failed'] += 1
+
+    def stats(self) -> dict[str, float]:
+        stats = {name: getattr(self, name)
+                 for name, _, _ in _COUNTERS + _GAUGES}
+        for code, count in sorted(self.responses.items()):
+            stats[f'responses_{code}'] = count
+        for (peer, result), count in self.handshakes.items():
+            stats[f'tls_{peer}_{result}'] = count
+        for name, _, _ in _HISTOGRAMS:
+            getattr(self, name).export(name, stats)
+        return stats
+
+
+class Timeline:
+    """
+    Monotonic timestamps of the stages a request passed, from the first
+    byte of its head to the end of its response. The first request
+    of a connection also passes the stages of opening the connection.
+    """
+    __slots__ = ('started', 'marks')
+
+    def __init__(self, started: Optional[float] = None):
+        """
+        :param started: monotonic time of the start, now if None
+        """
+        self.started = time.monotonic() if started is None else started
+        self.marks: list[tuple[str, float]] = []
+
+    def mark(self, stage: str):
+        """
+        Ends the stage now.
+        """
+        self.marks.append((stage, time.monotonic()))
+
+    @property
+    def elapsed(self) -> float:
+        """
+        :return: seconds from the start to the last stage
+        """
+        return self.marks[-1][1] - self.started if self.marks else 0.0
+
+    def durations(self) -> list[tuple[str, float]]:
+        """
+        :return: seconds of each stage since the end of the previous one
+        """
+        durations = []
+        previous = self.started
+        for stage, at in self.marks:
+            durations.append((stage, at - previous))
+            previous = at
+        return durations
+
+    def __str__(self) -> str:
+        return ' '.join(f'{stage}={duration * 1000:.1f}ms'
+                        for stage, duration in self.durations())
+
+
+def render(stats: dict[str, dict[str, float]]) -> str:
+    """
+    Formats statistics of the proxy in the Prometheus text format.
+    The 'metrics' component holds Metrics.stats(), numbers
+    of other components are exported as proxy_<component>_<name>.
+    """
+    lines = []
+    metrics = stats.get('metrics', dict())
+    for kind, definitions in (('counter', _COUNTERS), ('gauge', _GAUGES)):
+        for key, name, description in definitions:
+            if key in metrics:
+                lines += [f'# HELP {name} {description}',
+                          f'# TYPE {name} {kind}',
+                          f'{name} {metrics[key]}']
+    lines += ['# HELP proxy_responses_total Responses sent to clients.',
+              '# TYPE proxy_responses_total counter']
+    for key, value in metrics.items():
+        if key.startswith('responses_'):
+            code = key.removeprefix('responses_')
+            lines.append(f'proxy_responses_total{{code="{code}"}} {value}')
+    lines += ['# HELP proxy_tls_handshakes_total TLS handshakes '
+              'with clients and origins.',
+              '# TYPE proxy_tls_handshakes_total counter']
+    for peer in TLS_PEERS:
+        for result in TLS_RESULTS:
+            value = metrics.get(f'tls_{peer}_{result}', 0)
+            lines.append(f'proxy_tls_handshakes_total'
+                         f'{{peer="{peer}",result="{result}"}} {value}')
+    for key, name, description in _HISTOGRAMS:
+        lines += [f'# HELP {name} {description}',
+                  f'# TYPE {name} histogram']
+        for bound in LATENCY_BUCKETS + ('+Inf',):
+            value = metrics.get(f'{key}_le_{bound}', 0)
+            lines.append(f'{name}_bucket{{le="{bound}"}} {value}')
+        lines += [f'{name}_sum {metrics.get(f"{key}_sum", 0.0)}',
+                  f'{name}_count {metrics.get(f"{key}_count", 0)}']
+    for component, values in stats.items():
+        if component == 'metrics':
+            continue
+        for key, value in values.items():
+            lines.append(f'proxy_{component}_{key} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsServer:
+    """
+    Serves statistics on GET /metrics of a separate port
+    in the Prometheus text format.
+    """
+    _logger = logging.getLogger('metricsServer')
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self, host: str, port: int,
+                 collect: Callable[[], dict[str, dict[str, float]]],
+                 timeout: float = 10.0):
+        """
+        :param collect: returns statistics of the proxy
+        :param timeout: seconds to receive a request
+        """
+        self._host = host
+        self._port = port
+        self._collect = collect
+        self._timeout = timeout
+        self._server: Optional[asyncio.Server] = None
+        self.scrapes = 0
+
+    async def start(self):
+        self._server = await asyncio.start_server(
+            client_connected_cb=self._handle, host=self._host,
+            port=self._port)
+        addrs = ', '.join(str(s.getsockname()) for s in self._server.sockets)
+        self._logger.info(f'Serving metrics on {addrs}')
+
+    async def _handle(self, reader: StreamReader, writer: StreamWriter):
+        try:
+            async with asyncio.timeout(self._timeout):
+                request = await HTTPRequest().from_stream(
+                    reader, read_content=False)
+            writer.write(bytes(self._respond(request)))
+            await writer.drain()
+        except (ConnectionException, ConnectionError, TimeoutError):
+            pass
+        finally:
+            writer.close()
+
+    def _respond(self, request: HTTPRequest) -> HTTPResponse:
+        if request.path.split('?')[0] != '/metrics':
+            return self._response(404, 'Not Found', b'Not Found\n')
+        if request.method not in ('GET', 'HEAD'):
+            return self._response(405, 'Method Not Allowed',
+                                  b'Method Not Allowed\n')
+        self.scrapes += 1
+        content = render(self._collect()).encode()
+        response = self._response(200, 'OK', content)
+        if request.method == 'HEAD':
+            response.raw_content = b''
+        return response
+
+    def _response(self, code: int, message: str,
+                  content: bytes) -> HTTPResponse:
+        return HTTPResponse(
+            proto='HTTP/1.1', code=code, message=message,
+            headers={'Content-Type': self.content_type,
+                     'Content-Length': str(len(content)),
+                     'Connection': 'close'},
+            raw_content=content)
+
+    async def close(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
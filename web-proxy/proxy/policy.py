@@ -0,0 +1,83 @@
+import fnmatch
+import ipaddress
+import re
+from typing import Iterable, Optional
+
+
+class InterceptPolicy:
+    """
+    Decides for every CONNECT whether the tunnel is intercepted (MITM)
+    or spliced as raw bytes.
+
+    Bypass rules are host patterns or networks:
+        bank.example.com   exact host
+        *.cdn.example.com  shell-style pattern
+        .example.org       the domain and all of its subdomains
+        10.0.0.0/8         network of the target address
+    Only tunnels to intercept_ports are intercepted if it is set.
+    """
+
+    def __init__(self,
+                 bypass_hosts: Iterable[str] = (),
+                 bypass_networks: Iterable[str] = (),
+                 intercept_ports: Optional[Iterable[int]] = None):
+        patterns = []
+        for host in bypass_hosts:
+            host = host.lower().rstrip('.')
+            if host.startswith('.'):
+                patterns.append(fnmatch.translate(host[1:]))
+                host = f'*{host}'
+            patterns.append(fnmatch.translate(host))
+        self._hosts = re.compile('|'.join(patterns)) if patterns else None
+        self._networks = [ipaddress.ip_network(network, strict=False)
+                          for network in bypass_networks]
+        self._ports = frozenset(intercept_ports) \
+            if intercept_ports is not None else None
+
+    @classmethod
+    def from_rules(cls, rules: Iterable[str],
+                   intercept_ports: Optional[Iterable[int]] = None
+                   ) -> 'InterceptPolicy':
+        """
+        :param rules: host patterns and networks mixed together
+        """
+        hosts, networks = [], []
+        for rule in rules:
+            try:
+                ipaddress.ip_network(rule, strict=False)
+                networks.append(rule)
+            except ValueError:
+                hosts.append(rule)
+        return cls(bypass_hosts=hosts, bypass_networks=networks,
+                   intercept_ports=intercept_ports)
+
+    @staticmethod
+    def read_rules(filename: str) -> list[str]:
+        """
+        Reads rules from a file, one per line. Text after # is ignored.
+        """
+        with open(filename) as f:
+            rules = [line.split('#', maxsplit=1)[0].strip() for line in f]
+        return [rule for rule in rules if rule]
+
+    def should_intercept(self, host: str, port: int,
+                         address: Optional[str] = None) -> bool:
+        """
+        :param host: host from the CONNECT request
+        :param port: port from the CONNECT request
+        :param address: resolved IP address of the target, if known
+        """
+        if self._ports is not None and port not in self._ports:
+            return False
+        host = host.lower().rstrip('.')
+        if self._hosts and self._hosts.match(host):
+            return False
+        if self._networks:
+            for value in (host, address):
+                try:
+                    ip = ipaddress.ip_address(value)
+                except ValueError:
+                    continue
+                if any(ip in network for network in self._networks):
+                    return False
+        return True
@@ -0,0 +1,199 @@
+import asyncio
+import logging
+import time
+from asyncio import StreamReader, StreamWriter
+from collections import deque
+from dataclasses import dataclass
+from typing import Optional
+
+from proxy.dns import Resolver
+from proxy.metrics import Metrics, Timeline
+from proxy.tuning import SocketOptions
+
+
+@dataclass
+class UpstreamConnection:
+    host: str
+    port: int
+    reader: StreamReader
+    writer: StreamWriter
+    released_at: float = 0.0
+
+    @property
+    def key(self) -> tuple[str, int]:
+        return self.host, self.port
+
+    def is_healthy(self) -> bool:
+        """
+        An idle connection is healthy while the origin has not closed it.
+        """
+        return not self.writer.is_closing() and not self.reader.at_eof()
+
+    def close(self):
+        self.writer.close()
+
+
+class UpstreamPool:
+    """
+    Keep-alive connections to origin servers shared by all clients.
+    Connections are kept per (host, port) and closed after idle_timeout.
+    At most max_active_per_host connections to an origin are handed out,
+    acquire waits until one is released.
+    """
+    _logger = logging.getLogger('upstreamPool')
+
+    def __init__(self, max_idle_per_host: int = 8,
+                 idle_timeout: float = 30.0,
+                 socket_options: Optional[SocketOptions] = None,
+                 metrics: Optional[Metrics] = None,
+                 resolver: Optional[Resolver] = None,
+                 max_active_per_host: int = 256):
+        """
+        :param max_active_per_host: most connections to a host in use
+                                    at once, 0 disables the limit
+        :param metrics: metrics new connections are timed in
+        :param resolver: resolver of origin hosts
+        """
+        self._max_idle_per_host = max_idle_per_host
+        self._socket_options = socket_options or SocketOptions()
+        self._idle_timeout = idle_timeout
+        self._metrics = metrics or Metrics()
+        self._resolver = resolver or Resolver()
+        self._idle: dict[tuple[str, int], deque[UpstreamConnection]] = dict()
+        self._max_active_per_host = max_active_per_host
+        # Connections in use or waited for per host, and their limits.
+        self._active: dict[tuple[str, int], int] = dict()
+        self._limits: dict[tuple[str, int], asyncio.Semaphore] = dict()
+        self._reaper: Optional[asyncio.Task] = None
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.waited = 0
+
+    async def acquire(self, host: str, port: int,
+                      timeline: Optional[Timeline] = None) \
+            -> UpstreamConnection:
+        """
+        Waits while max_active_per_host connections to the host are in use.
+        The connection is handed back with release.
+        :param timeline: stages of the request, marked if the connection
+                         is opened
+        """
+        key = (host, port)
+        await self._take(key)
+        try:
+            connection = self._pop_idle(key)
+            if connection:
+                self.hits += 1
+                return connection
+            self.misses += 1
+            started = time.monotonic()
+            reader, writer = await self._socket_options.open_connection(
+                host=host,
+                port=port,
+                resolver=self._resolver,
+                timeline=timeline
+            )
+        except BaseException:
+            self._give_back(key)
+            raise
+        self._metrics.upstream_connect.observe(time.monotonic() - started)
+        return UpstreamConnection(host=host, port=port,
+                                  reader=reader, writer=writer)
+
+    async def _take(self, key: tuple[str, int]):
+        if self._max_active_per_host <= 0:
+            return
+        limit = self._limits.get(key)
+        if limit is None:
+            limit = asyncio.Semaphore(self._max_active_per_host)
+            self._limits[key] = limit
+        if limit.locked():
+            self.waited += 1
+        self._active[key] = self._active.get(key, 0) + 1
+        try:
+            await limit.acquire()
+        except BaseException:
+            self._forget(key)
+            raise
+
+    def _give_back(self, key: tuple[str, int]):
+        if key in self._active:
+            self._limits[key].release()
+            self._forget(key)
+
+    def _forget(self, key: tuple[str, int]):
+        """
+        Drops the limit of a host no connection is waited for or in use.
+        """
+        self._active[key] -= 1
+        if not self._active[key]:
+            del self._active[key]
+            del self._limits[key]
+
+    def release(self, connection: UpstreamConnection,
+                reusable: bool = True):
+        self._give_back(connection.key)
+        idle = self._idle.setdefault(connection.key, deque())
+        if not reusable or not connection.is_healthy() \
+                or len(idle) >= self._max_idle_per_host:
+            connection.close()
+            return
+        connection.released_at = asyncio.get_running_loop().time()
+        idle.append(connection)
+        if self._reaper is None or self._reaper.done():
+            self._reaper = asyncio.create_task(self._evict_idle())
+
+    def _pop_idle(self, key: tuple[str, int]) -> Optional[UpstreamConnection]:
+        idle = self._idle.get(key)
+        now = asyncio.get_running_loop().time()
+        while idle:
+            connection = idle.pop()
+            if now - connection.released_at < self._idle_timeout \
+                    and connection.is_healthy():
+                return connection
+            self.evicted += 1
+            connection.close()
+        return None
+
+    def _evict_expired(self):
+        now = asyncio.get_running_loop().time()
+        for key in list(self._idle):
+            idle = self._idle[key]
+            while idle and (
+                    now - idle[0].released_at >= self._idle_timeout
+                    or not idle[0].is_healthy()):
+                self.evicted += 1
+                idle.popleft().close()
+            if not idle:
+                del self._idle[key]
+
+    async def _evict_idle(self):
+        while self._idle:
+            await asyncio.sleep(self._idle_timeout / 2)
+            self._evict_expired()
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'idle': sum(len(idle) for idle in self._idle.values()),
+            'active': sum(self._active.values()),
+            'waited': self.waited,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evicted': self.evicted
+        }
+
+    async def close(self):
+        if self._reaper:
+            self._reaper.cancel()
+        connections = [connection for idle in self._idle.values()
+                       for connection in idle]
+        self._idle.clear()
+        for connection in connections:
+            connection.close()
+        await asyncio.gather(
+            *[connection.writer.wait_closed() for connection in connections],
+            return_exceptions=True
+        )
+        self._logger.info(
+            f'Upstream pool closed (connections={len(connections)}).')
@@ -0,0 +1,94 @@
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from types import FrameType
+from typing import Optional
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of a running thread from a background thread,
+    the profiled code is not instrumented and runs as usual.
+    The profile is written as collapsed stacks: a line per distinct
+    stack, frames from the outermost separated by ';' and the count
+    of samples, as read by flamegraph.pl and speedscope.
+    """
+    _logger = logging.getLogger('samplingProfiler')
+
+    def __init__(self, dirname: str = './profiles', duration: float = 10.0,
+                 interval: float = 0.005):
+        """
+        :param dirname: directory of written profiles
+        :param duration: seconds a profile is sampled
+        :param interval: seconds between samples
+        """
+        self._dirname = dirname
+        self._duration = duration
+        self._interval = interval
+        self._thread: Optional[threading.Thread] = None
+        self.profiles = 0
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, duration: Optional[float] = None) -> bool:
+        """
+        Starts sampling the calling thread for duration seconds,
+        the profile is written when sampling ends.
+        :return: False if a profile is being sampled already
+        """
+        if self.running:
+            self._logger.warning('A profile is being sampled already.')
+            return False
+        self._thread = threading.Thread(
+            target=self._run, name='samplingProfiler', daemon=True,
+            args=(threading.current_thread(), duration or self._duration))
+        self._thread.start()
+        return True
+
+    def _run(self, thread: threading.Thread, duration: float):
+        self._logger.info(f'Sampling a profile for {duration} s.')
+        samples = Counter()
+        deadline = time.monotonic() + duration
+        # The identifier of an ended thread may be given to a new one.
+        while thread.is_alive() and time.monotonic() < deadline:
+            frame = sys._current_frames().get(thread.ident)
+            if frame is None:
+                break
+            samples[self._stack(frame)] += 1
+            del frame
+            time.sleep(self._interval)
+        try:
+            filename = self._write(samples)
+        except OSError as e:
+            self._logger.warning(f'Profile is not written: {e}')
+            return
+        self.profiles += 1
+        self._logger.info(
+            f'Profile of {sum(samples.values())} samples '
+            f'written to {filename}')
+
+    @staticmethod
+    def _stack(frame: FrameType) -> str:
+        frames = []
+        while frame is not None:
+            code = frame.f_code
+            frames.append(f'{code.co_name} '
+                          f'({os.path.basename(code.co_filename)}:'
+                          f'{code.co_firstlineno})')
+            frame = frame.f_back
+        return ';'.join(reversed(frames))
+
+    def _write(self, samples: Counter) -> str:
+        os.makedirs(self._dirname, exist_ok=True)
+        filename = os.path.join(
+            self._dirname,
+            f'profile-{os.getpid()}-{time.strftime("%Y%m%d-%H%M%S")}.txt')
+        with open(filename, 'w') as f:
+            for stack, count in samples.most_common():
+                f.write(f'{stack} {count}\n')
+        return filename
@@ -1,12 +1,28 @@
 import asyncio
 import logging
+import signal
 import sys
 import traceback
 from asyncio import StreamReader, StreamWriter
+from typing import Optional
 
+from common.filemanager import FileNotExist
 from features.collector import PasswordCollector
+from proxy.admission import AdmissionControl
+from proxy.cache import HTTPCache
+from proxy.coalescing import RequestCoalescer
+from proxy.dns import Resolver
 from proxy.connection import ProxyConnection
 from proxy.errors import ConnectionException
+from proxy.httpparser import HTTPCode429, HTTPCode503
+from proxy.metrics import Metrics, MetricsServer
+from proxy.policy import InterceptPolicy
+from proxy.profiler import SamplingProfiler
+from proxy.pool import UpstreamPool
+from proxy.tls import ClientSSLContext
+from proxy.timeouts import Timeouts
+from proxy.tuning import SocketOptions
+from sslcert.sslcreator import CertificateCreator
 
 
 class ProxyServer:
@@ -14,22 +30,137 @@ class ProxyServer:
                  host: str,
                  port: int,
                  buffer_size: int,
-                 users: int = 100):
+                 users: int = 100,
+                 pool_size: int = 8,
+                 pool_idle_timeout: float = 30.0,
+                 pool_active: int = 256,
+                 policy: Optional[InterceptPolicy] = None,
+                 tunnel_buffer_size: int = 65536,
+                 tunnel_idle_timeout: Optional[float] = 600.0,
+                 cert_cache_size: int = 1024,
+                 cert_cache_ttl: float = 3600.0,
+                 cert_workers: int = 2,
+                 spare_keys: int = 0,
+                 cert_key: str = 'ecdsa',
+                 upstream_cafile: Optional[str] = None,
+                 cache_size: int = 64 * 2 ** 20,
+                 cache_object_size: int = 2 ** 20,
+                 cache_dir: Optional[str] = None,
+                 cache_disk_size: int = 2 ** 30,
+                 coalesce_size: int = 8 * 2 ** 20,
+                 cert_gc_interval: Optional[float] = 3600.0,
+                 reuse_port: bool = False,
+                 password_collector: Optional[PasswordCollector] = None,
+                 socket_options: Optional[SocketOptions] = None,
+                 timeouts: Optional[Timeouts] = None,
+                 max_connections: int = 1024,
+                 max_queue: int = 256,
+                 queue_timeout: float = 5.0,
+                 per_client_connections: int = 128,
+                 metrics_host: str = '127.0.0.1',
+                 metrics_port: Optional[int] = None,
+                 slow_request: Optional[float] = None,
+                 profile_dir: str = './profiles',
+                 profile_duration: float = 10.0,
+                 resolver: Optional[Resolver] = None):
+        """
+        :param tunnel_idle_timeout: seconds a tunnel or an upgraded
+                                    connection is kept without data,
+                                    None disables the timeout
+        :param cert_gc_interval: seconds between garbage collections
+                                 of the certificate store, None disables them
+        :param reuse_port: bind with SO_REUSEPORT, so worker processes
+                           listen on the same port
+        :param password_collector: collector of credentials, a new one
+                                   writing passwords.jsonl if None
+        :param socket_options: options of client and upstream sockets
+        :param timeouts: timeouts of client and upstream connections
+        :param max_connections: most client connections served at once,
+                                0 disables the cap
+        :param max_queue: most connections waiting for a slot
+        :param queue_timeout: seconds a connection waits for a slot
+        :param per_client_connections: most connections of a client
+                                       address, 0 disables the limit
+        :param metrics_port: port of the metrics endpoint,
+                             None disables it
+        :param slow_request: seconds of a request after which its stages
+                             are logged, None disables the log
+        :param profile_dir: directory of profiles sampled on SIGUSR1
+        :param profile_duration: seconds a profile is sampled
+        :param resolver: resolver of origin hosts, a new one with
+                         the default cache if None
+        """
         self._host = host
         self._port = port
         self._users = users
         self._buffer_size = buffer_size
+        self._policy = policy
+        self._tunnel_buffer_size = tunnel_buffer_size
+        self._tunnel_idle_timeout = tunnel_idle_timeout
         self._logger = logging.getLogger('proxyServer')
         self._server = None
         self._set_clients: set[ProxyConnection] = set()
-        self._password_collector = PasswordCollector()
+        self._reuse_port = reuse_port
+        self._socket_options = socket_options or SocketOptions()
+        self._timeouts = timeouts or Timeouts()
+        self._slow_request = slow_request
+        self._profiler = SamplingProfiler(dirname=profile_dir,
+                                          duration=profile_duration)
+        self._admission = AdmissionControl(max_connections=max_connections,
+                                           max_queue=max_queue,
+                                           queue_timeout=queue_timeout,
+                                           per_client=per_client_connections)
+        self._metrics = Metrics()
+        self._resolver = resolver or Resolver()
+        self._metrics_server = MetricsServer(
+            host=metrics_host, port=metrics_port, collect=self.stats) \
+            if metrics_port is not None else None
+        self._password_collector = password_collector or PasswordCollector()
+        self._cert_creator = self._create_cert_creator(
+            context_cache_size=cert_cache_size,
+            context_ttl=cert_cache_ttl,
+            workers=cert_workers,
+            spare_keys=spare_keys,
+            gc_interval=cert_gc_interval,
+            key_algorithm=cert_key)
+        self._client_context = ClientSSLContext(cafile=upstream_cafile)
+        self._cache = HTTPCache(max_size=cache_size,
+                                max_object_size=cache_object_size,
+                                disk_dir=cache_dir,
+                                disk_max_size=cache_disk_size) \
+            if cache_size > 0 else None
+        self._coalescer = RequestCoalescer(max_size=coalesce_size) \
+            if coalesce_size > 0 else None
+        self._upstream_pool = UpstreamPool(max_idle_per_host=pool_size,
+                                           idle_timeout=pool_idle_timeout,
+                                           socket_options=self._socket_options,
+                                           metrics=self._metrics,
+                                           resolver=self._resolver,
+                                           max_active_per_host=pool_active)
+
+    def _create_cert_creator(self, **kwargs) -> Optional[CertificateCreator]:
+        try:
+            return CertificateCreator(**kwargs)
+        except FileNotExist as e:
+            self._logger.warning(
+                f'{e.message} HTTPS interception is disabled.')
+            return None
 
     async def run(self):
+        if self._cert_creator:
+            self._cert_creator.start()
+        if self._metrics_server:
+            await self._metrics_server.start()
+        if hasattr(signal, 'SIGUSR1'):
+            asyncio.get_running_loop().add_signal_handler(
+                signal.SIGUSR1, self._profiler.start)
         self._server = await asyncio.start_server(
             client_connected_cb=self._handle_client,
             host=self._host,
             port=self._port,
-            backlog=self._users)
+            backlog=self._users,
+            reuse_port=self._reuse_port,
+            limit=self._socket_options.stream_limit)
 
         addrs = ', '.join(str(s.getsockname()) for s in self._server.sockets)
         self._logger.info(f'Serving on {addrs}')
@@ -50,14 +181,44 @@ class ProxyServer:
             raise
 
     async def _handle_client(self, reader: StreamReader, writer: StreamWriter):
+        self._socket_options.apply_to(writer)
+        peer = writer.get_extra_info('peername')
+        client = peer[0] if peer else ''
+        limited = self._admission.limited(client)
+        if not await self._admission.admit(client):
+            self._logger.debug(f'Connection of {client} is shed.')
+            writer.write(bytes(HTTPCode429 if limited else HTTPCode503))
+            writer.close()
+            return
+        try:
+            await self._serve_client(reader, writer)
+        finally:
+            self._admission.release(client)
+
+    async def _serve_client(self, reader: StreamReader, writer: StreamWriter):
         connection = ProxyConnection(
             client_reader=reader,
             client_writer=writer,
             buffer_size=self._buffer_size,
             close_hook=self._set_clients.remove,
-            password_collector=self._password_collector
+            password_collector=self._password_collector,
+            upstream_pool=self._upstream_pool,
+            policy=self._policy,
+            tunnel_buffer_size=self._tunnel_buffer_size,
+            tunnel_idle_timeout=self._tunnel_idle_timeout,
+            cert_creator=self._cert_creator,
+            client_context=self._client_context,
+            cache=self._cache,
+            coalescer=self._coalescer,
+            socket_options=self._socket_options,
+            timeouts=self._timeouts,
+            metrics=self._metrics,
+            slow_request=self._slow_request,
+            resolver=self._resolver
         )
         self._set_clients.add(connection)
+        self._metrics.connections += 1
+        self._metrics.active_connections += 1
         try:
             await connection.run()
         except ConnectionException as e:
@@ -68,12 +229,34 @@ class ProxyServer:
                 f'({connection.id}) Exception was occurred ({t})\n'
                 f'{repr(traceback.format_exception(v))}')
         finally:
+            self._metrics.active_connections -= 1
             await connection.close()
 
+    def stats(self) -> dict[str, dict[str, int]]:
+        stats = {
+            'metrics': self._metrics.stats(),
+            'admission': self._admission.stats(),
+            'dns': self._resolver.stats(),
+            'upstream_pool': self._upstream_pool.stats(),
+            'upstream_tls': self._client_context.stats()
+        }
+        if self._cert_creator:
+            stats['certificates'] = self._cert_creator.stats()
+        if self._cache:
+            stats['cache'] = self._cache.stats()
+        if self._coalescer:
+            stats['coalescing'] = self._coalescer.stats()
+        stats['credentials'] = self._password_collector.stats()
+        return stats
+
     async def close(self):
         if self._server:
             self._server.close()
             await self._server.wait_closed()
+        if self._metrics_server:
+            await self._metrics_server.close()
+        if hasattr(signal, 'SIGUSR1'):
+            asyncio.get_running_loop().remove_signal_handler(signal.SIGUSR1)
         self._logger.info(f'The server is disabled.')
         self._logger.info(
             f'Closing clients\' connections (num={len(self._set_clients)}).')
@@ -81,3 +264,8 @@ class ProxyServer:
               *[client.close() for client in self._set_clients]
         )
         self._logger.info('All clients\' connections closed.')
+        self._logger.info(f'Statistics: {self.stats()}')
+        await self._upstream_pool.close()
+        if self._cert_creator:
+            await self._cert_creator.close()
+        await asyncio.to_thread(self._password_collector.close)
@@ -0,0 +1,109 @@
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from proxy.errors import ConnectionTimeout
+
+
+@dataclass
+class Timeouts:
+    """
+    Seconds the proxy waits for a peer, None waits forever.
+    """
+    # The head of a request since its first byte, or since the client
+    # connected for the first request.
+    header: Optional[float] = 10.0
+    # Between reads or writes of a content.
+    body: Optional[float] = 30.0
+    # A kept-alive client connection without a new request.
+    idle: Optional[float] = 60.0
+    # Opening an upstream connection and TLS handshakes.
+    connect: Optional[float] = 10.0
+    # The head of a response since its request was sent.
+    response: Optional[float] = 60.0
+
+
+class Activity:
+    """
+    Watchdog of a stream: cancels the watched tasks when no data passes
+    for `timeout` seconds. The timeout and its phase change as a message
+    goes from the head to the content. touch() and expect() only store
+    numbers, the timer is re-armed when it fires, so a busy stream
+    does not schedule a timer per read.
+    Used as an async context manager by the watched task, the expiry
+    is raised from it as ConnectionTimeout.
+    """
+
+    def __init__(self, timeout: Optional[float] = None, phase: str = 'idle'):
+        self.timeout = timeout
+        self.phase = phase
+        self.last = time.monotonic()
+        # When the phase started.
+        self.started = self.last
+        self.timed_out = False
+        self._tasks: set[asyncio.Task] = set()
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    def touch(self):
+        self.last = time.monotonic()
+
+    def expect(self, timeout: Optional[float], phase: str) -> 'Activity':
+        """
+        Starts a phase: the watched tasks are cancelled if no data passes
+        for timeout seconds from now.
+        """
+        self.timeout = timeout
+        self.phase = phase
+        self.last = self.started = time.monotonic()
+        if not timeout or not self._tasks:
+            return self
+        if self._timer is not None:
+            # An earlier timer re-arms itself when it fires, a later one
+            # is moved.
+            if self._timer.when() - asyncio.get_running_loop().time() \
+                    <= timeout:
+                return self
+            self._timer.cancel()
+        self._arm(timeout)
+        return self
+
+    def watch(self, task: asyncio.Task):
+        self._tasks.add(task)
+        if self.timeout and self._timer is None:
+            self._arm(self.last + self.timeout - time.monotonic())
+
+    def unwatch(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        if not self._tasks and self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _arm(self, delay: float):
+        self._timer = asyncio.get_running_loop().call_later(max(0.0, delay),
+                                                            self._check)
+
+    def _check(self):
+        self._timer = None
+        if not self.timeout or not self._tasks:
+            return
+        remaining = self.last + self.timeout - time.monotonic()
+        if remaining > 0:
+            self._arm(remaining)
+            return
+        self.timed_out = True
+        for task in self._tasks:
+            task.cancel()
+
+    async def __aenter__(self) -> 'Activity':
+        self.watch(asyncio.current_task())
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        task = asyncio.current_task()
+        self.unwatch(task)
+        # Other cancellations of the task are not converted.
+        if exc_type is asyncio.CancelledError and self.timed_out \
+                and task.uncancel() == 0:
+            raise ConnectionTimeout(
+                f'{self.phase} timeout ({self.timeout} s)') from exc
@@ -0,0 +1,83 @@
+import ssl
+import time
+from collections import OrderedDict
+from typing import Optional
+
+
+class ClientSSLContext(ssl.SSLContext):
+    """
+    Client context shared by all upstream TLS connections.
+    The last session of every origin host is kept and offered
+    on the next handshake, so repeat connections are resumed.
+    asyncio has no way to pass a session to start_tls,
+    so it is injected in wrap_bio.
+    """
+
+    def __new__(cls, cafile: Optional[str] = None, max_sessions: int = 1024):
+        return super().__new__(cls, ssl.PROTOCOL_TLS_CLIENT)
+
+    def __init__(self, cafile: Optional[str] = None, max_sessions: int = 1024):
+        """
+        :param cafile: CA certificates of origins, the system store if None
+        :param max_sessions: count of hosts whose sessions are kept
+        """
+        super().__init__()
+        if cafile:
+            self.load_verify_locations(cafile=cafile)
+        else:
+            self.load_default_certs(ssl.Purpose.SERVER_AUTH)
+        self._sessions: OrderedDict[str, ssl.SSLSession] = OrderedDict()
+        self._max_sessions = max_sessions
+        self.handshakes = 0
+        self.offered = 0
+        self.resumed = 0
+
+    def wrap_bio(self, incoming, outgoing, server_side=False,
+                 server_hostname=None, session=None):
+        if session is None and not server_side and server_hostname:
+            session = self._get_session(server_hostname)
+            if session is not None:
+                self.offered += 1
+        return super().wrap_bio(incoming, outgoing, server_side=server_side,
+                                server_hostname=server_hostname,
+                                session=session)
+
+    def _get_session(self, host: str) -> Optional[ssl.SSLSession]:
+        session = self._sessions.get(host)
+        if session is None:
+            return None
+        if session.time + session.timeout <= time.time():
+            del self._sessions[host]
+            return None
+        self._sessions.move_to_end(host)
+        return session
+
+    def handshake_done(self, host: str, ssl_object: ssl.SSLObject):
+        """
+        Counts the handshake and keeps its session.
+        """
+        self.handshakes += 1
+        if ssl_object.session_reused:
+            self.resumed += 1
+        self.save_session(host, ssl_object)
+
+    def save_session(self, host: str, ssl_object: Optional[ssl.SSLObject]):
+        """
+        TLS 1.3 tickets arrive after the handshake, so the session
+        is saved again when the connection is closed.
+        """
+        session = ssl_object.session if ssl_object else None
+        if session is None:
+            return
+        self._sessions[host] = session
+        self._sessions.move_to_end(host)
+        while len(self._sessions) > self._max_sessions:
+            self._sessions.popitem(last=False)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'sessions': len(self._sessions),
+            'handshakes': self.handshakes,
+            'offered': self.offered,
+            'resumed': self.resumed
+        }
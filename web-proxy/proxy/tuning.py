@@ -0,0 +1,103 @@
+import asyncio
+import logging
+import socket
+from asyncio import StreamReader, StreamWriter
+from dataclasses import dataclass
+from typing import Optional
+
+from proxy.dns import Resolver
+from proxy.metrics import Timeline
+
+EVENT_LOOPS = ('auto', 'asyncio', 'uvloop')
+# Default limit of asyncio streams.
+STREAM_LIMIT = 2 ** 16
+
+_logger = logging.getLogger('tuning')
+
+
+def install_event_loop(name: str = 'auto') -> str:
+    """
+    Sets the event loop policy used by asyncio.run.
+    uvloop is optional: 'auto' falls back to asyncio silently,
+    'uvloop' with a warning.
+    :return: name of the installed loop
+    """
+    if name not in EVENT_LOOPS:
+        raise ValueError(f'Unknown event loop: {name}')
+    if name == 'asyncio':
+        return name
+    try:
+        import uvloop
+    except ImportError:
+        if name == 'uvloop':
+            _logger.warning('uvloop is not installed, asyncio is used.')
+        return 'asyncio'
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return 'uvloop'
+
+
+@dataclass
+class SocketOptions:
+    """
+    Options applied to client and upstream TCP sockets.
+    None keeps the system default.
+    """
+    nodelay: bool = True
+    send_buffer: Optional[int] = None
+    receive_buffer: Optional[int] = None
+    keepalive_idle: Optional[int] = None
+    keepalive_interval: Optional[int] = None
+    keepalive_count: Optional[int] = None
+    stream_limit: int = STREAM_LIMIT
+
+    def apply(self, sock):
+        """
+        :param sock: socket or transport socket of asyncio or uvloop
+        """
+        if getattr(sock, 'family', None) not in (socket.AF_INET,
+                                                 socket.AF_INET6):
+            return
+        options = [(socket.IPPROTO_TCP, socket.TCP_NODELAY,
+                    int(self.nodelay))]
+        if self.send_buffer:
+            options.append((socket.SOL_SOCKET, socket.SO_SNDBUF,
+                            self.send_buffer))
+        if self.receive_buffer:
+            options.append((socket.SOL_SOCKET, socket.SO_RCVBUF,
+                            self.receive_buffer))
+        if self.keepalive_idle:
+            options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+            # The names differ between platforms, missing ones are skipped.
+            for name, value in (('TCP_KEEPIDLE', self.keepalive_idle),
+                                ('TCP_KEEPINTVL', self.keepalive_interval),
+                                ('TCP_KEEPCNT', self.keepalive_count)):
+                if value and hasattr(socket, name):
+                    options.append((socket.IPPROTO_TCP,
+                                    getattr(socket, name), value))
+        for level, option, value in options:
+            try:
+                sock.setsockopt(level, option, value)
+            except OSError as e:
+                _logger.debug(f'Socket option {option} is not set: {e}')
+
+    def apply_to(self, writer: StreamWriter):
+        self.apply(writer.get_extra_info('socket'))
+
+    async def open_connection(self, host: str, port: int,
+                              resolver: Optional[Resolver] = None,
+                              timeline: Optional[Timeline] = None,
+                              **kwargs) -> tuple[StreamReader, StreamWriter]:
+        """
+        asyncio.open_connection with the stream limit and the socket options.
+        :param resolver: resolves the host and connects to its addresses,
+                         asyncio does if None
+        :param timeline: stages of the request opening the connection,
+                         the resolver marks the 'dns' stage
+        """
+        if resolver is not None:
+            kwargs['sock'] = await resolver.connect(host, port, timeline)
+            host = port = None
+        reader, writer = await asyncio.open_connection(
+            host=host, port=port, limit=self.stream_limit, **kwargs)
+        self.apply_to(writer)
+        return reader, writer
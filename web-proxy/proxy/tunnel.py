@@ -0,0 +1,57 @@
+import asyncio
+from asyncio import StreamReader, StreamWriter
+from typing import Optional
+
+from proxy.errors import ConnectionTimeout
+from proxy.timeouts import Activity
+
+
+async def pipe(reader: StreamReader, writer: StreamWriter,
+               buffer_size: int, activity: Optional[Activity] = None) -> int:
+    """
+    Copies bytes from reader to writer until EOF or the timeout
+    of the activity without parsing them.
+    :return: count of copied bytes
+    """
+    activity = activity or Activity()
+    total = 0
+    try:
+        async with activity:
+            while data := await reader.read(buffer_size):
+                writer.write(data)
+                total += len(data)
+                activity.touch()
+                await writer.drain()
+    except ConnectionTimeout:
+        pass
+    if writer.can_write_eof() and not writer.is_closing():
+        writer.write_eof()
+    return total
+
+
+async def splice(client_reader: StreamReader, client_writer: StreamWriter,
+                 target_reader: StreamReader, target_writer: StreamWriter,
+                 buffer_size: int,
+                 activity: Optional[Activity] = None) -> tuple[int, int]:
+    """
+    Relays raw bytes in both directions until both sides close,
+    one of them fails or both are idle for activity.timeout.
+    :return: counts of bytes sent to the target and to the client
+    """
+    activity = activity or Activity()
+    upstream = asyncio.create_task(
+        pipe(client_reader, target_writer, buffer_size, activity))
+    downstream = asyncio.create_task(
+        pipe(target_reader, client_writer, buffer_size, activity))
+    try:
+        await asyncio.wait({upstream, downstream},
+                           return_when=asyncio.FIRST_EXCEPTION)
+    finally:
+        upstream.cancel()
+        downstream.cancel()
+        results = await asyncio.gather(upstream, downstream,
+                                       return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+    return results[0], results[1]
@@ -0,0 +1,259 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+from multiprocessing.connection import wait
+from multiprocessing.process import BaseProcess
+from typing import Optional
+
+from features.collector import PasswordCollector, SharedPasswordCollector, \
+    UserData
+from proxy.errors import ProxyOpenError
+from proxy.logs import stop_queue_logging
+from proxy.metrics import MetricsServer
+from proxy.server import ProxyServer
+
+
+def run_worker(slot: int, credentials, reports, report_interval: float,
+               options: dict):
+    """
+    Entry point of a worker process.
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # The handler of the supervisor is not inherited,
+    # the server handles SIGUSR1 once it runs.
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    try:
+        asyncio.run(_serve(slot, credentials, reports, report_interval,
+                           options))
+    finally:
+        # Writes records queued by the worker before it exits.
+        stop_queue_logging()
+
+
+async def _serve(slot: int, credentials, reports, report_interval: float,
+                 options: dict):
+    # One worker collects garbage of the shared certificate store.
+    if slot != 0:
+        options = dict(options, cert_gc_interval=None)
+    server = ProxyServer(reuse_port=True,
+                         password_collector=SharedPasswordCollector(
+                             credentials),
+                         **options)
+    running = asyncio.create_task(server.run())
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, running.cancel)
+    reporter = asyncio.create_task(
+        _report(slot, server, reports, report_interval))
+    try:
+        await running
+    finally:
+        reporter.cancel()
+        await server.close()
+        reports.put((slot, server.stats()))
+
+
+async def _report(slot: int, server: ProxyServer, reports,
+                  report_interval: float):
+    while True:
+        await asyncio.sleep(report_interval)
+        reports.put((slot, server.stats()))
+
+
+class Supervisor:
+    """
+    Runs ProxyServer in worker processes listening on the same port
+    with SO_REUSEPORT, the kernel spreads connections between them.
+    Crashed workers are restarted.
+    Workers send credentials and their statistics through queues,
+    only the supervisor writes the passwords file and serves metrics,
+    which are as old as the last reports of the workers.
+    """
+    _logger = logging.getLogger('supervisor')
+
+    def __init__(self, workers: int, report_interval: float = 10.0,
+                 restart_delay: float = 1.0,
+                 metrics_host: str = '127.0.0.1',
+                 metrics_port: Optional[int] = None, **options):
+        """
+        :param workers: count of worker processes
+        :param report_interval: seconds between statistics reports
+        :param restart_delay: least seconds between starts of a worker,
+                              so a failing worker is not restarted in a loop
+        :param metrics_port: port of the metrics endpoint,
+                             None disables it
+        :param options: keyword arguments of ProxyServer
+        :raise ProxyOpenError
+        """
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            raise ProxyOpenError('SO_REUSEPORT is not supported.')
+        self._options = options
+        self._report_interval = report_interval
+        self._restart_delay = restart_delay
+        self._context = multiprocessing.get_context()
+        self._credentials = self._context.Queue()
+        self._reports = self._context.Queue()
+        self._processes: list[Optional[BaseProcess]] = [None] * workers
+        self._started_at = [0.0] * workers
+        self._stats: dict[int, dict[str, dict[str, int]]] = dict()
+        self._stopping = False
+        self._collector: Optional[PasswordCollector] = None
+        self._metrics_server = MetricsServer(
+            host=metrics_host, port=metrics_port, collect=self.stats) \
+            if metrics_port is not None else None
+        self._metrics_loop: Optional[asyncio.AbstractEventLoop] = None
+        self.restarts = 0
+
+    def run(self):
+        """
+        Runs the workers until SIGTERM or KeyboardInterrupt.
+        """
+        self._collector = PasswordCollector()
+        metrics = self._start_metrics()
+        readers = [
+            threading.Thread(target=self._collect_credentials,
+                             args=(self._collector,)),
+            threading.Thread(target=self._collect_reports)
+        ]
+        for reader in readers:
+            reader.start()
+        signal.signal(signal.SIGTERM, self._stop)
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, self._profile)
+        try:
+            for slot in range(len(self._processes)):
+                self._start(slot)
+            while not self._stopping:
+                self._watch(timeout=1.0)
+        except KeyboardInterrupt:
+            self._logger.warning(f'KeyboardInterrupt')
+        finally:
+            self._stopping = True
+            self._stop_workers()
+            self._credentials.put(None)
+            self._reports.put(None)
+            for reader in readers:
+                reader.join()
+            self._stop_metrics(metrics)
+            self._collector.close()
+            self._logger.info(f'Statistics: {self.stats()}')
+
+    def _start_metrics(self) -> Optional[threading.Thread]:
+        """
+        Serves metrics from an event loop of a separate thread.
+        """
+        if self._metrics_server is None:
+            return None
+        self._metrics_loop = asyncio.new_event_loop()
+        self._metrics_loop.run_until_complete(self._metrics_server.start())
+        thread = threading.Thread(target=self._metrics_loop.run_forever,
+                                  name='metrics')
+        thread.start()
+        return thread
+
+    def _stop_metrics(self, thread: Optional[threading.Thread]):
+        if thread is None:
+            return
+        self._metrics_loop.call_soon_threadsafe(self._metrics_loop.stop)
+        thread.join()
+        self._metrics_loop.run_until_complete(self._metrics_server.close())
+        self._metrics_loop.close()
+
+    def _stop(self, signum, frame):
+        self._stopping = True
+
+    def _profile(self, signum, frame):
+        """
+        Forwards SIGUSR1 to the workers, each one samples a profile.
+        """
+        for process in self._processes:
+            if process is not None and process.is_alive():
+                os.kill(process.pid, signum)
+
+    def _start(self, slot: int):
+        process = self._context.Process(
+            target=run_worker,
+            name=f'worker-{slot}',
+            args=(slot, self._credentials, self._reports,
+                  self._report_interval, self._options))
+        process.start()
+        self._processes[slot] = process
+        self._started_at[slot] = time.monotonic()
+        self._logger.info(f'Worker {slot} started (pid={process.pid}).')
+
+    def _watch(self, timeout: float):
+        """
+        Waits for exited workers and restarts them.
+        """
+        sentinels = {process.sentinel: slot
+                     for slot, process in enumerate(self._processes)
+                     if process is not None}
+        for sentinel in wait(list(sentinels), timeout=timeout):
+            slot = sentinels[sentinel]
+            process = self._processes[slot]
+            process.join()
+            if self._stopping:
+                continue
+            self._logger.warning(
+                f'Worker {slot} (pid={process.pid}) exited '
+                f'with code {process.exitcode}, restarting.')
+            uptime = time.monotonic() - self._started_at[slot]
+            if uptime < self._restart_delay:
+                time.sleep(self._restart_delay - uptime)
+            self._start(slot)
+            self.restarts += 1
+
+    def _stop_workers(self, timeout: float = 10.0):
+        alive = [process for process in self._processes
+                 if process is not None and process.is_alive()]
+        for process in alive:
+            process.terminate()
+        deadline = time.monotonic() + timeout
+        for process in alive:
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                self._logger.warning(
+                    f'Worker {process.name} (pid={process.pid}) '
+                    f'did not stop, killing.')
+                process.kill()
+                process.join()
+
+    def _collect_credentials(self, collector: PasswordCollector):
+        while (data := self._credentials.get()) is not None:
+            try:
+                collector.add_user(UserData(data))
+            except Exception as e:
+                self._logger.warning(f'Credentials are not saved: {e}')
+
+    def _collect_reports(self):
+        while (report := self._reports.get()) is not None:
+            slot, stats = report
+            self._stats[slot] = stats
+
+    def stats(self) -> dict[str, dict[str, int]]:
+        """
+        Sums of the last statistics reported by each worker
+        and statistics of the credentials file.
+        Counters of a restarted worker start from zero.
+        """
+        total = dict()
+        for stats in list(self._stats.values()):
+            for component, values in stats.items():
+                summed = total.setdefault(component, dict())
+                for name, value in values.items():
+                    summed[name] = summed.get(name, 0) + value
+        if self._collector:
+            total.setdefault('credentials', dict()).update(
+                self._collector.stats())
+        total['workers'] = {
+            'running': sum(1 for process in self._processes
+                           if process is not None and process.is_alive()),
+            'restarts': self.restarts
+        }
+        return total
@@ -1 +1,2 @@
 from sslcert.sslcreator import CertificateCreator, save_file_at_dir
+from sslcert.certstore import CertificateStore
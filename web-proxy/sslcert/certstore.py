@@ -0,0 +1,211 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Iterable, Optional
+
+from cryptography import x509
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+
+class CertificateStore:
+    """
+    On-disk index of issued certificates: hostname and SAN set
+    to the certificate files saved in cert_dir.
+    The database is opened on first use, nothing is loaded in advance.
+    It is kept in WAL mode, so worker processes sharing it do not
+    block each other's lookups. A writer may still hold the lock
+    for a while, so lookups are meant to run in a thread: the connection
+    is shared by threads and used by one of them at a time.
+    """
+    _logger = logging.getLogger('certificateStore')
+
+    def __init__(self, filename: str, cert_dir: str,
+                 renew_before: float = 86400.0, grace: float = 60.0):
+        """
+        :param filename: SQLite database of the index
+        :param cert_dir: directory with .crt and .key files
+        :param renew_before: seconds before expiration when a certificate
+                             is not used anymore
+        :param grace: seconds an unindexed file is kept, it may be saved
+                      by a minting process right now
+        """
+        self._filename = filename
+        self._cert_dir = cert_dir
+        self._renew_before = renew_before
+        self._grace = grace
+        self._db: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        os.makedirs(os.path.dirname(self._filename) or '.', exist_ok=True)
+        db = sqlite3.connect(self._filename, timeout=10.0,
+                             check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('CREATE TABLE IF NOT EXISTS certificates ('
+                   'hostname TEXT PRIMARY KEY, '
+                   'san TEXT NOT NULL, '
+                   'serial TEXT NOT NULL, '
+                   'not_after REAL NOT NULL, '
+                   "key_type TEXT NOT NULL DEFAULT 'rsa')")
+        self._migrate(db)
+        db.commit()
+        return db
+
+    @staticmethod
+    def _migrate(db: sqlite3.Connection):
+        columns = {row[1] for row in
+                   db.execute('PRAGMA table_info(certificates)')}
+        if 'key_type' not in columns:
+            # Indexes created before ECDSA support hold RSA keys only.
+            db.execute('ALTER TABLE certificates ADD COLUMN '
+                       "key_type TEXT NOT NULL DEFAULT 'rsa'")
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = self._connect()
+        return self._db
+
+    @staticmethod
+    def _san_key(alt_names: Iterable[str]) -> str:
+        return '\n'.join(sorted(set(alt_names)))
+
+    def _files(self, serial: str) -> tuple[Path, Path]:
+        return (Path(self._cert_dir, f'{serial}.crt'),
+                Path(self._cert_dir, f'{serial}.key'))
+
+    def get(self, hostname: str, alt_names: Iterable[str],
+            key_type: str = 'rsa') -> Optional[str]:
+        """
+        :return: serial of a valid certificate for the hostname
+                 with the same SAN set and key type, if any
+        """
+        with self._lock:
+            row = self.db.execute(
+                'SELECT san, serial, not_after, key_type FROM certificates '
+                'WHERE hostname = ?', (hostname,)).fetchone()
+        if row is None:
+            return None
+        san, serial, not_after, saved_key_type = row
+        if san != self._san_key(alt_names) or saved_key_type != key_type \
+                or not_after - self._renew_before <= time.time() \
+                or not all(path.exists() for path in self._files(serial)):
+            return None
+        return serial
+
+    def put(self, hostname: str, alt_names: Iterable[str],
+            serial: str, not_after: float, key_type: str = 'rsa'):
+        with self._lock, self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO certificates '
+                '(hostname, san, serial, not_after, key_type) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (hostname, self._san_key(alt_names), serial, not_after,
+                 key_type))
+
+    def __len__(self):
+        with self._lock:
+            return self.db.execute(
+                'SELECT COUNT(*) FROM certificates').fetchone()[0]
+
+    def collect_garbage(self) -> dict[str, int]:
+        """
+        Removes expired certificates and files of replaced ones.
+        Certificates saved before the index existed are indexed.
+        Uses its own database connection, so it may run in a thread.
+        :return: counts of indexed and removed certificates
+        """
+        db = self._connect()
+        try:
+            return self._collect_garbage(db)
+        finally:
+            db.close()
+
+    def _collect_garbage(self, db: sqlite3.Connection) -> dict[str, int]:
+        now = time.time()
+        stats = {'indexed': 0, 'removed': 0}
+        with db:
+            expired = db.execute(
+                'SELECT serial FROM certificates WHERE not_after <= ?',
+                (now,)).fetchall()
+            db.execute('DELETE FROM certificates WHERE not_after <= ?',
+                       (now,))
+        for serial, in expired:
+            self._remove(serial)
+            stats['removed'] += 1
+
+        indexed = {serial for serial, in db.execute(
+            'SELECT serial FROM certificates')}
+        for serial in self._saved_serials():
+            if serial in indexed:
+                continue
+            crt_path, key_path = self._files(serial)
+            if self._is_recent(crt_path) or self._is_recent(key_path):
+                continue
+            if self._index_file(db, serial, now):
+                stats['indexed'] += 1
+            else:
+                self._remove(serial)
+                stats['removed'] += 1
+        self._logger.info(f'Garbage collected ({stats}).')
+        return stats
+
+    def _saved_serials(self) -> set[str]:
+        if not os.path.isdir(self._cert_dir):
+            return set()
+        return {os.path.splitext(name)[0]
+                for name in os.listdir(self._cert_dir)
+                if name.endswith(('.crt', '.key'))}
+
+    def _is_recent(self, path: Path) -> bool:
+        try:
+            return time.time() - path.stat().st_mtime < self._grace
+        except FileNotFoundError:
+            return False
+
+    def _index_file(self, db: sqlite3.Connection, serial: str,
+                    now: float) -> bool:
+        """
+        Indexes a certificate saved without the index.
+        :return: False if the files are broken, expired or replaced
+        """
+        crt_path, key_path = self._files(serial)
+        if not key_path.exists():
+            return False
+        try:
+            cert = x509.load_pem_x509_certificate(crt_path.read_bytes())
+            hostname = cert.subject.get_attributes_for_oid(
+                NameOID.COMMON_NAME)[0].value
+            alt_names = cert.extensions.get_extension_for_class(
+                x509.SubjectAlternativeName).value.get_values_for_type(
+                x509.DNSName)
+        except (OSError, ValueError, IndexError, x509.ExtensionNotFound):
+            return False
+        not_after = cert.not_valid_after_utc.timestamp()
+        if not_after <= now:
+            return False
+        key_type = 'ecdsa' \
+            if isinstance(cert.public_key(), ec.EllipticCurvePublicKey) \
+            else 'rsa'
+        with db:
+            cursor = db.execute(
+                'INSERT OR IGNORE INTO certificates '
+                '(hostname, san, serial, not_after, key_type) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (hostname, self._san_key(alt_names), serial, not_after,
+                 key_type))
+        return cursor.rowcount == 1
+
+    def _remove(self, serial: str):
+        for path in self._files(serial):
+            path.unlink(missing_ok=True)
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
@@ -1,31 +1,178 @@
+import asyncio
+import logging
 import os
 import random
 import ssl
+import time
 
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
 from pathlib import Path
+from typing import Optional
 
 from cryptography import x509
 from cryptography.x509.oid import NameOID
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
 
 from common.filemanager import FileManager, save_file_at_dir
+from sslcert.certstore import CertificateStore
+
+CERT_VALIDITY = timedelta(days=10 * 365)
+KEY_ALGORITHMS = ('rsa', 'ecdsa')
+# Forward secrecy only, AEAD ciphers for ECDSA and RSA certificates.
+SERVER_CIPHERS = 'ECDHE+AESGCM:ECDHE+CHACHA20'
+
+
+def _load_ca(ca_cert_bytes: bytes, ca_key_bytes: bytes):
+    ca_cert = x509.load_pem_x509_certificates(ca_cert_bytes)[0]
+    ca_key = serialization.load_pem_private_key(
+        data=ca_key_bytes,
+        password=None,
+        backend=default_backend()
+    )
+    return ca_cert, ca_key
+
+
+def generate_key(algorithm='rsa'):
+    """
+    :param algorithm: 'rsa' for RSA-2048 or 'ecdsa' for ECDSA P-256
+    """
+    if algorithm == 'ecdsa':
+        return ec.generate_private_key(ec.SECP256R1(), default_backend())
+    return rsa.generate_private_key(
+        public_exponent=65537,
+        key_size=2048,
+        backend=default_backend(),
+    )
+
+
+def key_to_pem(key) -> bytes:
+    return key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.TraditionalOpenSSL,
+        encryption_algorithm=serialization.NoEncryption(),
+    )
+
+
+def generate_certificate(ca_cert, ca_key, hostname, san, key=None,
+                         algorithm='rsa'):
+    """
+    Issues a leaf certificate for the hostname signed by the root CA.
+    :param algorithm: algorithm of a new key if the key is not given
+    :return: serial number, certificate PEM, key PEM
+    """
+    if key is None:
+        key = generate_key(algorithm)
+    name = x509.Name([
+        x509.NameAttribute(NameOID.COMMON_NAME, hostname)
+    ])
+
+    basic_contraints = x509.BasicConstraints(ca=False, path_length=None)
+    now = datetime.utcnow()
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(ca_cert.subject)
+        .public_key(key.public_key())
+        .serial_number(random.getrandbits(64))
+        .not_valid_before(now)
+        .not_valid_after(now + CERT_VALIDITY)
+        .add_extension(basic_contraints, False)
+        .add_extension(san, False)
+        .sign(ca_key, hashes.SHA256(), default_backend())
+    )
+    cert_pem = cert.public_bytes(encoding=serialization.Encoding.PEM)
+    return cert.serial_number, cert_pem, key_to_pem(key)
+
+
+# Root CA of a minting worker process, loaded once by _init_worker.
+_worker_ca = None
+
+
+def _init_worker(ca_cert_bytes: bytes, ca_key_bytes: bytes):
+    global _worker_ca
+    _worker_ca = _load_ca(ca_cert_bytes, ca_key_bytes)
+
+
+def _generate_key_pem(algorithm='rsa') -> bytes:
+    return key_to_pem(generate_key(algorithm))
+
+
+def _mint_certificate(cert_dir: str, hostname: str, alt_names: list[str],
+                      algorithm='rsa', key_pem: Optional[bytes] = None) -> str:
+    """
+    Runs in a worker process: issues and saves a leaf certificate.
+    :return: filename of the certificate and the key without extension
+    """
+    ca_cert, ca_key = _worker_ca
+    key = None
+    if key_pem is not None:
+        key = serialization.load_pem_private_key(
+            data=key_pem, password=None, backend=default_backend())
+    san = x509.SubjectAlternativeName(
+        [x509.DNSName(name) for name in alt_names])
+    serialnumber, cert, key = generate_certificate(
+        ca_cert, ca_key, hostname, san, key, algorithm)
+    filename = str(serialnumber)
+    save_file_at_dir(cert_dir, f'{filename}.crt', cert)
+    save_file_at_dir(cert_dir, f'{filename}.key', key)
+    return filename
 
 
 class CertificateCreator:
+    _logger = logging.getLogger('certificateCreator')
+
     def __init__(self, work_dir='./openssl/',
-                 ca_cert_file='RootCA.crt', ca_key_file='RootCA.key'):
+                 ca_cert_file='RootCA.crt', ca_key_file='RootCA.key',
+                 context_cache_size=1024, context_ttl=3600.0,
+                 workers=2, spare_keys=0,
+                 store: Optional[CertificateStore] = None,
+                 gc_interval=3600.0,
+                 key_algorithm='ecdsa'):
         """
         :param work_dir:
         :param ca_cert_file:
         :param ca_key_file:
+        :param context_cache_size: count of server-side contexts
+                                   and of certificate filenames kept
+        :param context_ttl: seconds a context is kept
+        :param workers: count of processes minting certificates
+        :param spare_keys: count of pre-generated keys for new hosts
+        :param store: index of saved certificates,
+                      work_dir/certs.sqlite3 by default
+        :param gc_interval: seconds between garbage collections of the store,
+                            None disables them
+        :param key_algorithm: 'ecdsa' or 'rsa' keys of issued certificates
         :raise FileNotExist
         """
-        self._cert: dict = dict()
+        if key_algorithm not in KEY_ALGORITHMS:
+            raise ValueError(f'Unknown key algorithm: {key_algorithm}')
+        self._key_algorithm = key_algorithm
+        # Filenames of certificates per host, least recently used first.
+        self._cert: OrderedDict[str, str] = OrderedDict()
         self._cert_dir = os.path.join(work_dir, 'ssl/')
+        self._store = store if store is not None else CertificateStore(
+            filename=os.path.join(work_dir, 'certs.sqlite3'),
+            cert_dir=self._cert_dir)
+        self._gc_interval = gc_interval
+        self._gc: Optional[asyncio.Task] = None
+        self._contexts: OrderedDict[str, tuple[ssl.SSLContext, float]] = \
+            OrderedDict()
+        self._context_cache_size = context_cache_size
+        self._context_ttl = context_ttl
+        self.context_hits = 0
+        self.context_misses = 0
+        self.minted = 0
+        self._workers = workers
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._minting: dict[str, asyncio.Future] = dict()
+        self._spare_keys_size = spare_keys
+        self._spare_keys: deque[bytes] = deque()
+        self._refill: Optional[asyncio.Task] = None
         self._load_certs(work_dir, ca_cert_file, ca_key_file)
 
     def _load_certs(self, work_dir: str, ca_cert_file: str, ca_key_file: str):
@@ -35,30 +182,174 @@ class CertificateCreator:
         ca_key_file = FileManager(dirname=work_dir, file=ca_key_file)
         ca_key_bytes = ca_key_file.read_file()
 
-        self._ca_cert = x509.load_pem_x509_certificates(ca_cert_bytes)[0]
-        self._ca_key = serialization.load_pem_private_key(
-            data=ca_key_bytes,
-            password=None,
-            backend=default_backend()
-        )
+        self._ca_pem = (ca_cert_bytes, ca_key_bytes)
+        self._ca_cert, self._ca_key = _load_ca(ca_cert_bytes, ca_key_bytes)
+
+    def start(self):
+        """
+        Starts the minting processes, fills the spare keys
+        and collects garbage of the store in the background.
+        """
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self._workers,
+                initializer=_init_worker,
+                initargs=self._ca_pem)
+        self._refill_spare_keys()
+        if self._gc is None and self._gc_interval:
+            self._gc = asyncio.create_task(self._collect_garbage())
+
+    async def _collect_garbage(self):
+        while True:
+            try:
+                await asyncio.to_thread(self._store.collect_garbage)
+            except Exception as e:
+                self._logger.warning(f'Garbage collection failed: {e!r}')
+            await asyncio.sleep(self._gc_interval)
+
+    async def get_sslcontext(self, target_host,
+                             cert_dict) -> ssl.SSLContext:
+        """
+        Returns a cached context for the host or creates a new one.
+        Concurrent calls for the same host wait for one certificate.
+        """
+        context = self._get_cached_context(target_host)
+        if context is not None:
+            self.context_hits += 1
+            return context
+        future = self._minting.get(target_host)
+        if future is None:
+            self.context_misses += 1
+            future = asyncio.ensure_future(
+                self._create_sslcontext(target_host, cert_dict))
+            self._minting[target_host] = future
+            future.add_done_callback(
+                lambda _: self._minting.pop(target_host, None))
+        return await asyncio.shield(future)
+
+    async def _create_sslcontext(self, target_host,
+                                 cert_dict) -> ssl.SSLContext:
+        alt_names = self._get_alt_name_list(target_host, cert_dict)
+        # The store is shared by workers, a lock of another process
+        # must not stall the event loop.
+        filename = self._get_cert_filename(target_host) \
+            or await asyncio.to_thread(self._store.get, target_host,
+                                       alt_names, self._key_algorithm)
+        if filename is None:
+            not_after = time.time() + CERT_VALIDITY.total_seconds()
+            filename = await self._mint(target_host, cert_dict)
+            self.minted += 1
+            await asyncio.to_thread(self._store.put, target_host, alt_names,
+                                    filename, not_after, self._key_algorithm)
+        self._remember_cert(target_host, filename)
+        # Reading the files and the key must not stall other connections.
+        context = await asyncio.to_thread(self._load_sslcontext,
+                                          self._get_crt_path(filename),
+                                          self._get_key_path(filename))
+        self._cache_context(target_host, context)
+        return context
+
+    async def _mint(self, host, cert_info) -> str:
+        if self._executor is None:
+            self.start()
+        key_pem = self._spare_keys.popleft() if self._spare_keys else None
+        self._refill_spare_keys()
+        alt_names = self._get_alt_name_list(host, cert_info)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, _mint_certificate,
+            self._cert_dir, host, alt_names, self._key_algorithm, key_pem)
+
+    def _refill_spare_keys(self):
+        if len(self._spare_keys) < self._spare_keys_size \
+                and (self._refill is None or self._refill.done()):
+            self._refill = asyncio.create_task(self._fill_spare_keys())
+
+    async def _fill_spare_keys(self):
+        loop = asyncio.get_running_loop()
+        while len(self._spare_keys) < self._spare_keys_size:
+            key_pem = await loop.run_in_executor(
+                self._executor, _generate_key_pem, self._key_algorithm)
+            self._spare_keys.append(key_pem)
+
+    def _get_cached_context(self, host) -> ssl.SSLContext | None:
+        cached = self._contexts.get(host)
+        if cached is None:
+            return None
+        context, expires = cached
+        if expires <= time.monotonic():
+            del self._contexts[host]
+            return None
+        self._contexts.move_to_end(host)
+        return context
+
+    def _cache_context(self, host, context: ssl.SSLContext):
+        self._contexts[host] = (context, time.monotonic() + self._context_ttl)
+        self._contexts.move_to_end(host)
+        while len(self._contexts) > self._context_cache_size:
+            self._contexts.popitem(last=False)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'contexts': len(self._contexts),
+            'context_hits': self.context_hits,
+            'context_misses': self.context_misses,
+            'minting': len(self._minting),
+            'minted': self.minted,
+            'spare_keys': len(self._spare_keys)
+        }
+
+    async def close(self):
+        for task in (self._refill, self._gc):
+            if task:
+                task.cancel()
+        self._store.close()
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        self._logger.info('Certificate creator closed.')
 
     def create_sslcontext(self, target_host, cert_dict) -> ssl.SSLContext:
         certfile, keyfile = self._create_ssl(target_host, cert_dict)
+        return self._load_sslcontext(certfile, keyfile)
+
+    def _load_sslcontext(self, certfile, keyfile) -> ssl.SSLContext:
+        """
+        Server-side context of one host. Contexts are cached, so clients
+        resume sessions by tickets or by the session cache of the context.
+        """
         context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        context.minimum_version = ssl.TLSVersion.TLSv1_2
+        context.options |= ssl.OP_CIPHER_SERVER_PREFERENCE \
+            | ssl.OP_NO_RENEGOTIATION
+        context.options &= ~ssl.OP_NO_TICKET
+        context.set_ciphers(SERVER_CIPHERS)
+        context.num_tickets = 2
         self._ca_cert_file.check_exist()
         context.load_verify_locations(cafile=self._ca_cert_file.filename)
         context.load_cert_chain(certfile=certfile, keyfile=keyfile)
         return context
 
-    def _create_ssl(self, host, cert_info) -> (str, str):
-        is_exist = host in self._cert
-        if is_exist:
-            filename = self._cert[host]
-            is_exist = all((
+    def _get_cert_filename(self, host) -> Optional[str]:
+        """
+        :return: filename of the saved certificate of the host, if any
+        """
+        filename = self._cert.get(host)
+        if filename is None or not all((
                 Path(self._get_crt_path(filename)).exists(),
-                Path(self._get_key_path(filename)).exists()
-            ))
-        if not is_exist:
+                Path(self._get_key_path(filename)).exists())):
+            return None
+        self._cert.move_to_end(host)
+        return filename
+
+    def _remember_cert(self, host, filename: str):
+        self._cert[host] = filename
+        self._cert.move_to_end(host)
+        while len(self._cert) > self._context_cache_size:
+            self._cert.popitem(last=False)
+
+    def _create_ssl(self, host, cert_info) -> (str, str):
+        if self._get_cert_filename(host) is None:
             serialnumber, cert, key = self._generate_selfsigned_cert(
                 hostname=host,
                 san=self._get_alt_names(host, cert_info),
@@ -67,7 +358,7 @@ class CertificateCreator:
             filename = str(serialnumber)
             save_file_at_dir(self._cert_dir, f'{filename}.crt', cert)
             save_file_at_dir(self._cert_dir, f'{filename}.key', key)
-            self._cert[host] = filename
+            self._remember_cert(host, filename)
         filename = self._cert[host]
         return self._get_crt_path(filename), self._get_key_path(filename)
 
@@ -78,43 +369,17 @@ class CertificateCreator:
         return os.path.join(self._cert_dir, f'{filename}.key')
 
     @staticmethod
-    def _get_alt_names(hostname: str, cert_info: dict):
-        ip_addresses = [addr for _, addr in cert_info['subjectAltName']]
-        ip_addresses.append(hostname)
-        alt_names = []
-        for addr in ip_addresses:
-            alt_names.append(x509.DNSName(addr))
-        return x509.SubjectAlternativeName(alt_names)
+    def _get_alt_name_list(hostname: str, cert_info: dict) -> list[str]:
+        alt_names = [addr for _, addr in cert_info.get('subjectAltName', ())]
+        alt_names.append(hostname)
+        return alt_names
+
+    @classmethod
+    def _get_alt_names(cls, hostname: str, cert_info: dict):
+        return x509.SubjectAlternativeName(
+            [x509.DNSName(addr)
+             for addr in cls._get_alt_name_list(hostname, cert_info)])
 
     def _generate_selfsigned_cert(self, hostname, san, key=None):
-        if key is None:
-            key = rsa.generate_private_key(
-                public_exponent=65537,
-                key_size=2048,
-                backend=default_backend(),
-            )
-        name = x509.Name([
-            x509.NameAttribute(NameOID.COMMON_NAME, hostname)
-        ])
-
-        basic_contraints = x509.BasicConstraints(ca=False, path_length=None)
-        now = datetime.utcnow()
-        cert = (
-            x509.CertificateBuilder()
-            .subject_name(name)
-            .issuer_name(self._ca_cert.subject)
-            .public_key(key.public_key())
-            .serial_number(random.getrandbits(64))
-            .not_valid_before(now)
-            .not_valid_after(now + timedelta(days=10 * 365))
-            .add_extension(basic_contraints, False)
-            .add_extension(san, False)
-            .sign(self._ca_key, hashes.SHA256(), default_backend())
-        )
-        cert_pem = cert.public_bytes(encoding=serialization.Encoding.PEM)
-        key_pem = key.private_bytes(
-            encoding=serialization.Encoding.PEM,
-            format=serialization.PrivateFormat.TraditionalOpenSSL,
-            encryption_algorithm=serialization.NoEncryption(),
-        )
-        return cert.serial_number, cert_pem, key_pem
+        return generate_certificate(self._ca_cert, self._ca_key,
+                                    hostname, san, key, self._key_algorithm)
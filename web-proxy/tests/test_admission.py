@@ -0,0 +1,64 @@
+import asyncio
+from unittest import IsolatedAsyncioTestCase
+
+from proxy.admission import AdmissionControl
+
+
+class AdmissionControlTests(IsolatedAsyncioTestCase):
+
+    async def test_admit(self):
+        admission = AdmissionControl(max_connections=2)
+        self.assertTrue(await admission.admit('a'))
+        self.assertTrue(await admission.admit('b'))
+        admission.release('a')
+        self.assertEqual({'active': 1, 'waiting': 0, 'admitted': 2,
+                          'queued': 0, 'shed': 0, 'shed_client': 0},
+                         admission.stats())
+
+    async def test_queue(self):
+        admission = AdmissionControl(max_connections=1, queue_timeout=1)
+        self.assertTrue(await admission.admit('a'))
+        waiting = asyncio.create_task(admission.admit('b'))
+        await asyncio.sleep(0)
+        self.assertEqual(1, admission.stats()['waiting'])
+        admission.release('a')
+        self.assertTrue(await waiting)
+        self.assertEqual(1, admission.stats()['active'])
+        self.assertEqual(1, admission.queued)
+
+    async def test_queue_full(self):
+        admission = AdmissionControl(max_connections=1, max_queue=1)
+        self.assertTrue(await admission.admit('a'))
+        waiting = asyncio.create_task(admission.admit('b'))
+        await asyncio.sleep(0)
+        self.assertFalse(await admission.admit('c'))
+        self.assertEqual(1, admission.shed)
+        waiting.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiting
+        admission.release('a')
+        self.assertEqual(0, admission.stats()['active'])
+        self.assertEqual({}, admission._clients)
+
+    async def test_queue_timeout(self):
+        admission = AdmissionControl(max_connections=1, queue_timeout=0.01)
+        self.assertTrue(await admission.admit('a'))
+        self.assertFalse(await admission.admit('b'))
+        self.assertEqual(1, admission.shed)
+        admission.release('a')
+        # The expired waiter does not take the slot.
+        self.assertEqual(0, admission.stats()['active'])
+
+    async def test_per_client(self):
+        admission = AdmissionControl(max_connections=1, per_client=1)
+        self.assertTrue(await admission.admit('a'))
+        self.assertTrue(admission.limited('a'))
+        self.assertFalse(await admission.admit('a'))
+        self.assertFalse(admission.limited('b'))
+        self.assertEqual(1, admission.shed_client)
+
+    async def test_unlimited(self):
+        admission = AdmissionControl(max_connections=0, per_client=0)
+        for _ in range(3):
+            self.assertTrue(await admission.admit('a'))
+        self.assertFalse(admission.limited('a'))
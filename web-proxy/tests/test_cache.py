@@ -0,0 +1,318 @@
+import tempfile
+import time
+from asyncio import StreamWriter
+from email.utils import formatdate
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import MagicMock
+
+from parameterized import parameterized
+
+from proxy.cache import HTTPCache, CacheEntry, CacheLookup, CacheSink, \
+    DiskTier, cache_key, parse_cache_control
+from proxy.httpparser import HTTPRequest, HTTPResponse
+
+
+def get_request(path='http://host/a', **headers) -> HTTPRequest:
+    return HTTPRequest(method='GET', path=path, proto='HTTP/1.1',
+                       host='host', port=80, headers=headers)
+
+
+def get_entry(body=b'body', now=None, **headers) -> CacheEntry:
+    now = now or time.time()
+    return CacheEntry(key='http://host/a', proto='HTTP/1.1', code=200,
+                      message='OK', headers=headers, body=body,
+                      request_time=now, response_time=now)
+
+
+class CacheFunctionsTests(IsolatedAsyncioTestCase):
+
+    def test_parse_cache_control(self):
+        self.assertEqual(
+            {'max-age': '60', 'no-cache': None, 'private': 'set-cookie'},
+            parse_cache_control(
+                {'cache-control': 'max-age=60, No-Cache, '
+                                  'private="set-cookie"'}))
+
+    @parameterized.expand([
+        ('http://host/a', False, 'http://host/a'),
+        ('/a', True, 'https://host:8443/a'),
+        ('/a', False, 'http://host:8443/a'),
+    ])
+    def test_cache_key(self, path, https, expected):
+        request = get_request(path=path, host='host:8443')
+        self.assertEqual(expected, cache_key(request, https))
+
+    @parameterized.expand([
+        ({'cache-control': 'max-age=60'}, 60),
+        ({'cache-control': 's-maxage=10, max-age=60'}, 10),
+        ({'expires': formatdate(1000 + 30, usegmt=True),
+          'date': formatdate(1000, usegmt=True)}, 30),
+        ({'expires': '0'}, 0),
+        ({'last-modified': formatdate(0, usegmt=True),
+          'date': formatdate(1000, usegmt=True)}, 100),
+        ({'etag': '"v1"'}, 0),
+    ])
+    def test_freshness_lifetime(self, headers, expected):
+        self.assertEqual(expected, get_entry(**headers).freshness_lifetime())
+
+    def test_current_age(self):
+        entry = get_entry(age='10', now=1000)
+        entry.request_time = 998
+        self.assertEqual(17, entry.current_age(1005))
+
+    @parameterized.expand([
+        ({}, True),
+        ({'max-age': '5'}, False),
+        ({'min-fresh': '55'}, False),
+        ({'min-fresh': '5'}, True),
+    ])
+    def test_is_fresh(self, directives, expected):
+        now = time.time()
+        entry = get_entry(now=now - 10, **{'cache-control': 'max-age=60'})
+        self.assertEqual(expected, entry.is_fresh(directives, now))
+
+    def test_no_cache_response_is_not_fresh(self):
+        entry = get_entry(**{'cache-control': 'max-age=60, no-cache'})
+        self.assertFalse(entry.is_fresh({}, time.time()))
+
+    @parameterized.expand([
+        ({'if-none-match': '"v1"'}, 304),
+        ({'if-none-match': '"v0", W/"v1"'}, 304),
+        ({'if-none-match': '*'}, 304),
+        ({'if-none-match': '"v2"'}, 200),
+        ({'if-modified-since': formatdate(200, usegmt=True)}, 304),
+        ({'if-modified-since': formatdate(50, usegmt=True)}, 200),
+        ({}, 200),
+    ])
+    def test_to_response(self, conditions, code):
+        entry = get_entry(etag='"v1"', **{
+            'last-modified': formatdate(100, usegmt=True),
+            'x-custom': 'value'})
+        response = entry.to_response(conditions, entry.response_time + 3)
+        self.assertEqual(code, response.code)
+        self.assertEqual('3', response.headers['age'])
+        if code == 200:
+            self.assertEqual('4', response.headers['content-length'])
+            self.assertEqual(b'body', response.raw_content)
+        else:
+            self.assertNotIn('x-custom', response.headers)
+
+    def test_entry_bytes(self):
+        entry = get_entry(etag='"v1"')
+        entry.vary = {'accept-encoding': 'gzip'}
+        self.assertEqual(entry, CacheEntry.from_bytes(entry.to_bytes()))
+
+    def test_sink(self):
+        target = MagicMock(spec=StreamWriter)
+        sink = CacheSink(target, max_size=4)
+        sink.write(b'ab')
+        sink.write(b'cd')
+        self.assertEqual(b'abcd', sink.content)
+        sink.write(b'e')
+        self.assertTrue(sink.overflowed)
+        self.assertEqual(b'', sink.content)
+        self.assertEqual(3, target.write.call_count)
+
+
+class HTTPCacheTests(IsolatedAsyncioTestCase):
+
+    @staticmethod
+    def get_response(code=200, **headers) -> HTTPResponse:
+        return HTTPResponse(proto='HTTP/1.1', code=code, message='OK',
+                            headers=headers)
+
+    async def store(self, cache: HTTPCache, request: HTTPRequest,
+                    body=b'body', **headers) -> CacheLookup:
+        lookup = await cache.lookup(request, https=False)
+        headers.setdefault('content-length', str(len(body)))
+        response = self.get_response(**headers)
+        await cache.store(lookup, request, response, body, time.time())
+        return lookup
+
+    async def test_miss_and_hit(self):
+        cache = HTTPCache()
+        lookup = await self.store(cache, get_request(), **{
+            'cache-control': 'max-age=60', 'connection': 'keep-alive'})
+        self.assertIsNone(lookup.entry)
+        lookup = await cache.lookup(get_request(), https=False)
+        self.assertTrue(lookup.fresh)
+        self.assertEqual(b'body', lookup.entry.body)
+        self.assertNotIn('connection', lookup.entry.headers)
+        self.assertNotIn('content-length', lookup.entry.headers)
+        self.assertEqual({'hits': 1, 'misses': 1, 'stale': 0,
+                          'revalidated': 0, 'stored': 1, 'invalidated': 0,
+                          'entries': 1, 'memory_bytes': lookup.entry.size},
+                         cache.stats())
+
+    @parameterized.expand([
+        ('post', HTTPRequest(method='POST', path='http://host/a')),
+        ('authorization', get_request(authorization='Basic x')),
+        ('no_store', get_request(**{'cache-control': 'no-store'})),
+        ('content', get_request(**{'content-length': '3'})),
+    ])
+    async def test_lookup_bypass(self, _, request):
+        self.assertIsNone(await HTTPCache().lookup(request, https=False))
+
+    @parameterized.expand([
+        ('no_cache', {'cache-control': 'no-cache'}),
+        ('pragma', {'pragma': 'no-cache'}),
+        ('max_age', {'cache-control': 'max-age=0'}),
+    ])
+    async def test_lookup_forced_revalidation(self, _, headers):
+        cache = HTTPCache()
+        await self.store(cache, get_request(),
+                         **{'cache-control': 'max-age=60'})
+        lookup = await cache.lookup(get_request(**headers), https=False)
+        self.assertIsNotNone(lookup.entry)
+        self.assertFalse(lookup.fresh)
+        self.assertEqual(1, cache.stale)
+
+    async def test_vary(self):
+        cache = HTTPCache()
+        for encoding in ('gzip', 'br'):
+            await self.store(cache, get_request(**{'accept-encoding':
+                                                   encoding}),
+                             body=encoding.encode(), vary='Accept-Encoding',
+                             **{'cache-control': 'max-age=60'})
+        for encoding in ('gzip', 'br'):
+            lookup = await cache.lookup(
+                get_request(**{'accept-encoding': encoding}), https=False)
+            self.assertEqual(encoding.encode(), lookup.entry.body)
+        lookup = await cache.lookup(get_request(), https=False)
+        self.assertIsNone(lookup.entry)
+        self.assertEqual(2, cache.stats()['entries'])
+
+    async def test_store_chunked(self):
+        cache = HTTPCache()
+        lookup = await cache.lookup(get_request(), https=False)
+        response = self.get_response(**{'transfer-encoding': 'chunked',
+                                        'cache-control': 'max-age=60'})
+        await cache.store(lookup, get_request(), response,
+                          b'2\r\nab\r\n1\r\nc\r\n0\r\n\r\n', time.time())
+        entry = (await cache.lookup(get_request(), https=False)).entry
+        self.assertEqual(b'abc', entry.body)
+        self.assertNotIn('transfer-encoding', entry.headers)
+        self.assertEqual('3', entry.to_response({}, time.time())
+                         .headers['content-length'])
+
+    @parameterized.expand([
+        ('max_age', 200, {'cache-control': 'max-age=60'}, True),
+        ('etag', 200, {'etag': '"v1"'}, True),
+        ('public', 200, {'cache-control': 'public'}, True),
+        ('nothing', 200, {}, False),
+        ('no_store', 200, {'cache-control': 'no-store, max-age=60'}, False),
+        ('private', 200, {'cache-control': 'private, max-age=60'}, False),
+        ('cookie', 200, {'cache-control': 'max-age=60',
+                         'set-cookie': 'a=b'}, False),
+        ('vary_star', 200, {'cache-control': 'max-age=60',
+                            'vary': '*'}, False),
+        ('code', 500, {'cache-control': 'max-age=60'}, False),
+        ('too_big', 200, {'cache-control': 'max-age=60',
+                          'content-length': '2048'}, False),
+    ])
+    def test_is_storable(self, _, code, headers, expected):
+        headers.setdefault('content-length', '4')
+        cache = HTTPCache(max_object_size=1024)
+        self.assertEqual(expected, cache.is_storable(
+            get_request(), self.get_response(code, **headers)))
+
+    def test_is_storable_unframed(self):
+        self.assertFalse(HTTPCache().is_storable(
+            get_request(), self.get_response(**{'cache-control':
+                                                'max-age=60'})))
+
+    async def test_revalidation(self):
+        cache = HTTPCache()
+        await self.store(cache, get_request(), etag='"v1"', **{
+            'cache-control': 'max-age=0',
+            'last-modified': formatdate(100, usegmt=True)})
+        request = get_request(**{'if-none-match': '"client"'})
+        lookup = await cache.lookup(request, https=False)
+        self.assertFalse(lookup.fresh)
+        self.assertTrue(cache.add_validators(lookup, request))
+        self.assertEqual('"v1"', request.headers['if-none-match'])
+        self.assertEqual(formatdate(100, usegmt=True),
+                         request.headers['if-modified-since'])
+        self.assertEqual({'if-none-match': '"client"'}, lookup.conditions)
+
+        entry = await cache.refresh(lookup, self.get_response(
+            304, **{'cache-control': 'max-age=60', 'content-length': '0'}),
+            time.time())
+        self.assertEqual('max-age=60', entry.headers['cache-control'])
+        self.assertNotIn('content-length', entry.headers)
+        self.assertEqual(200, lookup.to_response(time.time()).code)
+        self.assertTrue((await cache.lookup(get_request(),
+                                            https=False)).fresh)
+
+    async def test_refresh_counts_size(self):
+        cache = HTTPCache()
+        await self.store(cache, get_request(), etag='"v1"',
+                         **{'cache-control': 'max-age=0'})
+        lookup = await cache.lookup(get_request(), https=False)
+        await cache.refresh(lookup, self.get_response(
+            304, **{'cache-control': 'max-age=60, must-revalidate',
+                    'x-served-by': 'origin-1'}), time.time())
+        self.assertEqual(lookup.entry.size, cache.stats()['memory_bytes'])
+
+    def test_add_validators_without_validators(self):
+        lookup = CacheLookup(key='key', entry=get_entry())
+        self.assertFalse(HTTPCache.add_validators(lookup, get_request()))
+        self.assertFalse(lookup.revalidating)
+
+    async def test_invalidate(self):
+        cache = HTTPCache()
+        await self.store(cache, get_request(),
+                         **{'cache-control': 'max-age=60'})
+        await cache.invalidate('http://host/a')
+        self.assertIsNone((await cache.lookup(get_request(),
+                                              https=False)).entry)
+        self.assertEqual(0, cache.stats()['memory_bytes'])
+
+    async def test_memory_lru(self):
+        cache = HTTPCache(max_size=300)
+        for path in ('first', 'second', 'first', 'third'):
+            await self.store(cache, get_request(path=f'http://host/{path}'),
+                             body=b'x' * 100,
+                             **{'cache-control': 'max-age=60'})
+        self.assertEqual(['http://host/first', 'http://host/third'],
+                         list(cache._memory))
+        self.assertLessEqual(cache.stats()['memory_bytes'], 300)
+
+    async def test_disk_tier(self):
+        with tempfile.TemporaryDirectory() as disk_dir:
+            cache = HTTPCache(disk_dir=disk_dir)
+            await self.store(cache, get_request(),
+                             **{'cache-control': 'max-age=60'})
+            restarted = HTTPCache(disk_dir=disk_dir)
+            lookup = await restarted.lookup(get_request(), https=False)
+            self.assertTrue(lookup.fresh)
+            self.assertEqual(b'body', lookup.entry.body)
+            self.assertEqual(1, restarted.stats()['entries'])
+            await restarted.invalidate('http://host/a')
+            self.assertEqual(0, restarted.stats()['disk_entries'])
+
+
+class DiskTierTests(IsolatedAsyncioTestCase):
+
+    def test_size_limit(self):
+        with tempfile.TemporaryDirectory() as disk_dir:
+            first = get_entry(body=b'x' * 100)
+            size = len(first.to_bytes())
+            disk = DiskTier(disk_dir, max_size=size * 2)
+            for key in ('first', 'second', 'third'):
+                entry = get_entry(body=b'x' * 100)
+                entry.key = key
+                disk.put(entry)
+            self.assertIsNone(disk.get('first'))
+            self.assertIsNotNone(disk.get('third'))
+            self.assertEqual(2, disk.stats()['disk_entries'])
+            self.assertLessEqual(disk.stats()['disk_bytes'], size * 2)
+
+    def test_broken_file(self):
+        with tempfile.TemporaryDirectory() as disk_dir:
+            disk = DiskTier(disk_dir, max_size=2 ** 20)
+            disk.put(get_entry())
+            with open(disk._path('http://host/a'), 'wb') as f:
+                f.write(b'\0\0\0\5broken')
+            self.assertIsNone(disk.get('http://host/a'))
+            self.assertEqual(0, disk.stats()['disk_entries'])
@@ -0,0 +1,167 @@
+import os
+import sqlite3
+import tempfile
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes
+from cryptography.x509.oid import NameOID
+
+from sslcert import CertificateStore
+from sslcert.sslcreator import generate_certificate, generate_key
+
+
+class CertificateStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.cert_dir = os.path.join(self._tmp.name, 'ssl')
+        self.store = CertificateStore(
+            filename=os.path.join(self._tmp.name, 'certs.sqlite3'),
+            cert_dir=self.cert_dir, grace=0)
+
+    def tearDown(self):
+        self.store.close()
+        self._tmp.cleanup()
+
+    def save(self, serial: str, crt: bytes = b'crt', key: bytes = b'key'):
+        os.makedirs(self.cert_dir, exist_ok=True)
+        Path(self.cert_dir, f'{serial}.crt').write_bytes(crt)
+        Path(self.cert_dir, f'{serial}.key').write_bytes(key)
+
+    def exists(self, serial: str) -> bool:
+        return Path(self.cert_dir, f'{serial}.crt').exists()
+
+    @staticmethod
+    def issue(hostname: str, alt_names: list[str]) -> tuple[bytes, bytes]:
+        ca_key = generate_key()
+        ca_cert = (
+            x509.CertificateBuilder()
+            .subject_name(x509.Name(
+                [x509.NameAttribute(NameOID.COMMON_NAME, 'CA')]))
+            .issuer_name(x509.Name(
+                [x509.NameAttribute(NameOID.COMMON_NAME, 'CA')]))
+            .public_key(ca_key.public_key())
+            .serial_number(1)
+            .not_valid_before(datetime.utcnow())
+            .not_valid_after(datetime.utcnow() + timedelta(days=1))
+            .sign(ca_key, hashes.SHA256())
+        )
+        san = x509.SubjectAlternativeName(
+            [x509.DNSName(name) for name in alt_names])
+        _, cert, key = generate_certificate(ca_cert, ca_key, hostname, san)
+        return cert, key
+
+    def test_lazy_open(self):
+        self.assertFalse(
+            os.path.exists(os.path.join(self._tmp.name, 'certs.sqlite3')))
+        self.assertEqual(0, len(self.store))
+        self.assertTrue(
+            os.path.exists(os.path.join(self._tmp.name, 'certs.sqlite3')))
+
+    def test_put_and_get(self):
+        self.save('1')
+        self.store.put('host', ['alt', 'host'], '1', time.time() + 86400 * 30)
+        self.assertEqual('1', self.store.get('host', ['host', 'alt']))
+        self.assertIsNone(self.store.get('host', ['host']))
+        self.assertIsNone(self.store.get('other', ['other']))
+
+    def test_get_expiring(self):
+        self.save('1')
+        self.store.put('host', ['host'], '1', time.time() + 60)
+        self.assertIsNone(self.store.get('host', ['host']))
+
+    def test_get_without_files(self):
+        self.store.put('host', ['host'], '1', time.time() + 86400 * 30)
+        self.assertIsNone(self.store.get('host', ['host']))
+
+    def test_survives_reopen(self):
+        self.save('1')
+        self.store.put('host', ['host'], '1', time.time() + 86400 * 30)
+        self.store.close()
+        self.assertEqual('1', self.store.get('host', ['host']))
+
+    def test_shared_by_processes(self):
+        self.save('1')
+        self.store.put('host', ['host'], '1', time.time() + 86400 * 30)
+        other = CertificateStore(
+            filename=os.path.join(self._tmp.name, 'certs.sqlite3'),
+            cert_dir=self.cert_dir)
+        try:
+            self.assertEqual('1', other.get('host', ['host']))
+            self.assertEqual('wal', other.db.execute(
+                'PRAGMA journal_mode').fetchone()[0])
+        finally:
+            other.close()
+
+    def test_used_by_threads(self):
+        self.save('1')
+        self.store.put('host', ['host'], '1', time.time() + 86400 * 30)
+        with ThreadPoolExecutor(4) as executor:
+            found = list(executor.map(
+                lambda _: self.store.get('host', ['host']), range(20)))
+        self.assertEqual(['1'] * 20, found)
+
+    def test_collect_expired(self):
+        self.save('1')
+        self.save('2')
+        self.store.put('old', ['old'], '1', time.time() - 1)
+        self.store.put('new', ['new'], '2', time.time() + 86400 * 30)
+        self.assertEqual({'indexed': 0, 'removed': 1},
+                         self.store.collect_garbage())
+        self.assertFalse(self.exists('1'))
+        self.assertTrue(self.exists('2'))
+        self.assertEqual(1, len(self.store))
+
+    def test_collect_indexes_saved_files(self):
+        cert, key = self.issue('host', ['alt', 'host'])
+        self.save('10', cert, key)
+        self.save('11', b'broken', b'key')
+        self.assertEqual({'indexed': 1, 'removed': 1},
+                         self.store.collect_garbage())
+        self.assertEqual('10', self.store.get('host', ['alt', 'host']))
+        self.assertFalse(self.exists('11'))
+
+    def test_collect_replaced(self):
+        cert, key = self.issue('host', ['host'])
+        self.save('1', cert, key)
+        self.save('2')
+        self.store.put('host', ['host'], '2', time.time() + 86400 * 30)
+        self.assertEqual({'indexed': 0, 'removed': 1},
+                         self.store.collect_garbage())
+        self.assertFalse(self.exists('1'))
+        self.assertEqual('2', self.store.get('host', ['host']))
+
+    def test_collect_keeps_recent_files(self):
+        store = CertificateStore(
+            filename=os.path.join(self._tmp.name, 'certs.sqlite3'),
+            cert_dir=self.cert_dir)
+        self.save('1', b'broken')
+        self.assertEqual({'indexed': 0, 'removed': 0},
+                         store.collect_garbage())
+        self.assertTrue(self.exists('1'))
+
+    def test_key_type(self):
+        self.save('1')
+        self.store.put('host', ['host'], '1', time.time() + 86400 * 30,
+                       'ecdsa')
+        self.assertEqual('1', self.store.get('host', ['host'], 'ecdsa'))
+        self.assertIsNone(self.store.get('host', ['host'], 'rsa'))
+
+    def test_migrate_key_type(self):
+        filename = os.path.join(self._tmp.name, 'certs.sqlite3')
+        db = sqlite3.connect(filename)
+        db.execute('CREATE TABLE certificates (hostname TEXT PRIMARY KEY, '
+                   'san TEXT NOT NULL, serial TEXT NOT NULL, '
+                   'not_after REAL NOT NULL)')
+        db.execute('INSERT INTO certificates VALUES (?, ?, ?, ?)',
+                   ('host', 'host', '1', time.time() + 86400 * 30))
+        db.commit()
+        db.close()
+        self.save('1')
+        self.assertEqual('1', self.store.get('host', ['host'], 'rsa'))
+        self.assertIsNone(self.store.get('host', ['host'], 'ecdsa'))
@@ -0,0 +1,266 @@
+import asyncio
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import MagicMock, AsyncMock
+
+from parameterized import parameterized
+
+from proxy.coalescing import RequestCoalescer, Flight, coalescing_key
+from proxy.errors import CloseConnection
+from proxy.httpparser import HTTPRequest, HTTPResponse
+
+
+def get_request(method='GET', **headers) -> HTTPRequest:
+    return HTTPRequest(method=method, path='http://host/a', proto='HTTP/1.1',
+                       host='host', port=80, headers=headers)
+
+
+def get_response(code=200, **headers) -> HTTPResponse:
+    return HTTPResponse(proto='HTTP/1.1', code=code, message='OK',
+                        headers=headers)
+
+
+class CoalescingKeyTests(IsolatedAsyncioTestCase):
+
+    def test_key(self):
+        self.assertEqual(
+            'GET\nhttp://host/a\naccept: \naccept-encoding: gzip, br\n'
+            'accept-language: ',
+            coalescing_key(get_request(**{'accept-encoding': 'gzip,  br'}),
+                           https=False))
+
+    def test_key_method(self):
+        self.assertNotEqual(coalescing_key(get_request(), False),
+                            coalescing_key(get_request('HEAD'), False))
+
+    @parameterized.expand([
+        ('POST', {}),
+        ('GET', {'content-length': '5'}),
+        ('GET', {'transfer-encoding': 'chunked'}),
+        ('GET', {'authorization': 'Basic dXNlcjpwYXNz'}),
+        ('GET', {'cookie': 'session=1'}),
+        ('GET', {'if-none-match': '"v1"'}),
+        ('GET', {'range': 'bytes=0-10'}),
+        ('GET', {'upgrade': 'websocket'}),
+    ])
+    def test_key_not_coalesced(self, method, headers):
+        self.assertIsNone(coalescing_key(get_request(method, **headers),
+                                         https=False))
+
+
+class FlightTests(IsolatedAsyncioTestCase):
+
+    @staticmethod
+    def get_flight(max_size=1024, **headers) -> Flight:
+        return Flight('key', leader=1, request=get_request(**headers),
+                      max_size=max_size)
+
+    async def test_fan_out(self):
+        flight = self.get_flight()
+
+        async def follow():
+            response = await flight.response()
+            return response, [data async for data in flight.content()]
+
+        followers = [asyncio.create_task(follow()) for _ in range(3)]
+        await asyncio.sleep(0)
+        response = get_response(**{'content-length': '4'})
+        flight.publish(response)
+        response.headers['via'] = 'callback of the leader'
+        flight.feed(b'ab')
+        await asyncio.sleep(0)
+        flight.feed(b'cd')
+        flight.finish()
+        for head, content in await asyncio.gather(*followers):
+            self.assertEqual({'content-length': '4'}, head.headers)
+            self.assertEqual([b'ab', b'cd'], content)
+
+    async def test_late_follower(self):
+        flight = self.get_flight()
+        flight.followers = 1
+        flight.publish(get_response())
+        flight.feed(b'ab')
+        flight.finish()
+        self.assertEqual(200, (await flight.response()).code)
+        self.assertEqual([b'ab'], [data async for data in flight.content()])
+
+    async def test_abort_before_response(self):
+        flight = self.get_flight()
+        follower = asyncio.create_task(flight.response())
+        await asyncio.sleep(0)
+        flight.abort()
+        self.assertIsNone(await follower)
+
+    async def test_abort_during_content(self):
+        flight = self.get_flight()
+        flight.publish(get_response())
+        flight.feed(b'ab')
+        flight.abort()
+        with self.assertRaises(CloseConnection):
+            [data async for data in flight.content()]
+
+    def test_not_joinable_after_max_size(self):
+        flight = self.get_flight(max_size=3)
+        flight.publish(get_response())
+        flight.feed(b'ab')
+        self.assertTrue(flight.joinable)
+        flight.feed(b'cd')
+        self.assertFalse(flight.joinable)
+
+    def test_not_kept_without_followers(self):
+        flight = self.get_flight(max_size=3)
+        flight.publish(get_response())
+        flight.feed(b'ab')
+        self.assertEqual([b'ab'], flight._chunks)
+        flight.feed(b'cd')
+        flight.feed(b'ef')
+        self.assertEqual([], flight._chunks)
+        self.assertFalse(flight.needs_content)
+
+    def test_not_kept_if_not_shared(self):
+        flight = self.get_flight()
+        flight.followers = 1
+        flight.publish(get_response(**{'cache-control': 'private'}))
+        self.assertFalse(flight.joinable)
+        self.assertFalse(flight.needs_content)
+        flight.feed(b'ab')
+        self.assertEqual([], flight._chunks)
+
+    def test_kept_size_limited(self):
+        flight = self.get_flight(max_size=4)
+        flight.followers = 1
+        flight.publish(get_response())
+        for data in (b'ab', b'cd', b'ef', b'gh'):
+            flight.feed(data)
+        self.assertEqual([b'ef', b'gh'], flight._chunks)
+        self.assertFalse(flight.replayable)
+        flight.leave()
+        self.assertEqual([], flight._chunks)
+
+    async def test_released_as_read(self):
+        flight = self.get_flight()
+        flight.followers = 1
+        flight.publish(get_response())
+        flight.feed(b'ab')
+        flight.feed(b'cd')
+        content = flight.content()
+        self.assertEqual(b'ab', await anext(content))
+        self.assertEqual([b'ab', b'cd'], flight._chunks)
+        flight.finish()
+        self.assertEqual([b'cd'], flight._chunks)
+        self.assertEqual(b'cd', await anext(content))
+        self.assertEqual([], flight._chunks)
+        with self.assertRaises(StopAsyncIteration):
+            await anext(content)
+
+    async def test_follower_behind_closed(self):
+        flight = self.get_flight(max_size=4)
+        flight.followers = 1
+        flight.publish(get_response())
+        flight.feed(b'ab')
+        content = flight.content()
+        self.assertEqual(b'ab', await anext(content))
+        for data in (b'cd', b'ef', b'gh'):
+            flight.feed(data)
+        with self.assertRaises(CloseConnection):
+            await anext(content)
+
+    @parameterized.expand([
+        (200, {}, True),
+        (304, {}, False),
+        (200, {'set-cookie': 'session=1'}, False),
+        (200, {'cache-control': 'private, max-age=60'}, False),
+        (200, {'cache-control': 'no-store'}, False),
+        (200, {'vary': '*'}, False),
+    ])
+    def test_shared(self, code, headers, expected):
+        flight = self.get_flight()
+        flight.publish(get_response(code, **headers))
+        self.assertEqual(expected, flight.shared)
+        self.assertEqual(expected, flight.is_shared_with(get_request()))
+
+    @parameterized.expand([
+        ({'user-agent': 'a'}, True),
+        ({'user-agent': 'b'}, False),
+        ({}, False),
+    ])
+    def test_shared_with_vary(self, headers, expected):
+        flight = self.get_flight(**{'user-agent': 'a'})
+        flight.publish(get_response(vary='Accept-Encoding, User-Agent'))
+        self.assertEqual(expected,
+                         flight.is_shared_with(get_request(**headers)))
+
+    def test_sink(self):
+        flight = self.get_flight()
+        flight.publish(get_response())
+        target = MagicMock()
+        flight.sink(target).write(b'ab')
+        target.write.assert_called_once_with(b'ab')
+        self.assertEqual([b'ab'], flight._chunks)
+
+    async def test_sink_detached(self):
+        flight = self.get_flight()
+        flight.followers = 1
+        flight.publish(get_response())
+        target = MagicMock()
+        target.drain = AsyncMock(side_effect=ConnectionResetError)
+        sink = flight.sink(target)
+        sink.write(b'ab')
+        await sink.drain()
+        sink.write(b'cd')
+        await sink.drain()
+        self.assertTrue(sink.detached)
+        target.write.assert_called_once_with(b'ab')
+        self.assertEqual([b'ab', b'cd'], flight._chunks)
+
+    async def test_sink_without_followers(self):
+        target = MagicMock()
+        target.drain = AsyncMock(side_effect=ConnectionResetError)
+        with self.assertRaises(ConnectionResetError):
+            await self.get_flight().sink(target).drain()
+
+
+class RequestCoalescerTests(IsolatedAsyncioTestCase):
+
+    def test_lead_and_follow(self):
+        coalescer = RequestCoalescer()
+        self.assertIsNone(coalescer.follow('key'))
+        flight = coalescer.lead('key', 1, get_request())
+        self.assertIs(flight, coalescer.follow('key'))
+        self.assertIs(flight, coalescer.follow('key'))
+        coalescer.finish(flight)
+        self.assertIsNone(coalescer.follow('key'))
+        self.assertEqual({'flights': 1, 'in_flight': 0, 'coalesced': 2,
+                          'alone': 0, 'aborted': 0, 'passes': 0},
+                         coalescer.stats())
+
+    def test_not_joinable(self):
+        coalescer = RequestCoalescer(max_size=1)
+        flight = coalescer.lead('key', 1, get_request())
+        flight.feed(b'ab')
+        self.assertIsNone(coalescer.follow('key'))
+        second = coalescer.lead('key', 2, get_request())
+        coalescer.finish(flight)
+        self.assertIs(second, coalescer.follow('key'))
+
+    def test_pass_not_shared(self):
+        coalescer = RequestCoalescer(pass_ttl=60)
+        flight = coalescer.lead('key', 1, get_request())
+        coalescer.publish(flight, get_response(**{'set-cookie': 'id=1'}))
+        self.assertIsNone(coalescer.follow('key'))
+        self.assertIsNone(coalescer.lead('key', 2, get_request()))
+        self.assertEqual(1, coalescer.stats()['passes'])
+
+    def test_pass_expired(self):
+        coalescer = RequestCoalescer(pass_ttl=0)
+        flight = coalescer.lead('key', 1, get_request())
+        coalescer.publish(flight, get_response(**{'set-cookie': 'id=1'}))
+        self.assertIsNotNone(coalescer.lead('key', 2, get_request()))
+
+    def test_abort(self):
+        coalescer = RequestCoalescer()
+        flight = coalescer.lead('key', 1, get_request())
+        coalescer.abort(flight)
+        coalescer.abort(flight)
+        self.assertTrue(flight.failed)
+        self.assertIsNone(coalescer.follow('key'))
+        self.assertEqual(1, coalescer.stats()['aborted'])
@@ -1,14 +1,27 @@
-import socket
+import asyncio
+import ssl
+import time
 import unittest
 from asyncio import StreamWriter, StreamReader
 from unittest import IsolatedAsyncioTestCase
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, ANY
 
 from features.collector import PasswordCollector
 from proxy.connection import ProxyConnection, get_id
-from proxy.errors import UnresolvedRequest
-from proxy.httpparser import HTTPRequest, HTTPResponse
+from proxy.cache import HTTPCache
+from proxy.coalescing import RequestCoalescer
+from proxy.dns import Resolver
+from proxy.errors import UnresolvedRequest, ConnectionTimeout, \
+    SSLHandshakeError
+from proxy.httpparser import HTTPRequest, HTTPResponse, HTTPCode200
+from proxy.metrics import Timeline
+from proxy.policy import InterceptPolicy
+from proxy.pool import UpstreamPool, UpstreamConnection
+from proxy.timeouts import Timeouts
+from proxy.tls import ClientSSLContext
+from proxy.tuning import SocketOptions
 from sslcert import CertificateCreator
+from sslcert.errors import SSlContextError
 
 
 class ProxyConnectionSyncTests(unittest.TestCase):
@@ -31,7 +44,8 @@ class ProxyConnectionAsyncTests(IsolatedAsyncioTestCase):
                 client_reader=StreamReader(),
                 client_writer=self.get_writer(),
                 close_hook=MagicMock(),
-                password_collector=PasswordCollector())
+                password_collector=PasswordCollector(),
+                resolver=MagicMock(spec=Resolver))
 
             connection._w_target = self.get_writer()
             return connection
@@ -43,7 +57,9 @@ class ProxyConnectionAsyncTests(IsolatedAsyncioTestCase):
                 patch.object(StreamWriter, 'get_extra_info'), \
                 patch.object(StreamWriter, 'close'), \
                 patch.object(StreamWriter, 'wait_closed'):
-            return StreamWriter()
+            writer = StreamWriter()
+        writer._transport = MagicMock()
+        return writer
 
     async def test_init(self):
         connection = self.get_connection()
@@ -107,43 +123,490 @@ class ProxyConnectionAsyncTests(IsolatedAsyncioTestCase):
                              return_value=False) as mock_closing, \
                 patch.object(StreamWriter, 'write') as mock_write, \
                 patch.object(StreamWriter, 'drain') as mock_drain, \
-                patch.object(HTTPRequest, 'from_stream') as mock_parser, \
+                patch.object(HTTPRequest, 'from_stream',
+                             return_value=httprequest) as mock_parser, \
                 patch.object(HTTPRequest, 'del_proxy_head') as mock_del_head:
             self.assertTrue(await connection._http_exchange(source=source,
                                                             target=target,
                                                             server_side=True))
         mock_cb.assert_called_once()
         mock_closing.assert_called()
-        mock_write.assert_called_once_with(bytes(httprequest))
+        mock_write.assert_called_once_with(httprequest.head_bytes())
         mock_drain.assert_called_once()
         mock_drain.assert_awaited()
-        mock_parser.assert_called_once_with(source)
+        mock_parser.assert_called_once_with(
+            source, read_content=False,
+            activity=connection._requests_activity, timeout=10.0)
         mock_del_head.assert_called_once()
 
+    async def test_http_exchange_buffers_inspected_content(self):
+        connection = self.get_connection()
+        source = StreamReader()
+        source.feed_data(b'say=Hi&to=Mom')
+        target = self.get_writer()
+        httprequest = HTTPRequest(
+            method='POST', proto='HTTP/1.1', path='/test',
+            headers={'content-type': 'application/x-www-form-urlencoded',
+                     'content-length': '13'})
+        with patch.object(PasswordCollector, 'add_userdata') as mock_add, \
+                patch.object(StreamWriter, 'get_extra_info'), \
+                patch.object(StreamWriter, 'is_closing', return_value=False), \
+                patch.object(StreamWriter, 'writelines') as mock_write, \
+                patch.object(StreamWriter, 'drain'), \
+                patch.object(HTTPRequest, 'from_stream',
+                             return_value=httprequest):
+            self.assertTrue(await connection._http_exchange(source=source,
+                                                            target=target,
+                                                            server_side=True))
+        mock_add.assert_called_once()
+        self.assertEqual(b'say=Hi&to=Mom', httprequest.content)
+        mock_write.assert_called_once_with([httprequest.head_bytes(),
+                                            b'say=Hi&to=Mom'])
+
     async def test_http_exchange_client_side(self):
         connection = self.get_connection()
         source = StreamReader()
         target = self.get_writer()
-        httpresponse = HTTPResponse(proto='HTTP/1.1', code=200, message='OK')
+        httpresponse = HTTPResponse(proto='HTTP/1.1', code=200, message='OK',
+                                    headers={'content-length': '0'})
+        connection._pending.append((HTTPRequest(method='GET'), None, None,
+                                    Timeline()))
         with patch.object(ProxyConnection, '_response_cb',
                           return_value=httpresponse) as mock_cb, \
                 patch.object(StreamWriter, 'is_closing',
                              return_value=False) as mock_closing, \
                 patch.object(StreamWriter, 'write') as mock_write, \
                 patch.object(StreamWriter, 'drain') as mock_drain, \
-                patch.object(HTTPResponse, 'from_stream') as mock_parser:
+                patch.object(HTTPResponse, 'from_stream',
+                             return_value=httpresponse) as mock_parser:
             self.assertTrue(await connection._http_exchange(source=source,
                                                             target=target,
                                                             server_side=False))
         mock_cb.assert_called_once()
         mock_closing.assert_called()
-        mock_write.assert_called_once_with(bytes(httpresponse))
+        mock_write.assert_called_once_with(httpresponse.head_bytes())
         mock_drain.assert_called_once()
         mock_drain.assert_awaited()
-        mock_parser.assert_called_once_with(source)
+        mock_parser.assert_called_once_with(source, read_content=False)
+        self.assertFalse(connection._pending)
+
+    async def test_http_exchange_client_done(self):
+        connection = self.get_connection()
+        connection._client_done = True
+        with patch.object(StreamWriter, 'is_closing', return_value=False), \
+                patch.object(HTTPResponse, 'from_stream') as mock_parser:
+            self.assertFalse(await connection._http_exchange(
+                source=StreamReader(), target=self.get_writer(),
+                server_side=False))
+        mock_parser.assert_not_called()
+
+    async def test_http_exchange_end_of_stream(self):
+        connection = self.get_connection()
+        source = StreamReader()
+        source.feed_eof()
+        with patch.object(StreamWriter, 'is_closing', return_value=False):
+            self.assertFalse(await connection._http_exchange(
+                source=source, target=self.get_writer(), server_side=True))
+
+    @staticmethod
+    def get_stream(data: bytes) -> StreamReader:
+        stream = StreamReader()
+        stream.feed_data(data)
+        stream.feed_eof()
+        return stream
+
+    async def test_relay_pipelined_requests(self):
+        connection = self.get_connection()
+        connection._reader = self.get_stream(
+            b'GET /1 HTTP/1.1\r\nHost: host\r\n\r\n'
+            b'HEAD /2 HTTP/1.1\r\nHost: host\r\n\r\n'
+            b'GET /3 HTTP/1.1\r\nHost: host\r\n\r\n')
+        connection._r_target = self.get_stream(
+            b'HTTP/1.1 200 OK\r\nContent-Length: 1\r\n\r\n1'
+            b'HTTP/1.1 200 OK\r\nContent-Length: 100\r\n\r\n'
+            b'HTTP/1.1 100 Continue\r\n\r\n'
+            b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'
+            b'1\r\n3\r\n0\r\n\r\n')
+        connection._writer = MagicMock(spec=StreamWriter)
+        connection._writer.is_closing.return_value = False
+        connection._w_target = MagicMock(spec=StreamWriter)
+        connection._w_target.is_closing.return_value = False
+        with patch.object(ProxyConnection, '_request_cb',
+                          side_effect=lambda request: request):
+            await connection._relay()
+
+        def written(writer):
+            return b''.join(c.args[0] for c in writer.write.call_args_list)
+
+        self.assertEqual(
+            b'GET /1 HTTP/1.1\r\nHost: host\r\n\r\n'
+            b'HEAD /2 HTTP/1.1\r\nHost: host\r\n\r\n'
+            b'GET /3 HTTP/1.1\r\nHost: host\r\n\r\n',
+            written(connection._w_target))
+        self.assertEqual(
+            b'HTTP/1.1 200 OK\r\nContent-Length: 1\r\n\r\n1'
+            b'HTTP/1.1 200 OK\r\nContent-Length: 100\r\n\r\n'
+            b'HTTP/1.1 100 Continue\r\n\r\n'
+            b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'
+            b'1\r\n3\r\n0\r\n\r\n',
+            written(connection._writer))
+        self.assertFalse(connection._pending)
+        self.assertTrue(connection._upstream_reusable)
+        metrics = connection._metrics
+        self.assertEqual({200: 3, 100: 1}, metrics.responses)
+        self.assertEqual(len(written(connection._w_target)),
+                         metrics.received_bytes)
+        self.assertEqual(len(written(connection._writer)),
+                         metrics.sent_bytes)
+        self.assertEqual(3, metrics.stats()['first_byte_count'])
+
+    async def test_relay_pipelined_connection_close(self):
+        connection = self.get_connection()
+        connection._reader = self.get_stream(
+            b'GET /a HTTP/1.1\r\nHost: host\r\n\r\n'
+            b'GET /b HTTP/1.1\r\nHost: host\r\nConnection: close\r\n\r\n')
+        connection._r_target = self.get_stream(
+            b'HTTP/1.1 200 OK\r\nContent-Length: 1\r\n\r\na'
+            b'HTTP/1.1 200 OK\r\nConnection: close\r\n'
+            b'Content-Length: 1\r\n\r\nb')
+        connection._writer = MagicMock(spec=StreamWriter)
+        connection._writer.is_closing.return_value = False
+        connection._w_target = MagicMock(spec=StreamWriter)
+        connection._w_target.is_closing.return_value = False
+        with patch.object(ProxyConnection, '_request_cb',
+                          side_effect=lambda request: request):
+            await connection._relay()
+        self.assertEqual(
+            b'HTTP/1.1 200 OK\r\nContent-Length: 1\r\n\r\na'
+            b'HTTP/1.1 200 OK\r\nConnection: close\r\n'
+            b'Content-Length: 1\r\n\r\nb',
+            self.written(connection._writer))
+        self.assertFalse(connection._pending)
+        self.assertFalse(connection._upstream_reusable)
+
+    async def test_relay_slow_request(self):
+        connection = self.get_connection()
+        connection._slow_request = 0.0
+        connection._timeline = None
+        connection._reader = self.get_stream(
+            b'GET /1 HTTP/1.1\r\nHost: host\r\n\r\n')
+        connection._r_target = self.get_stream(
+            b'HTTP/1.1 200 OK\r\nContent-Length: 1\r\n\r\n1')
+        connection._writer = MagicMock(spec=StreamWriter)
+        connection._writer.is_closing.return_value = False
+        connection._w_target = MagicMock(spec=StreamWriter)
+        connection._w_target.is_closing.return_value = False
+        with patch.object(ProxyConnection, '_request_cb',
+                          side_effect=lambda request: request), \
+                self.assertLogs('proxyConnection', 'WARNING') as logs:
+            await connection._relay()
+        [log] = logs.output
+        self.assertIn('Slow request GET host /1: ', log)
+        self.assertRegex(log, r'\(header=[\d.]+ms request=[\d.]+ms '
+                              r'first_byte=[\d.]+ms response=[\d.]+ms\)')
+
+    async def test_relay_access_log(self):
+        connection = self.get_connection()
+        connection._peer = ('127.0.0.1', 5000)
+        connection._reader = self.get_stream(
+            b'GET /a?b=c HTTP/1.1\r\nHost: host\r\n\r\n')
+        connection._r_target = self.get_stream(
+            b'HTTP/1.1 404 Not Found\r\nContent-Length: 1\r\n\r\n1')
+        connection._writer = MagicMock(spec=StreamWriter)
+        connection._writer.is_closing.return_value = False
+        connection._w_target = MagicMock(spec=StreamWriter)
+        connection._w_target.is_closing.return_value = False
+        with patch.object(ProxyConnection, '_request_cb',
+                          side_effect=lambda request: request), \
+                self.assertLogs('accessLog', 'INFO') as logs:
+            await connection._relay()
+        [log] = logs.output
+        self.assertRegex(
+            log, rf'conn={connection.id} client=127.0.0.1:5000 method=GET '
+                 r'scheme=http host=host path="/a\?b=c" status=404 '
+                 r'bytes=\d+ source=origin duration_ms=[\d.]+$')
+
+    async def test_relay_origin_closes(self):
+        connection = self.get_connection()
+        connection._reader = StreamReader()
+        connection._r_target = self.get_stream(
+            b'HTTP/1.1 200 OK\r\n\r\nuntil close')
+        connection._writer = MagicMock(spec=StreamWriter)
+        connection._writer.is_closing.return_value = False
+        connection._pending.append((HTTPRequest(method='GET'), None, None,
+                                    Timeline()))
+        await connection._relay()
+        self.assertEqual(b'until close',
+                         connection._writer.write.call_args_list[-1].args[0])
+        self.assertFalse(connection._upstream_reusable)
+
+    async def test_relay_cached_response(self):
+        connection = self.get_connection()
+        connection._cache = HTTPCache()
+        connection._reader = self.get_stream(
+            b'GET /1 HTTP/1.1\r\nHost: host\r\n\r\n')
+        connection._r_target = self.get_stream(
+            b'HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\n'
+            b'Content-Length: 2\r\n\r\nok')
+        connection._writer = MagicMock(spec=StreamWriter)
+        connection._writer.is_closing.return_value = False
+        connection._w_target = MagicMock(spec=StreamWriter)
+        connection._w_target.is_closing.return_value = False
+        with patch.object(ProxyConnection, '_request_cb',
+                          side_effect=lambda request: request):
+            await connection._relay()
+            connection._reader = self.get_stream(
+                b'GET /1 HTTP/1.1\r\nHost: host\r\n\r\n'
+                b'POST /1 HTTP/1.1\r\nHost: host\r\n'
+                b'Content-Length: 0\r\n\r\n')
+            connection._r_target = self.get_stream(
+                b'HTTP/1.1 204 No Content\r\n\r\n')
+            await connection._relay()
+        self.assertEqual(2, connection._w_target.write.call_count)
+        self.assertTrue(connection._w_target.write.call_args_list[-1]
+                        .args[0].startswith(b'POST /1 '))
+        head, content = connection._writer.writelines.call_args.args[0]
+        self.assertTrue(head.startswith(b'HTTP/1.1 200 OK\r\n'))
+        self.assertIn(b'age: 0\r\n', head)
+        self.assertTrue(head.endswith(b'\r\n\r\n'))
+        self.assertEqual(b'ok', content)
+        self.assertEqual({'hits': 1, 'entries': 0},
+                         {k: v for k, v in connection._cache.stats().items()
+                          if k in ('hits', 'entries')})
+        self.assertFalse(connection._pending)
+        self.assertEqual({200: 2, 204: 1}, connection._metrics.responses)
+
+    async def test_create_connection_cache_hit(self):
+        connection = self.get_connection()
+        connection._cache = HTTPCache()
+        connection._w_target = None
+        request = b'GET /1 HTTP/1.1\r\nHost: host\r\n\r\n'
+        stored = await HTTPRequest().from_stream(self.get_stream(request))
+        lookup = await connection._cache.lookup(stored, https=False)
+        await connection._cache.store(lookup, stored, HTTPResponse(
+            proto='HTTP/1.1', code=200, message='OK',
+            headers={'cache-control': 'max-age=60',
+                     'content-length': '2'}), b'ok', time.time())
+        connection._reader = self.get_stream(request)
+        connection._writer = MagicMock(spec=StreamWriter)
+        connection._writer.is_closing.return_value = False
+        with patch.object(ProxyConnection, '_request_cb',
+                          side_effect=lambda request: request), \
+                patch.object(SocketOptions, 'open_connection') as mock_open:
+            await connection._create_connection()
+        mock_open.assert_not_called()
+        connection._resolver.resolve.assert_not_called()
+        self.assertIsNone(connection._w_target)
+        _, content = connection._writer.writelines.call_args.args[0]
+        self.assertEqual(b'ok', content)
+
+    async def test_relay_cache_hit_connection_close(self):
+        connection = self.get_connection()
+        connection._cache = HTTPCache()
+        stored = await HTTPRequest().from_stream(self.get_stream(
+            b'GET /1 HTTP/1.1\r\nHost: host\r\n\r\n'))
+        lookup = await connection._cache.lookup(stored, https=False)
+        await connection._cache.store(lookup, stored, HTTPResponse(
+            proto='HTTP/1.1', code=200, message='OK',
+            headers={'cache-control': 'max-age=60',
+                     'content-length': '2'}), b'ok', time.time())
+        # The request after Connection: close is not read.
+        connection._reader = self.get_stream(
+            b'GET /1 HTTP/1.1\r\nHost: host\r\nConnection: close\r\n\r\n'
+            b'GET /2 HTTP/1.1\r\nHost: host\r\n\r\n')
+        connection._writer = MagicMock(spec=StreamWriter)
+        connection._writer.is_closing.return_value = False
+        connection._w_target = MagicMock(spec=StreamWriter)
+        connection._w_target.is_closing.return_value = False
+        with patch.object(ProxyConnection, '_request_cb',
+                          side_effect=lambda request: request):
+            await asyncio.wait_for(connection._relay(), 1)
+        connection._w_target.write.assert_not_called()
+        head, content = connection._writer.writelines.call_args.args[0]
+        self.assertIn(b'connection: close\r\n', head)
+        self.assertEqual(b'ok', content)
+        self.assertFalse(connection._pending)
+
+    def get_upgrade_relay(self, requests: bytes,
+                          responses: bytes) -> ProxyConnection:
+        connection = self.get_connection()
+        connection._reader = self.get_stream(requests)
+        connection._r_target = self.get_stream(responses)
+        connection._writer = MagicMock(spec=StreamWriter)
+        connection._writer.is_closing.return_value = False
+        connection._w_target = MagicMock(spec=StreamWriter)
+        connection._w_target.is_closing.return_value = False
+        return connection
+
+    @staticmethod
+    def written(writer: MagicMock) -> bytes:
+        return b''.join(c.args[0] for c in writer.write.call_args_list)
+
+    async def test_relay_switching_protocols(self):
+        request = b'GET /ws HTTP/1.1\r\nHost: host\r\n' \
+                  b'Connection: Upgrade\r\nUpgrade: websocket\r\n\r\n'
+        response = b'HTTP/1.1 101 Switching Protocols\r\n' \
+                   b'Connection: Upgrade\r\nUpgrade: websocket\r\n\r\n'
+        connection = self.get_upgrade_relay(
+            request + b'GET /not-http HTTP/1.1\r\n\r\n\x81\x02hi',
+            response + b'\x81\x05hello')
+        connection._tunnel_idle_timeout = 5.0
+        with patch.object(ProxyConnection, '_request_cb',
+                          side_effect=lambda request: request):
+            await connection._relay()
+        self.assertEqual(request + b'GET /not-http HTTP/1.1\r\n\r\n'
+                                   b'\x81\x02hi',
+                         self.written(connection._w_target))
+        self.assertEqual(response + b'\x81\x05hello',
+                         self.written(connection._writer))
+        self.assertTrue(connection._switched)
+        self.assertFalse(connection._upstream_reusable)
+        self.assertFalse(connection._pending)
+
+    async def test_relay_first_request_upgraded(self):
+        request = b'GET /ws HTTP/1.1\r\nHost: host\r\n' \
+                  b'Connection: Upgrade\r\nUpgrade: websocket\r\n\r\n'
+        connection = self.get_upgrade_relay(
+            request + b'GET /not-http HTTP/1.1\r\n\r\n',
+            b'HTTP/1.1 101 Switching Protocols\r\n\r\n')
+        first = await HTTPRequest().from_stream(source=connection._reader,
+                                                read_content=False)
+        with patch.object(ProxyConnection, '_request_cb',
+                          side_effect=lambda request: request):
+            connection._expect_upgrade(first)
+            await connection._send_request(first, source=connection._reader,
+                                           timeline=Timeline())
+            await connection._relay()
+        self.assertEqual(request + b'GET /not-http HTTP/1.1\r\n\r\n',
+                         self.written(connection._w_target))
+        self.assertTrue(connection._switched)
+
+    async def test_relay_upgrade_refused(self):
+        request = b'GET /ws HTTP/1.1\r\nHost: host\r\n' \
+                  b'Connection: Upgrade\r\nUpgrade: websocket\r\n\r\n'
+        connection = self.get_upgrade_relay(
+            request + b'GET /2 HTTP/1.1\r\nHost: host\r\n\r\n',
+            b'HTTP/1.1 426 Upgrade Required\r\nContent-Length: 0\r\n\r\n'
+            b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok')
+        with patch.object(ProxyConnection, '_request_cb',
+                          side_effect=lambda request: request):
+            await connection._relay()
+        self.assertEqual(request + b'GET /2 HTTP/1.1\r\nHost: host\r\n\r\n',
+                         self.written(connection._w_target))
+        self.assertTrue(self.written(connection._writer).endswith(b'ok'))
+        self.assertFalse(connection._switched)
+
+    async def test_pump_requests_idle(self):
+        connection = self.get_connection()
+        connection._timeouts = Timeouts(idle=0.01)
+        connection._w_target._transport.is_closing.return_value = False
+        await connection._pump_requests()
+        connection._w_target._transport.is_closing.return_value = True
+        self.assertTrue(connection._client_done)
+        self.assertTrue(connection._requests_activity.timed_out)
+
+    async def test_pump_requests_header_timeout(self):
+        connection = self.get_connection()
+        connection._timeouts = Timeouts(header=0.01)
+        connection._w_target._transport.is_closing.return_value = False
+        connection._reader.feed_data(b'GET / HTTP/1.1\r\nHost: host\r\n')
+        with self.assertRaises(ConnectionTimeout):
+            await connection._pump_requests()
+        connection._w_target._transport.is_closing.return_value = True
+
+    def get_relay(self, requests: bytes,
+                  coalescer: RequestCoalescer) -> ProxyConnection:
+        connection = self.get_connection()
+        connection._coalescer = coalescer
+        connection._reader = self.get_stream(requests)
+        connection._r_target = StreamReader()
+        connection._writer = MagicMock(spec=StreamWriter)
+        connection._writer.is_closing.return_value = False
+        connection._w_target = MagicMock(spec=StreamWriter)
+        connection._w_target.is_closing.return_value = False
+        return connection
+
+    @staticmethod
+    async def respond(connection: ProxyConnection, response: bytes,
+                      coalescer: RequestCoalescer):
+        """
+        The origin responds after the follower has joined the flight.
+        """
+        while not coalescer.coalesced:
+            await asyncio.sleep(0)
+        connection._r_target.feed_data(response)
+        connection._r_target.feed_eof()
+
+    async def test_relay_coalesced(self):
+        coalescer = RequestCoalescer()
+        request = b'GET /1 HTTP/1.1\r\nHost: host\r\n\r\n'
+        leader = self.get_relay(request, coalescer)
+        follower = self.get_relay(request, coalescer)
+        with patch.object(ProxyConnection, '_request_cb',
+                          side_effect=lambda request: request):
+            await asyncio.gather(
+                leader._relay(), follower._relay(),
+                self.respond(leader, b'HTTP/1.1 200 OK\r\n'
+                                     b'Content-Length: 2\r\n\r\nok',
+                             coalescer))
+        leader._w_target.write.assert_called_once()
+        follower._w_target.write.assert_not_called()
+        for connection in (leader, follower):
+            self.assertEqual(
+                [b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\n', b'ok'],
+                [c.args[0] for c in connection._writer.write.call_args_list])
+        self.assertEqual(1, coalescer.stats()['coalesced'])
+
+    async def test_send_coalesced_connection_close(self):
+        connection = self.get_connection()
+        connection._coalescer = RequestCoalescer()
+        target = MagicMock(spec=StreamWriter)
+        for headers, keep_alive in (({}, True),
+                                    ({'connection': 'close'}, False)):
+            request = HTTPRequest(method='GET', proto='HTTP/1.1', path='/1',
+                                  host='host', port=80, headers=headers)
+            flight = connection._coalescer.lead('key', 1, request)
+            flight.followers = 1
+            connection._coalescer.publish(flight, HTTPResponse(
+                proto='HTTP/1.1', code=200, message='OK',
+                headers={'content-length': '2'}))
+            flight.feed(b'ok')
+            connection._coalescer.finish(flight)
+            self.assertEqual(keep_alive, await connection._send_coalesced(
+                request, flight, target))
+        self.assertEqual(0, connection._coalescer.stats()['alone'])
+
+    async def test_relay_coalesced_not_shared(self):
+        coalescer = RequestCoalescer()
+        request = b'GET /1 HTTP/1.1\r\nHost: host\r\n\r\n'
+        leader = self.get_relay(request, coalescer)
+        follower = self.get_relay(request, coalescer)
+        with patch.object(ProxyConnection, '_request_cb',
+                          side_effect=lambda request: request), \
+                patch.object(ProxyConnection, '_fetch_alone',
+                             return_value=True) as mock_fetch:
+            await asyncio.gather(
+                leader._relay(), follower._relay(),
+                self.respond(leader, b'HTTP/1.1 200 OK\r\n'
+                                     b'Set-Cookie: id=1\r\n'
+                                     b'Content-Length: 2\r\n\r\nok',
+                             coalescer))
+        mock_fetch.assert_awaited_once()
+        self.assertEqual(1, coalescer.stats()['alone'])
+
+    async def test_close_aborts_flight(self):
+        coalescer = RequestCoalescer()
+        connection = self.get_connection()
+        connection._coalescer = coalescer
+        flight = coalescer.lead('key', connection.id, HTTPRequest())
+        connection._pending.append((HTTPRequest(), None, flight, Timeline()))
+        with patch.object(ProxyConnection, '_close_connections'):
+            await connection.close()
+        self.assertTrue(flight.failed)
 
     async def test_create_connection_http(self):
         connection = self.get_connection()
+        connection._w_target = None
         httprequest = HTTPRequest(method='GET', proto='HTTP/1.1', path='/test',
                                   host='host', port=12345)
         with patch.object(StreamWriter, 'write') as mock_write, \
@@ -151,23 +614,28 @@ class ProxyConnectionAsyncTests(IsolatedAsyncioTestCase):
                 patch.object(StreamWriter, 'drain') as mock_drain, \
                 patch.object(HTTPRequest, 'from_stream',
                              return_value=httprequest) as mock_parser, \
+                patch.object(ProxyConnection, '_request_cb',
+                             return_value=httprequest) as mock_cb, \
                 patch.object(ProxyConnection, '_http_exchange',
                              return_value=False) as mock_exchange, \
-                patch('asyncio.open_connection',
-                      return_value=(StreamReader(),
-                                    self.get_writer())) as mock_open:
+                patch.object(SocketOptions, 'open_connection',
+                             return_value=(StreamReader(),
+                                           self.get_writer())) as mock_open:
             await connection._create_connection()
 
         self.assertFalse(connection._https)
+        mock_cb.assert_called_once_with(httprequest)
         mock_open.assert_called_once_with(
             host=httprequest.host,
             port=httprequest.port,
-            family=socket.AF_INET)
+            resolver=connection._resolver,
+            timeline=ANY)
         mock_get.assert_called_once_with('peername')
-        mock_write.assert_called_once_with(bytes(httprequest))
+        mock_write.assert_called_once_with(httprequest.head_bytes())
         mock_drain.assert_called_once()
         mock_drain.assert_awaited()
-        mock_parser.assert_called_once_with(source=connection._reader)
+        mock_parser.assert_called_once_with(source=connection._reader,
+                                            read_content=False)
         mock_exchange.assert_called()
 
     async def test_create_connection_https(self):
@@ -180,21 +648,113 @@ class ProxyConnectionAsyncTests(IsolatedAsyncioTestCase):
                 patch.object(ProxyConnection, '_http_exchange',
                              return_value=False) as mock_exchange, \
                 patch.object(ProxyConnection, '_open_tls') as mock_tls, \
-                patch('asyncio.open_connection',
-                      return_value=(StreamReader(),
-                                    self.get_writer())) as mock_open:
+                patch.object(SocketOptions, 'open_connection',
+                             return_value=(StreamReader(),
+                                           self.get_writer())) as mock_open:
             await connection._create_connection()
 
         self.assertTrue(connection._https)
         mock_open.assert_called_once_with(
             host=httprequest.host,
             port=httprequest.port,
-            family=socket.AF_INET)
+            resolver=connection._resolver,
+            timeline=ANY)
         mock_get.assert_called_once_with('peername')
         mock_tls.assert_called_once_with(target_host=httprequest.host)
-        mock_parser.assert_called_once_with(source=connection._reader)
+        mock_parser.assert_called_once_with(source=connection._reader,
+                                            read_content=False)
         mock_exchange.assert_called()
 
+    async def test_create_connection_bypass(self):
+        connection = self.get_connection()
+        connection._policy = InterceptPolicy(bypass_hosts=['host'])
+        httprequest = HTTPRequest(method='CONNECT', proto='HTTP/1.1',
+                                  path='host:443', host='host', port=443)
+        with patch.object(StreamWriter, 'get_extra_info',
+                          return_value=('10.0.0.1', 443)), \
+                patch.object(HTTPRequest, 'from_stream',
+                             return_value=httprequest), \
+                patch.object(ProxyConnection, '_open_tls') as mock_tls, \
+                patch.object(ProxyConnection, '_relay') as mock_relay, \
+                patch.object(StreamWriter, 'write') as mock_write, \
+                patch.object(StreamWriter, 'drain'), \
+                patch('proxy.connection.splice',
+                      return_value=(1, 2)) as mock_splice, \
+                patch('asyncio.open_connection',
+                      return_value=(StreamReader(), self.get_writer())):
+            await connection._create_connection()
+
+        self.assertTrue(connection._https)
+        mock_write.assert_called_once_with(bytes(HTTPCode200))
+        mock_splice.assert_called_once_with(
+            connection._reader, connection._writer,
+            connection._r_target, connection._w_target, 65536, ANY)
+        mock_tls.assert_not_called()
+        mock_relay.assert_not_called()
+
+    async def test_open_tls_shared_creator(self):
+        connection = self.get_connection()
+        connection._cert_creator = MagicMock(spec=CertificateCreator)
+        cert = {'subject': ((('commonName', 'host'),),)}
+        with patch.object(StreamWriter, 'get_extra_info',
+                          return_value=cert), \
+                patch.object(StreamWriter, 'write'), \
+                patch.object(StreamWriter, 'drain'), \
+                patch.object(ProxyConnection, '_start_tls') as mock_tls:
+            await connection._open_tls(target_host='host')
+
+        connection._cert_creator.get_sslcontext.assert_called_once_with(
+            'host', cert)
+        self.assertEqual(2, mock_tls.call_count)
+        self.assertEqual('host',
+                         mock_tls.call_args_list[0].kwargs['server_hostname'])
+
+    async def test_start_tls_counts_handshakes(self):
+        connection = self.get_connection()
+        writer = MagicMock(spec=StreamWriter)
+        await connection._start_tls(writer, context=MagicMock(),
+                                    server_side=True)
+        error = ssl.SSLError()
+        error.reason = 'SSLV3_ALERT_HANDSHAKE_FAILURE'
+        writer.start_tls.side_effect = error
+        with self.assertRaises(SSLHandshakeError):
+            await connection._start_tls(writer, context=MagicMock(),
+                                        server_side=False,
+                                        server_hostname='host')
+        self.assertEqual({('client', 'ok'): 1, ('client', 'failed'): 0,
+                          ('origin', 'ok'): 0, ('origin', 'failed'): 1},
+                         connection._metrics.handshakes)
+
+    async def test_open_tls_shared_client_context(self):
+        connection = self.get_connection()
+        connection._cert_creator = MagicMock(spec=CertificateCreator)
+        connection._client_context = MagicMock(spec=ClientSSLContext)
+        with patch.object(StreamWriter, 'get_extra_info',
+                          return_value={'subject': ()}), \
+                patch.object(StreamWriter, 'write'), \
+                patch.object(StreamWriter, 'drain'), \
+                patch.object(StreamWriter, 'close'), \
+                patch.object(StreamWriter, 'wait_closed'), \
+                patch.object(ProxyConnection, '_start_tls') as mock_tls:
+            await connection._open_tls(target_host='host')
+            await connection._close_connections()
+
+        mock_tls.assert_any_call(stream=connection._w_target,
+                                 context=connection._client_context,
+                                 server_side=False, server_hostname='host')
+        connection._client_context.handshake_done.assert_called_once()
+        connection._client_context.save_session.assert_called_once()
+
+    async def test_open_tls_without_creator(self):
+        connection = self.get_connection()
+        with patch.object(StreamWriter, 'get_extra_info',
+                          return_value={'subject': ()}), \
+                patch.object(StreamWriter, 'write'), \
+                patch.object(StreamWriter, 'drain'), \
+                patch.object(ProxyConnection, '_start_tls'), \
+                self.assertRaises(SSlContextError):
+            await connection._open_tls(target_host='host')
+
     async def test_create_connection_exc(self):
         connection = self.get_connection()
         httprequest = HTTPRequest(method=None, proto='HTTP/1.1',
@@ -206,4 +766,79 @@ class ProxyConnectionAsyncTests(IsolatedAsyncioTestCase):
             await connection._create_connection()
 
         mock_get.assert_called_once_with('peername')
-        mock_parser.assert_called_once_with(source=connection._reader)
+        mock_parser.assert_called_once_with(source=connection._reader,
+                                            read_content=False)
+
+    async def test_create_connection_http_pooled(self):
+        connection = self.get_connection()
+        connection._w_target = None
+        connection._upstream_pool = UpstreamPool()
+        upstream = UpstreamConnection(host='host', port=12345,
+                                      reader=StreamReader(),
+                                      writer=self.get_writer())
+        httprequest = HTTPRequest(method='GET', proto='HTTP/1.1', path='/test',
+                                  host='host', port=12345)
+        with patch.object(StreamWriter, 'write'), \
+                patch.object(StreamWriter, 'drain'), \
+                patch.object(HTTPRequest, 'from_stream',
+                             return_value=httprequest), \
+                patch.object(ProxyConnection, '_request_cb',
+                             return_value=httprequest), \
+                patch.object(ProxyConnection, '_http_exchange',
+                             return_value=False), \
+                patch.object(UpstreamPool, 'acquire',
+                             return_value=upstream) as mock_acquire:
+            await connection._create_connection()
+        self.assertIs(upstream.writer, connection._w_target)
+        [(request, lookup, flight, timeline)] = connection._pending
+        mock_acquire.assert_called_once_with('host', 12345, timeline)
+        self.assertEqual((httprequest, None, None),
+                         (request, lookup, flight))
+        # The pool marks 'dns' when it opens a connection.
+        self.assertEqual(['header', 'connect', 'request'],
+                         [stage for stage, _ in timeline.marks])
+        self.assertIsNone(connection._timeline)
+
+    async def test_track_response(self):
+        connection = self.get_connection()
+        connection._pending.extend(['GET', 'GET'])
+        connection._track_response(
+            HTTPResponse(proto='HTTP/1.1', code=100, message='Continue'))
+        self.assertEqual(2, len(connection._pending))
+        connection._track_response(
+            HTTPResponse(proto='HTTP/1.1', code=200, message='OK',
+                         headers={'content-length': '0'}))
+        self.assertEqual(1, len(connection._pending))
+        self.assertTrue(connection._upstream_reusable)
+        connection._track_response(
+            HTTPResponse(proto='HTTP/1.1', code=200, message='OK'))
+        self.assertFalse(connection._pending)
+        self.assertFalse(connection._upstream_reusable)
+
+    async def test_close_connections_releases_upstream(self):
+        connection = self.get_connection()
+        connection._upstream_pool = UpstreamPool()
+        connection._upstream = UpstreamConnection(
+            host='host', port=80, reader=StreamReader(),
+            writer=connection._w_target)
+        with patch.object(UpstreamPool, 'release') as mock_release, \
+                patch.object(StreamWriter, 'close') as mock_close, \
+                patch.object(StreamWriter, 'wait_closed'):
+            await connection._close_connections()
+        mock_release.assert_called_once()
+        self.assertTrue(mock_release.call_args.kwargs['reusable'])
+        mock_close.assert_called_once()
+        self.assertIsNone(connection._upstream)
+
+    async def test_close_connections_with_pending_response(self):
+        connection = self.get_connection()
+        connection._upstream_pool = UpstreamPool()
+        connection._upstream = UpstreamConnection(
+            host='host', port=80, reader=StreamReader(),
+            writer=connection._w_target)
+        connection._pending.append('GET')
+        with patch.object(UpstreamPool, 'release') as mock_release, \
+                patch.object(StreamWriter, 'close'), \
+                patch.object(StreamWriter, 'wait_closed'):
+            await connection._close_connections()
+        self.assertFalse(mock_release.call_args.kwargs['reusable'])
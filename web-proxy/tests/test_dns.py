@@ -0,0 +1,219 @@
+import asyncio
+import socket
+import sys
+from unittest import IsolatedAsyncioTestCase, TestCase
+from unittest.mock import patch, MagicMock, AsyncMock
+
+from proxy.dns import Resolver, _interleave
+from proxy.errors import UnresolvedHost
+from proxy.metrics import Timeline
+
+V4 = (socket.AF_INET, ('127.0.0.1', 80))
+V6 = (socket.AF_INET6, ('::1', 80, 0, 0))
+
+
+class InterleaveTests(TestCase):
+
+    def test_interleave(self):
+        second_v4 = (socket.AF_INET, ('127.0.0.2', 80))
+        self.assertEqual([V6, V4, second_v4],
+                         _interleave([V6, V4, second_v4]))
+        self.assertEqual([V4, V6, second_v4],
+                         _interleave([V4, second_v4, V6]))
+
+    def test_empty(self):
+        self.assertEqual([], _interleave([]))
+
+
+class BackendTests(TestCase):
+
+    def test_aiodns(self):
+        with patch.dict(sys.modules, {'aiodns': MagicMock()}):
+            self.assertEqual('aiodns', Resolver(backend='auto').backend)
+
+    def test_aiodns_not_installed(self):
+        with patch.dict(sys.modules, {'aiodns': None}):
+            self.assertEqual('system', Resolver(backend='auto').backend)
+            with self.assertLogs('resolver', 'WARNING'):
+                self.assertEqual('system',
+                                 Resolver(backend='aiodns').backend)
+
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            Resolver(backend='dnspython')
+
+
+class ResolverAsyncTests(IsolatedAsyncioTestCase):
+
+    def get_resolver(self, **kwargs) -> Resolver:
+        return Resolver(backend='system', **kwargs)
+
+    async def test_resolve_cached(self):
+        resolver = self.get_resolver()
+        with patch.object(Resolver, '_getaddrinfo',
+                          return_value=[V6, V4]) as mock_query:
+            self.assertEqual([V6, V4], await resolver.resolve('host', 80))
+            self.assertEqual([V6, V4], await resolver.resolve('host', 80))
+        mock_query.assert_awaited_once_with('host', 80)
+        self.assertEqual((1, 1), (resolver.misses, resolver.hits))
+        self.assertEqual(1, resolver.stats()['entries'])
+
+    async def test_resolve_expired(self):
+        resolver = self.get_resolver(ttl=10)
+        with patch.object(Resolver, '_getaddrinfo', return_value=[V4]), \
+                patch('time.monotonic', return_value=100.0) as mock_time:
+            await resolver.resolve('host', 80)
+            mock_time.return_value = 111.0
+            await resolver.resolve('host', 80)
+        self.assertEqual((2, 0), (resolver.misses, resolver.hits))
+
+    async def test_resolve_failure_cached(self):
+        resolver = self.get_resolver()
+        with patch.object(Resolver, '_getaddrinfo',
+                          side_effect=socket.gaierror('unknown')) \
+                as mock_query:
+            with self.assertRaises(UnresolvedHost):
+                await resolver.resolve('host', 80)
+            with self.assertRaisesRegex(UnresolvedHost, 'cached'):
+                await resolver.resolve('host', 80)
+        mock_query.assert_awaited_once()
+        self.assertEqual((1, 1), (resolver.failures, resolver.negative_hits))
+
+    async def test_resolve_evicts_least_recent(self):
+        resolver = self.get_resolver(max_entries=2)
+        with patch.object(Resolver, '_getaddrinfo', return_value=[V4]):
+            for host in ('first', 'second', 'first', 'third'):
+                await resolver.resolve(host, 80)
+        self.assertEqual([('first', 80), ('third', 80)],
+                         list(resolver._entries))
+
+    async def test_resolve_without_cache(self):
+        resolver = self.get_resolver(max_entries=0)
+        with patch.object(Resolver, '_getaddrinfo', return_value=[V4]):
+            await resolver.resolve('host', 80)
+            await resolver.resolve('host', 80)
+        self.assertEqual((2, 0), (resolver.misses, resolver.hits))
+
+    async def test_resolve_shares_query(self):
+        resolver = self.get_resolver()
+        answered = asyncio.Event()
+
+        async def query(*_):
+            await answered.wait()
+            return [V4]
+
+        with patch.object(Resolver, '_getaddrinfo',
+                          side_effect=query) as mock_query:
+            lookups = asyncio.gather(resolver.resolve('host', 80),
+                                     resolver.resolve('host', 80))
+            await asyncio.sleep(0)
+            answered.set()
+            self.assertEqual([[V4], [V4]], await lookups)
+        mock_query.assert_called_once()
+        self.assertEqual(dict(), resolver._queries)
+
+    async def test_resolve_literal(self):
+        resolver = self.get_resolver()
+        with patch.object(Resolver, '_getaddrinfo') as mock_query:
+            self.assertEqual([V4], await resolver.resolve('127.0.0.1', 80))
+            self.assertEqual([V6], await resolver.resolve('[::1]', 80))
+        mock_query.assert_not_called()
+        self.assertEqual(0, resolver.stats()['entries'])
+
+    async def test_resolve_empty_host(self):
+        with self.assertRaises(UnresolvedHost):
+            await self.get_resolver().resolve('', 80)
+
+    async def test_resolve_system(self):
+        addresses = await self.get_resolver().resolve('localhost', 80)
+        self.assertIn(V4, addresses)
+
+    async def test_resolve_aiodns(self):
+        aiodns = MagicMock()
+        aiodns.DNSResolver.return_value.query = AsyncMock(side_effect=[
+            [MagicMock(host='::1', ttl=300)],
+            [MagicMock(host='127.0.0.1', ttl=30)]
+        ])
+        with patch.dict(sys.modules, {'aiodns': aiodns}), \
+                patch('time.monotonic', return_value=100.0):
+            resolver = Resolver(backend='aiodns')
+            self.assertEqual([V6, V4], await resolver.resolve('host', 80))
+        self.assertEqual(130.0, resolver._entries['host', 80][1])
+
+    async def test_resolve_aiodns_unknown_name(self):
+        aiodns = MagicMock()
+        aiodns.DNSResolver.return_value.query = AsyncMock(
+            side_effect=Exception('not found'))
+        with patch.dict(sys.modules, {'aiodns': aiodns}), \
+                patch.object(Resolver, '_getaddrinfo',
+                             return_value=[V4]) as mock_query:
+            resolver = Resolver(backend='aiodns')
+            self.assertEqual([V4], await resolver.resolve('host', 80))
+        mock_query.assert_awaited_once_with('host', 80)
+
+
+class ConnectAsyncTests(IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.server = await asyncio.start_server(
+            lambda reader, writer: writer.close(), '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            self.closed_port = sock.getsockname()[1]
+
+    async def asyncTearDown(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def test_connect(self):
+        resolver = Resolver(backend='system')
+        sock = await resolver.connect('127.0.0.1', self.port)
+        with sock:
+            self.assertEqual(('127.0.0.1', self.port), sock.getpeername())
+        self.assertEqual((1, 0), (resolver.connects, resolver.fallbacks))
+
+    async def test_connect_marks_dns(self):
+        resolver = Resolver(backend='system', max_entries=0)
+        timeline = Timeline()
+        with patch.object(Resolver, '_getaddrinfo',
+                          return_value=[(socket.AF_INET,
+                                         ('127.0.0.1', self.port))]) \
+                as mock_query:
+            sock = await resolver.connect('host', self.port, timeline)
+        sock.close()
+        mock_query.assert_awaited_once_with('host', self.port)
+        self.assertEqual(['dns'], [stage for stage, _ in timeline.marks])
+
+    async def test_connect_falls_back(self):
+        resolver = Resolver(backend='system', happy_eyeballs_delay=10)
+        addresses = [(socket.AF_INET, ('127.0.0.1', self.closed_port)),
+                     (socket.AF_INET, ('127.0.0.1', self.port))]
+        with patch.object(Resolver, 'resolve', return_value=addresses):
+            sock = await asyncio.wait_for(resolver.connect('host', 80), 1)
+        with sock:
+            self.assertEqual(('127.0.0.1', self.port), sock.getpeername())
+        self.assertEqual(1, resolver.fallbacks)
+
+    async def test_connect_overtakes_slow_address(self):
+        resolver = Resolver(backend='system', happy_eyeballs_delay=0.01)
+        fast = MagicMock(spec=socket.socket)
+        slow = asyncio.Event()
+
+        async def attempt(address):
+            if address is V6:
+                await slow.wait()
+            return fast
+
+        with patch.object(Resolver, 'resolve', return_value=[V6, V4]), \
+                patch.object(Resolver, '_attempt', side_effect=attempt):
+            self.assertIs(fast, await asyncio.wait_for(
+                resolver.connect('host', 80), 1))
+        self.assertEqual(1, resolver.fallbacks)
+
+    async def test_connect_fails(self):
+        resolver = Resolver(backend='system')
+        addresses = [(socket.AF_INET, ('127.0.0.1', self.closed_port))]
+        with patch.object(Resolver, 'resolve', return_value=addresses), \
+                self.assertRaisesRegex(OSError, 'Could not connect'):
+            await resolver.connect('host', 80)
@@ -1,11 +1,15 @@
+import asyncio
 import unittest
+from dataclasses import replace
 from unittest import IsolatedAsyncioTestCase
+from unittest.mock import MagicMock, patch
 
 from parameterized import parameterized
 
 from proxy.httpparser import *
+from proxy.timeouts import Activity
 from proxy.httpparser import _parse_headers, \
-    _read_chunked_content, _read_first_line_and_headers
+    _read_chunked_content, _read_head
 
 
 class ParserTests(unittest.TestCase):
@@ -67,9 +71,35 @@ class ParserTests(unittest.TestCase):
                                 expected: bytes, content: bytes):
         httpproperty = HTTPProperty()
         httpproperty.headers['content-encoding'] = encoding
-        httpproperty.content = content
-        httpproperty._decompress_content()
+        httpproperty.raw_content = content
+        self.assertEqual(expected, httpproperty._decompress_content())
         self.assertEqual(expected, httpproperty.content)
+        self.assertEqual(content, httpproperty.raw_content)
+
+    def test_unchanged_content_is_not_encoded_again(self):
+        httpresponse = HTTPResponse(proto='HTTP/1.1', code=200, message='OK')
+        httpresponse.headers = {'content-encoding': 'br',
+                                'content-length': '3'}
+        httpresponse.raw_content = b'raw'
+        with patch('brotli.compress') as mock_compress:
+            self.assertEqual(b'HTTP/1.1 200 OK\r\n'
+                             b'content-encoding: br\r\n'
+                             b'content-length: 3\r\n'
+                             b'\r\n'
+                             b'raw', bytes(httpresponse))
+        mock_compress.assert_not_called()
+
+    def test_changed_content_is_encoded(self):
+        httpresponse = HTTPResponse(proto='HTTP/1.1', code=200, message='OK')
+        httpresponse.headers = {'content-encoding': 'gzip',
+                                'content-length': '3'}
+        httpresponse.raw_content = b'raw'
+        httpresponse.content = b'test'
+        actual = bytes(httpresponse)
+        self.assertEqual(str(len(httpresponse.raw_content)),
+                         httpresponse.length)
+        self.assertTrue(actual.endswith(httpresponse.raw_content))
+        self.assertEqual(b'test', httpresponse._decompress_content())
 
     @parameterized.expand([
         [
@@ -160,6 +190,138 @@ class ParserTests(unittest.TestCase):
         self.assertEqual(expected, bytes(httrequest))
 
 
+HEAD = b'HTTP/1.1 200 OK\r\n' \
+       b'Content-Type: text/html\r\n' \
+       b'Set-Cookie: a=1; Expires=Wed, 21 Oct 2026 07:28:00 GMT\r\n' \
+       b'Cache-Control:  no-cache \t\r\n' \
+       b'Set-Cookie: b=2\r\n' \
+       b'Cache-Control: private\r\n\r\n'
+
+
+class HeadersTests(unittest.TestCase):
+
+    @staticmethod
+    def get_headers() -> Headers:
+        parser = HTTPHeadParser()
+        parser.feed(HEAD)
+        return parser.headers
+
+    def test_lookup(self):
+        headers = self.get_headers()
+        self.assertEqual('text/html', headers['content-type'])
+        self.assertEqual('text/html', headers['Content-Type'])
+        self.assertEqual('no-cache, private', headers['cache-control'])
+        self.assertEqual('b=2', headers['set-cookie'])
+        self.assertEqual(['a=1; Expires=Wed, 21 Oct 2026 07:28:00 GMT',
+                          'b=2'], headers.get_all('set-cookie'))
+        self.assertNotIn('content-length', headers)
+        self.assertIsNone(headers.get('content-length'))
+        self.assertEqual(['content-type', 'set-cookie', 'cache-control'],
+                         list(headers))
+        self.assertEqual(3, len(headers))
+
+    def test_set_and_delete(self):
+        headers = self.get_headers()
+        headers['cache-control'] = 'no-store'
+        headers['content-length'] = '5'
+        del headers['set-cookie']
+        self.assertEqual([('Content-Type', 'text/html'),
+                          ('Cache-Control', 'no-store'),
+                          ('content-length', '5')], list(headers.fields()))
+        with self.assertRaises(KeyError):
+            del headers['set-cookie']
+
+    def test_bytes_keep_fields(self):
+        headers = self.get_headers()
+        headers.add('via', '1.1 proxy')
+        self.assertEqual(HEAD.split(b'\r\n', 1)[1][:-2]
+                         .replace(b':  no-cache', b': no-cache')
+                         + b'via: 1.1 proxy\r\n', bytes(headers))
+
+    def test_not_utf8(self):
+        parser = HTTPHeadParser()
+        parser.feed(b'GET / HTTP/1.1\r\nX-Name: \xff\r\n\r\n')
+        headers = parser.headers
+        self.assertEqual('\udcff', headers['x-name'])
+        self.assertEqual(b'X-Name: \xff\r\n', bytes(headers))
+
+    def test_copy(self):
+        headers = self.get_headers()
+        copy = headers.copy()
+        copy['content-type'] = 'text/plain'
+        self.assertEqual('text/html', headers['content-type'])
+        self.assertEqual(dict(headers, **{'content-type': 'text/plain'}),
+                         copy)
+
+
+class HTTPHeadParserTests(unittest.TestCase):
+
+    def test_feed_by_bytes(self):
+        parser = HTTPHeadParser()
+        data = b'\r\nGET /a HTTP/1.1\r\nHost: example\r\n\r\nbody'
+        consumed = sum(parser.feed(data[i:i + 1]) for i in range(len(data)))
+        self.assertTrue(parser.done)
+        self.assertEqual(len(data) - 4, consumed)
+        self.assertEqual(('GET', '/a', 'HTTP/1.1'), parser.start_line)
+        self.assertEqual({'host': 'example'}, parser.headers)
+        self.assertEqual(data[2:-4], parser.head)
+
+    def test_feed_returns_consumed(self):
+        parser = HTTPHeadParser()
+        self.assertEqual(9, parser.feed(b'HTTP/1.1 '))
+        self.assertEqual(8, parser.feed(b'204 \r\n\r\nnext'))
+        self.assertEqual(('HTTP/1.1', '204', ''), parser.start_line)
+        self.assertEqual(0, parser.feed(b'next'))
+
+    def test_head_in_one_piece_is_not_copied(self):
+        parser = HTTPHeadParser()
+        parser.feed(HEAD)
+        self.assertIs(HEAD, parser.head)
+
+    def test_bare_lf(self):
+        parser = HTTPHeadParser()
+        parser.feed(b'GET / HTTP/1.1\nHost: example\n\n')
+        self.assertEqual('example', parser.headers['host'])
+
+    def test_reset(self):
+        parser = HTTPHeadParser()
+        parser.feed(b'GET / HTTP/1.1\r\n')
+        parser.reset()
+        parser.feed(b'HEAD / HTTP/1.1\r\n\r\n')
+        self.assertEqual('HEAD', parser.start_line[0])
+
+    def test_duplicate_content_length(self):
+        parser = HTTPHeadParser()
+        parser.feed(b'HTTP/1.1 200 OK\r\n'
+                    b'Content-Length: 5\r\nContent-Length: 5\r\n\r\n')
+        self.assertEqual([('Content-Length', '5')],
+                         list(parser.headers.fields()))
+
+    @parameterized.expand([
+        ['start_line', b'GET\r\n\r\n'],
+        ['field_without_colon', b'GET / HTTP/1.1\r\nHost\r\n\r\n'],
+        ['space_before_colon', b'GET / HTTP/1.1\r\nHost : a\r\n\r\n'],
+        ['folding', b'GET / HTTP/1.1\r\nA: b\r\n c\r\n\r\n'],
+        ['conflicting_content_length',
+         b'GET / HTTP/1.1\r\nContent-Length: 1\r\n'
+         b'Content-Length: 2\r\n\r\n'],
+        ['too_many_fields',
+         b'GET / HTTP/1.1\r\n' + b'A: b\r\n' * 4 + b'\r\n'],
+        ['too_large', b'GET / HTTP/1.1\r\nA: ' + b'b' * 64],
+        ['braced_start_line', b'{bad}\r\n\r\n'],
+        ['braced_field', b'GET / HTTP/1.1\r\n{bad}\r\n\r\n'],
+    ])
+    def test_invalid(self, _: str, data: bytes):
+        parser = HTTPHeadParser(max_size=64, max_fields=3)
+        with self.assertRaises(HTTPParsingException):
+            parser.feed(data)
+
+    def test_invalid_message_keeps_braces(self):
+        with self.assertRaisesRegex(HTTPParsingException,
+                                    "Invalid header field: b'{bad}"):
+            HTTPHeadParser().feed(b'GET / HTTP/1.1\r\n{bad}\r\n\r\n')
+
+
 class ParserAsyncTests(IsolatedAsyncioTestCase):
 
     @staticmethod
@@ -187,6 +349,66 @@ class ParserAsyncTests(IsolatedAsyncioTestCase):
                          b'Sat, 20 Mar 2004 21:12:00 GMT.</p></body></html>',
                          actual)
 
+    @staticmethod
+    def get_writer() -> MagicMock:
+        return MagicMock(spec=StreamWriter)
+
+    @staticmethod
+    def written(writer: MagicMock) -> bytes:
+        return b''.join(call.args[0] for call in writer.write.call_args_list)
+
+    async def test_read_chunked_content_with_extension(self):
+        s = self.get_reader(b'4;name=value\r\n'
+                            b'test\r\n'
+                            b'0\r\n')
+        self.assertEqual(b'test', await _read_chunked_content(s))
+
+    async def test_read_content_consumes_last_crlf(self):
+        reader = self.get_reader(b'HTTP/1.1 200 OK\r\n'
+                                 b'Transfer-Encoding: chunked\r\n'
+                                 b'\r\n'
+                                 b'4\r\n'
+                                 b'test\r\n'
+                                 b'0\r\n'
+                                 b'\r\n'
+                                 b'HTTP/1.1 204 No Content\r\n'
+                                 b'\r\n')
+        first = await HTTPResponse().from_stream(reader)
+        second = await HTTPResponse().from_stream(reader)
+        self.assertEqual(b'test', first.content)
+        self.assertEqual(204, second.code)
+
+    async def test_stream_content_with_length(self):
+        reader = self.get_reader(b'0123456789rest')
+        writer = self.get_writer()
+        httpresponse = HTTPResponse(headers={'content-length': '10'})
+        await httpresponse.stream_content(reader, writer, buffer_size=4)
+        self.assertEqual(b'0123456789', self.written(writer))
+        self.assertEqual(3, writer.write.call_count)
+        self.assertEqual(b'rest', await reader.read())
+
+    async def test_stream_content_exc(self):
+        reader = self.get_reader(b'01234')
+        httpresponse = HTTPResponse(headers={'content-length': '10'})
+        with self.assertRaises(HTTPParsingException):
+            await httpresponse.stream_content(reader, self.get_writer(),
+                                              buffer_size=4)
+
+    async def test_stream_chunked_content(self):
+        package = (b'8\r\n'
+                   b'Chunked \r\n'
+                   b'7;ext\r\n'
+                   b'content\r\n'
+                   b'0\r\n'
+                   b'Expires: Sat, 27 Mar 2004 21:12:00 GMT\r\n'
+                   b'\r\n')
+        reader = self.get_reader(package + b'next')
+        writer = self.get_writer()
+        httpresponse = HTTPResponse(headers={'transfer-encoding': 'chunked'})
+        await httpresponse.stream_content(reader, writer, buffer_size=3)
+        self.assertEqual(package, self.written(writer))
+        self.assertEqual(b'next', await reader.read())
+
     async def test_read_chunked_content_exc(self):
         s = self.get_reader(b'29\r\n'
                             b'<html><body><p>The file you requested is \r\n'
@@ -197,29 +419,109 @@ class ParserAsyncTests(IsolatedAsyncioTestCase):
         with self.assertRaises(HTTPParsingException):
             _ = await _read_chunked_content(s)
 
+    async def test_read_chunked_content_braced_size(self):
+        s = self.get_reader(b'{bad}\r\ncontent\r\n0\r\n\r\n')
+        with self.assertRaisesRegex(HTTPParsingException,
+                                    "Invalid chunk size: b'{bad}"):
+            await _read_chunked_content(s)
+
     @parameterized.expand([
-        ['request', b'GET /test.php HTTP/1.1\r\n', b'GET /test.php HTTP/1.1'],
-        ['response', b'HTTP/1.1 200 OK\r\n', b'HTTP/1.1 200 OK']
+        ['request', b'GET /test.php HTTP/1.1\r\n',
+         ('GET', '/test.php', 'HTTP/1.1')],
+        ['response', b'HTTP/1.1 200 OK\r\n', ('HTTP/1.1', '200', 'OK')]
     ])
-    async def test_read_first_line_and_headers(self, _: str,
-                                               first_line: bytes,
-                                               expected: bytes):
+    async def test_read_head(self, _: str, first_line: bytes,
+                             expected: tuple[str, str, str]):
         reader = self.get_reader(
             first_line +
             b'host: www.example.ru:8080\r\n'
-            b'accept-language: ru-ru\r\n\r\n')
-        actual = await _read_first_line_and_headers(reader)
-        self.assertEqual(actual, [expected,
-                                  b'host: www.example.ru:8080\r\n'
-                                  b'accept-language: ru-ru\r\n\r\n'
-                                  ])
-
-    async def test_read_first_line_and_headers_exc(self):
+            b'accept-language: ru-ru\r\n\r\ncontent')
+        parser = await _read_head(reader, HTTPHeadParser())
+        self.assertEqual(expected, parser.start_line)
+        self.assertEqual({'host': 'www.example.ru:8080',
+                          'accept-language': 'ru-ru'}, parser.headers)
+        self.assertEqual(b'content', await reader.read())
+
+    async def test_read_head_exc(self):
         reader = self.get_reader(
             b'GET /test.php HTTP/1.1\r\n'
             b'host: www.example.ru:8080\r\n')
         with self.assertRaises(HTTPParsingException):
-            _ = await _read_first_line_and_headers(reader)
+            _ = await _read_head(reader, HTTPHeadParser())
+
+    async def test_read_head_end_of_stream(self):
+        with self.assertRaises(EndOfStream):
+            _ = await _read_head(self.get_reader(b''), HTTPHeadParser())
+
+    async def test_read_head_idle_then_header(self):
+        reader = StreamReader()
+        reader.feed_data(b'\r\nGET / HTTP/1.1\r\n')
+        activity = Activity(timeout=60, phase='idle')
+        reading = asyncio.create_task(
+            _read_head(reader, HTTPHeadParser(), activity, timeout=10))
+        await asyncio.sleep(0)
+        self.assertEqual(('header', 10), (activity.phase, activity.timeout))
+        reader.feed_data(b'host: example\r\n\r\n')
+        parser = await reading
+        self.assertEqual(('GET', '/', 'HTTP/1.1'), parser.start_line)
+        self.assertEqual(b'GET / HTTP/1.1\r\nhost: example\r\n\r\n',
+                         parser.head)
+
+    async def test_read_head_idle_end_of_stream(self):
+        activity = Activity(timeout=60, phase='idle')
+        with self.assertRaises(EndOfStream):
+            _ = await _read_head(self.get_reader(b''), HTTPHeadParser(),
+                                 activity, timeout=10)
+        self.assertEqual('idle', activity.phase)
+
+    async def test_stream_content_touches_activity(self):
+        reader = self.get_reader(b'0123456789')
+        activity = Activity()
+        activity.last = 0
+        await HTTPResponse(headers={'content-length': '10'}).stream_content(
+            reader, self.get_writer(), buffer_size=4, activity=activity)
+        self.assertGreater(activity.last, 0)
+
+    async def test_read_head_over_limit(self):
+        reader = StreamReader(limit=64)
+        reader.feed_data(b'GET / HTTP/1.1\r\n' + b'a: b\r\n' * 20)
+        with self.assertRaises(HTTPParsingException):
+            _ = await _read_head(reader, HTTPHeadParser())
+
+    @parameterized.expand([
+        ['lf', b'GET / HTTP/1.1\nhost: example\n\n'],
+        ['mixed', b'GET / HTTP/1.1\nhost: example\r\n\r\n'],
+        ['crlf_then_lf', b'GET / HTTP/1.1\r\nhost: example\n\r\n'],
+    ])
+    async def test_read_head_bare_lf(self, _: str, head: bytes):
+        reader = StreamReader()
+        reader.feed_data(head + b'content')
+        parser = await asyncio.wait_for(
+            _read_head(reader, HTTPHeadParser()), timeout=1)
+        self.assertEqual(('GET', '/', 'HTTP/1.1'), parser.start_line)
+        self.assertEqual({'host': 'example'}, parser.headers)
+        reader.feed_eof()
+        self.assertEqual(b'content', await reader.read())
+
+    async def test_read_head_ends_with_bare_lf_after_crlf(self):
+        reader = self.get_reader(b'GET / HTTP/1.1\r\nhost: example\n\n'
+                                 b'GET /next HTTP/1.1\r\n\r\n')
+        with self.assertRaises(HTTPParsingException):
+            _ = await _read_head(reader, HTTPHeadParser())
+
+    async def test_read_head_bare_lf_over_max_size(self):
+        reader = self.get_reader(b'GET / HTTP/1.1\n' + b'a: b\n' * 20)
+        with self.assertRaises(HTTPParsingException):
+            _ = await _read_head(reader, HTTPHeadParser(max_size=64))
+
+    async def test_bare_lf_requests_pipelined(self):
+        reader = self.get_reader(
+            b'POST / HTTP/1.1\nHost: example\nContent-Length: 4\n\ntest'
+            b'GET /next HTTP/1.1\nHost: example\n\n')
+        first = await HTTPRequest().from_stream(reader)
+        second = await HTTPRequest().from_stream(reader)
+        self.assertEqual(b'test', first.content)
+        self.assertEqual(('GET', '/next'), (second.method, second.path))
 
     @parameterized.expand([
         [
@@ -291,7 +593,7 @@ class ParserAsyncTests(IsolatedAsyncioTestCase):
         self.assertEqual(proto, httpresponse.proto)
         self.assertEqual(code, httpresponse.code)
         self.assertEqual(message, httpresponse.message)
-        self.assertDictEqual(headers, httpresponse.headers)
+        self.assertEqual(headers, httpresponse.headers)
         self.assertEqual(content, httpresponse.content)
 
     @parameterized.expand([
@@ -338,5 +640,48 @@ class ParserAsyncTests(IsolatedAsyncioTestCase):
         self.assertEqual(host, httprequst.host)
         self.assertEqual(port, httprequst.port)
         self.assertEqual(proto, httprequst.proto)
-        self.assertDictEqual(headers, httprequst.headers)
+        self.assertEqual(headers, httprequst.headers)
         self.assertEqual(content, httprequst.content)
+
+    async def test_unchanged_head_is_reused(self):
+        head = b'HTTP/1.1 200 OK\r\nCache-Control:  max-age=60\r\n' \
+               b'Content-Length: 4\r\n\r\n'
+        httpresponse = await HTTPResponse().from_stream(
+            self.get_reader(head + b'test'))
+        self.assertEqual('max-age=60', httpresponse.headers['cache-control'])
+        buffers = httpresponse.to_buffers()
+        self.assertEqual([head, b'test'], buffers)
+        self.assertIs(httpresponse.raw_content, buffers[1])
+
+    @parameterized.expand([
+        ['header', lambda response: response.headers.update(age='1'),
+         b'HTTP/1.1 200 OK\r\nContent-Length: 4\r\nage: 1\r\n\r\n'],
+        ['start_line', lambda response: setattr(response, 'code', 203),
+         b'HTTP/1.1 203 OK\r\nContent-Length: 4\r\n\r\n'],
+        ['content', lambda response: setattr(response, 'content', b'tested'),
+         b'HTTP/1.1 200 OK\r\nContent-Length: 6\r\n\r\n'],
+    ])
+    async def test_changed_head_is_serialized(self, _: str, change,
+                                              expected: bytes):
+        httpresponse = await HTTPResponse().from_stream(self.get_reader(
+            b'HTTP/1.1 200 OK\r\nContent-Length:  4\r\n\r\ntest'))
+        change(httpresponse)
+        self.assertEqual(expected, httpresponse.to_buffers()[0])
+
+    async def test_empty_reason_phrase_is_serialized(self):
+        data = b'HTTP/1.1 200 \r\nContent-Length: 4\r\n\r\ntest'
+        httpresponse = await HTTPResponse().from_stream(self.get_reader(data))
+        self.assertEqual(data, bytes(httpresponse))
+        copied = replace(httpresponse,
+                         headers=httpresponse.headers.copy())
+        self.assertEqual(data, bytes(copied))
+
+    def test_incomplete_status_line_is_not_serialized(self):
+        self.assertEqual(b'', bytes(HTTPResponse(proto='HTTP/1.1')))
+        self.assertEqual([], HTTPResponse(message='OK').to_buffers())
+
+    async def test_head_with_bare_lf_is_serialized(self):
+        httprequest = await HTTPRequest().from_stream(self.get_reader(
+            b'GET / HTTP/1.1\nHost: example\r\n\r\n'))
+        self.assertEqual(b'GET / HTTP/1.1\r\nHost: example\r\n\r\n',
+                         httprequest.head_bytes())
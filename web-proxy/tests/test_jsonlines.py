@@ -0,0 +1,103 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+
+from common.jsonlines import JSONLinesSink
+
+
+class JSONLinesSinkTests(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self._tmp.name, 'dir', 'records.jsonl')
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def test_put(self):
+        sink = JSONLinesSink(self.filename)
+        for index in range(3):
+            self.assertTrue(sink.put({'index': index, 'text': 'пароль'}))
+        sink.close()
+        self.assertEqual([{'index': 0, 'text': 'пароль'},
+                          {'index': 1, 'text': 'пароль'},
+                          {'index': 2, 'text': 'пароль'}],
+                         list(sink.read()))
+        self.assertEqual(3, sink.written)
+        self.assertIsNone(sink._thread)
+
+    def test_batches(self):
+        sink = JSONLinesSink(self.filename, batch_size=2)
+        written = threading.Event()
+        release = threading.Event()
+        write = sink._write
+
+        def blocked_write(records):
+            written.set()
+            release.wait()
+            write(records)
+
+        with patch.object(sink, '_write', side_effect=blocked_write):
+            sink.put({'index': 0})
+            written.wait()
+            # Queued while the first batch is written.
+            for index in range(1, 4):
+                sink.put({'index': index})
+            release.set()
+            sink.close()
+        self.assertEqual(3, sink.batches)
+        self.assertEqual([0, 1, 2, 3],
+                         [record['index'] for record in sink.read()])
+
+    def test_dropped(self):
+        sink = JSONLinesSink(self.filename, queue_size=1)
+        with patch.object(JSONLinesSink, '_start'):
+            self.assertTrue(sink.put({'index': 0}))
+            self.assertFalse(sink.put({'index': 1}))
+        self.assertEqual(1, sink.stats()['dropped'])
+        self.assertEqual(1, sink.stats()['queued'])
+
+    def test_rotate(self):
+        sink = JSONLinesSink(self.filename, max_file_size=30, backups=2)
+        for index in range(5):
+            sink.put({'index': index, 'data': 'x' * 5})
+            sink.close()
+        self.assertEqual([f'{self.filename}.2', f'{self.filename}.1',
+                          self.filename], sink.files())
+        self.assertEqual(4, sink.rotations)
+        self.assertEqual([2, 3, 4],
+                         [record['index'] for record in sink.read()])
+
+    def test_rotate_without_backups(self):
+        sink = JSONLinesSink(self.filename, max_file_size=30, backups=0)
+        for index in range(2):
+            sink.put({'index': index, 'data': 'x' * 5})
+            sink.close()
+        self.assertEqual([self.filename], sink.files())
+        self.assertEqual([1], [record['index'] for record in sink.read()])
+
+    def test_write_error(self):
+        sink = JSONLinesSink(self.filename)
+        with patch('builtins.open', side_effect=OSError('disk full')), \
+                self.assertLogs('jsonLinesSink', 'WARNING'):
+            sink.put({'index': 0})
+            sink.close()
+        self.assertEqual(1, sink.failed)
+        self.assertEqual(0, sink.written)
+
+    def test_read_skips_torn_line(self):
+        os.makedirs(os.path.dirname(self.filename))
+        with open(self.filename, 'w') as f:
+            f.write(json.dumps({'index': 0}) + '\n[1]\n{"index": ')
+        sink = JSONLinesSink(self.filename)
+        with self.assertLogs('jsonLinesSink', 'WARNING') as logs:
+            self.assertEqual([{'index': 0}], list(sink.read()))
+        self.assertEqual(2, len(logs.output))
+
+    def test_close_not_started(self):
+        sink = JSONLinesSink(self.filename)
+        sink.close()
+        self.assertEqual([], sink.files())
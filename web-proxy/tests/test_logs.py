@@ -0,0 +1,106 @@
+import logging
+import threading
+from logging.handlers import QueueHandler
+from unittest import TestCase
+from unittest.mock import patch
+
+from parameterized import parameterized
+
+from proxy import logs
+from proxy.logs import SamplingFilter, format_fields, sample, \
+    start_queue_logging, stop_queue_logging
+
+
+def get_record(level: int) -> logging.LogRecord:
+    return logging.LogRecord('test', level, __file__, 1, 'message',
+                             None, None)
+
+
+class SamplingFilterTests(TestCase):
+
+    @parameterized.expand([
+        ('passed', 0.5, 0.25, True),
+        ('dropped', 0.5, 0.75, False),
+        ('all', 1.0, 0.99, True),
+        ('none', 0.0, 0.0, False)
+    ])
+    def test_info(self, _: str, rate: float, random: float, passed: bool):
+        sampling = SamplingFilter(rate)
+        with patch('random.random', return_value=random):
+            self.assertEqual(passed,
+                             sampling.filter(get_record(logging.INFO)))
+        self.assertEqual(0 if passed else 1, sampling.dropped)
+
+    def test_warning_always_passes(self):
+        sampling = SamplingFilter(0.0)
+        self.assertTrue(sampling.filter(get_record(logging.WARNING)))
+
+    def test_invalid_rate(self):
+        with self.assertRaises(ValueError):
+            SamplingFilter(1.5)
+
+    def test_sample(self):
+        logger = logging.getLogger('sampledLogger')
+        sample('sampledLogger', 1.0)
+        self.assertEqual([], logger.filters)
+        sample('sampledLogger', 0.0)
+        [sampling] = logger.filters
+        logger.removeFilter(sampling)
+        self.assertEqual(0.0, sampling.rate)
+
+
+class FormatFieldsTests(TestCase):
+
+    def test_format(self):
+        self.assertEqual(
+            'method=GET path="/a?b=c" agent="curl \\"8\\"" bytes=10 host=-',
+            format_fields({'method': 'GET', 'path': '/a?b=c',
+                           'agent': 'curl "8"', 'bytes': 10, 'host': None}))
+
+    def test_empty_value(self):
+        self.assertEqual('path=""', format_fields({'path': ''}))
+
+
+class QueueLoggingTests(TestCase):
+
+    def setUp(self):
+        self.root = logging.getLogger()
+        self.handler = logging.Handler()
+        self.handler.emit = self.emit
+        self.handlers = self.root.handlers[:]
+        self.root.handlers = [self.handler]
+        self.threads = []
+
+    def tearDown(self):
+        stop_queue_logging()
+        self.root.handlers = self.handlers
+
+    def emit(self, record: logging.LogRecord):
+        self.threads.append(threading.current_thread())
+
+    def test_records_written_by_listener(self):
+        start_queue_logging()
+        [handler] = self.root.handlers
+        self.assertIsInstance(handler, QueueHandler)
+        logging.getLogger('queued').warning('message')
+        stop_queue_logging()
+        self.assertEqual([self.handler], self.root.handlers)
+        [thread] = self.threads
+        self.assertIsNot(threading.current_thread(), thread)
+
+    def test_start_twice(self):
+        start_queue_logging()
+        start_queue_logging()
+        self.assertEqual(1, len(self.root.handlers))
+
+    def test_restart_after_fork(self):
+        start_queue_logging()
+        [handler] = self.root.handlers
+        queue, listener = handler.queue, logs._listener
+        logs._restart_after_fork()
+        # The thread of the parent does not exist in a forked child.
+        listener.stop()
+        self.assertIsNot(queue, handler.queue)
+        logging.getLogger('queued').warning('message')
+        stop_queue_logging()
+        self.assertEqual(1, len(self.threads))
@@ -0,0 +1,144 @@
+import asyncio
+import unittest
+from unittest import IsolatedAsyncioTestCase
+
+from parameterized import parameterized
+
+from proxy.metrics import Histogram, Metrics, MetricsServer, Timeline, \
+    render
+
+
+class HistogramTests(unittest.TestCase):
+
+    def test_observe(self):
+        histogram = Histogram(bounds=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0, 3.0):
+            histogram.observe(value)
+        self.assertEqual([2, 1, 2], histogram.counts)
+        self.assertAlmostEqual(5.65, histogram.sum)
+
+    def test_export(self):
+        histogram = Histogram(bounds=(0.1, 1.0))
+        for value in (0.05, 0.5, 2.0):
+            histogram.observe(value)
+        stats = dict()
+        histogram.export('latency', stats)
+        self.assertEqual({'latency_le_0.1': 1, 'latency_le_1.0': 2,
+                          'latency_le_+Inf': 3, 'latency_sum': 2.55,
+                          'latency_count': 3}, stats)
+
+
+class MetricsTests(unittest.TestCase):
+
+    def test_stats(self):
+        metrics = Metrics()
+        metrics.request(100)
+        metrics.response(404, 20)
+        metrics.response(200, 50)
+        metrics.response(200, 30)
+        metrics.handshake('client', ok=True)
+        metrics.handshake('origin', ok=False)
+        stats = metrics.stats()
+        self.assertEqual(100, stats['received_bytes'])
+        self.assertEqual(100, stats['sent_bytes'])
+        self.assertEqual((2, 1), (stats['responses_200'],
+                                  stats['responses_404']))
+        self.assertEqual((1, 0, 0, 1),
+                         (stats['tls_client_ok'], stats['tls_client_failed'],
+                          stats['tls_origin_ok'], stats['tls_origin_failed']))
+        self.assertEqual(0, stats['upstream_connect_count'])
+
+    def test_render(self):
+        metrics = Metrics()
+        metrics.connections = 2
+        metrics.response(200, 10)
+        metrics.first_byte.observe(0.2)
+        text = render({'metrics': metrics.stats(),
+                       'cache': {'hits': 3}})
+        lines = text.splitlines()
+        self.assertIn('# TYPE proxy_connections_total counter', lines)
+        self.assertIn('proxy_connections_total 2', lines)
+        self.assertIn('proxy_responses_total{code="200"} 1', lines)
+        self.assertIn('proxy_tls_handshakes_total'
+                      '{peer="origin",result="failed"} 0', lines)
+        self.assertIn('# TYPE proxy_first_byte_seconds histogram', lines)
+        self.assertIn('proxy_first_byte_seconds_bucket{le="0.1"} 0', lines)
+        self.assertIn('proxy_first_byte_seconds_bucket{le="0.25"} 1', lines)
+        self.assertIn('proxy_first_byte_seconds_bucket{le="+Inf"} 1', lines)
+        self.assertIn('proxy_first_byte_seconds_count 1', lines)
+        self.assertIn('proxy_cache_hits 3', lines)
+        self.assertTrue(text.endswith('\n'))
+
+    def test_render_summed_stats(self):
+        first, second = Metrics(), Metrics()
+        first.upstream_connect.observe(0.01)
+        second.upstream_connect.observe(20.0)
+        summed = {name: value + second.stats()[name]
+                  for name, value in first.stats().items()}
+        lines = render({'metrics': summed}).splitlines()
+        self.assertIn('proxy_upstream_connect_seconds_bucket{le="0.01"} 1',
+                      lines)
+        self.assertIn('proxy_upstream_connect_seconds_bucket{le="+Inf"} 2',
+                      lines)
+
+
+class TimelineTests(unittest.TestCase):
+
+    def test_durations(self):
+        timeline = Timeline(started=10.0)
+        timeline.marks = [('header', 10.5), ('connect', 10.75),
+                          ('response', 12.0)]
+        self.assertEqual([('header', 0.5), ('connect', 0.25),
+                          ('response', 1.25)], timeline.durations())
+        self.assertEqual(2.0, timeline.elapsed)
+        self.assertEqual('header=500.0ms connect=250.0ms response=1250.0ms',
+                         str(timeline))
+
+    def test_empty(self):
+        timeline = Timeline()
+        self.assertEqual(0.0, timeline.elapsed)
+        self.assertEqual('', str(timeline))
+
+
+class MetricsServerAsyncTests(IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.server = MetricsServer(
+            host='127.0.0.1', port=0,
+            collect=lambda: {'metrics': Metrics().stats()})
+        await self.server.start()
+        self.port = self.server._server.sockets[0].getsockname()[1]
+
+    async def asyncTearDown(self):
+        await self.server.close()
+
+    async def get(self, request: bytes) -> bytes:
+        reader, writer = await asyncio.open_connection('127.0.0.1',
+                                                       self.port)
+        writer.write(request)
+        response = await reader.read()
+        writer.close()
+        await writer.wait_closed()
+        return response
+
+    async def test_scrape(self):
+        response = await self.get(b'GET /metrics HTTP/1.1\r\n'
+                                  b'Host: localhost\r\n\r\n')
+        head, content = response.split(b'\r\n\r\n', 1)
+        self.assertTrue(head.startswith(b'HTTP/1.1 200 OK\r\n'))
+        self.assertIn(b'text/plain; version=0.0.4', head)
+        self.assertIn(f'Content-Length: {len(content)}'.encode(), head)
+        self.assertIn(b'\nproxy_connections_total 0\n', content)
+        self.assertEqual(1, self.server.scrapes)
+
+    @parameterized.expand([
+        ('path', b'GET / HTTP/1.1\r\n\r\n', b'HTTP/1.1 404 '),
+        ('method', b'POST /metrics HTTP/1.1\r\n\r\n', b'HTTP/1.1 405 ')
+    ])
+    async def test_rejected(self, _: str, request: bytes, expected: bytes):
+        response = await self.get(request)
+        self.assertTrue(response.startswith(expected))
+        self.assertEqual(0, self.server.scrapes)
+
+    async def test_invalid_request(self):
+        self.assertEqual(b'', await self.get(b'\x00\r\n\r\n'))
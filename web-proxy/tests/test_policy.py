@@ -0,0 +1,42 @@
+import unittest
+from unittest.mock import patch, mock_open
+
+from parameterized import parameterized
+
+from proxy.policy import InterceptPolicy
+
+
+class InterceptPolicyTests(unittest.TestCase):
+
+    @parameterized.expand([
+        ['exact_host', 'bank.example.com', 443, None, False],
+        ['other_host', 'example.com', 443, None, True],
+        ['pattern', 'static.cdn.example.net', 443, None, False],
+        ['pattern_root', 'cdn.example.net', 443, None, True],
+        ['domain', 'example.org', 443, None, False],
+        ['subdomain', 'www.example.org', 443, None, False],
+        ['case_and_dot', 'WWW.Example.ORG.', 443, None, False],
+        ['ip_host', '10.1.2.3', 443, None, False],
+        ['resolved_address', 'internal.host', 443, '10.1.2.3', False],
+        ['ipv6', '2001:db8::1', 443, None, False],
+        ['other_address', 'host', 443, '192.168.0.1', True],
+        ['other_port', 'host', 8443, None, False],
+    ])
+    def test_should_intercept(self, _: str, host: str, port: int,
+                              address: str, expected: bool):
+        policy = InterceptPolicy.from_rules(
+            ['bank.example.com', '*.cdn.example.net', '.example.org',
+             '10.0.0.0/8', '2001:db8::/32'],
+            intercept_ports=[443])
+        self.assertEqual(expected,
+                         policy.should_intercept(host, port, address))
+
+    def test_default_intercepts_all(self):
+        policy = InterceptPolicy()
+        self.assertTrue(policy.should_intercept('example.com', 8443))
+
+    def test_read_rules(self):
+        data = '# banks\nbank.example.com  # main\n\n10.0.0.0/8\n'
+        with patch('builtins.open', mock_open(read_data=data)):
+            self.assertEqual(['bank.example.com', '10.0.0.0/8'],
+                             InterceptPolicy.read_rules('rules.txt'))
@@ -0,0 +1,115 @@
+import asyncio
+from asyncio import StreamReader, StreamWriter
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import patch, MagicMock
+
+from proxy.dns import Resolver
+from proxy.metrics import Timeline
+from proxy.pool import UpstreamPool, UpstreamConnection
+
+
+class UpstreamPoolTests(IsolatedAsyncioTestCase):
+
+    @staticmethod
+    def get_connection(host='host', port=80,
+                       closing=False) -> UpstreamConnection:
+        writer = MagicMock(spec=StreamWriter)
+        writer.is_closing.return_value = closing
+        return UpstreamConnection(host=host, port=port,
+                                  reader=StreamReader(), writer=writer)
+
+    async def test_acquire_new(self):
+        pool = UpstreamPool(resolver=MagicMock(spec=Resolver))
+        reader, writer = StreamReader(), MagicMock(spec=StreamWriter)
+        timeline = Timeline()
+        with patch('asyncio.open_connection',
+                   return_value=(reader, writer)) as mock_open:
+            connection = await pool.acquire('host', 8080, timeline)
+        sock = pool._resolver.connect.return_value
+        pool._resolver.connect.assert_awaited_once_with('host', 8080,
+                                                        timeline)
+        mock_open.assert_called_once_with(host=None, port=None,
+                                          limit=2 ** 16, sock=sock)
+        self.assertEqual(('host', 8080), connection.key)
+        self.assertIs(writer, connection.writer)
+        self.assertEqual(1, pool.misses)
+
+    async def test_active_limit(self):
+        pool = UpstreamPool(max_active_per_host=1,
+                            resolver=MagicMock(spec=Resolver))
+        with patch('asyncio.open_connection',
+                   side_effect=lambda **kwargs: (
+                       StreamReader(), MagicMock(spec=StreamWriter))):
+            first = await pool.acquire('host', 80)
+            other = await pool.acquire('other', 80)
+            waiting = asyncio.create_task(pool.acquire('host', 80))
+            await asyncio.sleep(0)
+            self.assertFalse(waiting.done())
+            stats = pool.stats()
+            self.assertEqual((3, 1), (stats['active'], stats['waited']))
+            pool.release(first, reusable=False)
+            second = await asyncio.wait_for(waiting, 1)
+        pool.release(second, reusable=False)
+        pool.release(other, reusable=False)
+        self.assertEqual(0, pool.stats()['active'])
+        self.assertEqual({}, pool._limits)
+
+    async def test_active_limit_released_on_error(self):
+        pool = UpstreamPool(max_active_per_host=1,
+                            resolver=MagicMock(spec=Resolver))
+        pool._resolver.connect.side_effect = OSError('refused')
+        with self.assertRaises(OSError):
+            await pool.acquire('host', 80)
+        self.assertEqual(0, pool.stats()['active'])
+
+    async def test_release_and_reuse(self):
+        pool = UpstreamPool()
+        connection = self.get_connection()
+        pool.release(connection)
+        with patch('asyncio.open_connection') as mock_open:
+            self.assertIs(connection, await pool.acquire('host', 80))
+        mock_open.assert_not_called()
+        self.assertEqual(1, pool.hits)
+        await pool.close()
+
+    async def test_release_not_reusable(self):
+        pool = UpstreamPool()
+        connection = self.get_connection()
+        pool.release(connection, reusable=False)
+        connection.writer.close.assert_called_once()
+        self.assertEqual(0, pool.stats()['idle'])
+
+    async def test_release_over_limit(self):
+        pool = UpstreamPool(max_idle_per_host=1)
+        first, second = self.get_connection(), self.get_connection()
+        pool.release(first)
+        pool.release(second)
+        second.writer.close.assert_called_once()
+        self.assertEqual(1, pool.stats()['idle'])
+        await pool.close()
+        first.writer.close.assert_called_once()
+
+    async def test_unhealthy_connection_is_not_reused(self):
+        pool = UpstreamPool(resolver=MagicMock(spec=Resolver))
+        connection = self.get_connection()
+        pool.release(connection)
+        connection.reader.feed_eof()
+        with patch('asyncio.open_connection',
+                   return_value=(StreamReader(),
+                                 MagicMock(spec=StreamWriter))):
+            self.assertIsNot(connection, await pool.acquire('host', 80))
+        connection.writer.close.assert_called_once()
+        self.assertEqual(1, pool.evicted)
+
+    async def test_evict_expired(self):
+        pool = UpstreamPool(idle_timeout=10)
+        old, fresh = self.get_connection(), self.get_connection(port=81)
+        pool.release(old)
+        pool.release(fresh)
+        old.released_at -= 20
+        pool._evict_expired()
+        old.writer.close.assert_called_once()
+        fresh.writer.close.assert_not_called()
+        self.assertEqual({'idle': 1, 'active': 0, 'waited': 0, 'hits': 0,
+                          'misses': 0, 'evicted': 1}, pool.stats())
+        await pool.close()
@@ -0,0 +1,67 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from proxy.profiler import SamplingProfiler
+
+
+def busy_function(stop: threading.Event):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+class SamplingProfilerTests(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.profiler = SamplingProfiler(dirname=self._tmp.name,
+                                         duration=0.1, interval=0.001)
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def test_profile(self):
+        stop = threading.Event()
+        busy = threading.Thread(target=self.start_busy, args=(stop,))
+        busy.start()
+        try:
+            time.sleep(0.01)
+            self.assertTrue(self.started)
+            self.profiler._thread.join()
+        finally:
+            stop.set()
+            busy.join()
+        self.assertEqual(1, self.profiler.profiles)
+        [filename] = os.listdir(self._tmp.name)
+        with open(os.path.join(self._tmp.name, filename)) as f:
+            lines = f.read().splitlines()
+        stack, count = lines[0].rsplit(' ', 1)
+        self.assertIn('start_busy (test_profiler.py:', stack)
+        self.assertIn(';busy_function (test_profiler.py:', stack)
+        self.assertGreater(int(count), 0)
+
+    def start_busy(self, stop: threading.Event):
+        self.started = self.profiler.start()
+        busy_function(stop)
+
+    def test_start_running(self):
+        stop = threading.Event()
+        self.profiler._thread = threading.Thread(target=stop.wait)
+        self.profiler._thread.start()
+        try:
+            with self.assertLogs('samplingProfiler', 'WARNING'):
+                self.assertFalse(self.profiler.start())
+        finally:
+            stop.set()
+            self.profiler._thread.join()
+
+    def test_thread_ended(self):
+        thread = threading.Thread(target=self.profiler.start,
+                                  kwargs={'duration': 10.0})
+        thread.start()
+        thread.join()
+        self.profiler._thread.join(timeout=1.0)
+        self.assertFalse(self.profiler.running)
+        self.assertEqual(1, self.profiler.profiles)
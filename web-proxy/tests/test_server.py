@@ -1,11 +1,22 @@
+import asyncio
+import os
+import signal
+import unittest
 from asyncio import StreamReader
 from asyncio.base_events import Server
 from unittest import IsolatedAsyncioTestCase
-from unittest.mock import patch
+from unittest.mock import patch, MagicMock
 
+from parameterized import parameterized
+
+from common.filemanager import FileNotExist
 from features.collector import PasswordCollector
+from proxy.admission import AdmissionControl
 from proxy.connection import ProxyConnection
+from proxy.pool import UpstreamPool
+from proxy.profiler import SamplingProfiler
 from proxy.server import ProxyServer
+from sslcert import CertificateCreator
 from tests.test_connection import ProxyConnectionAsyncTests
 
 
@@ -13,21 +24,63 @@ class ServerAsyncTests(IsolatedAsyncioTestCase):
 
     @staticmethod
     def get_server():
-        with patch.object(PasswordCollector, '__init__', return_value=None):
+        with patch.object(PasswordCollector, '__init__', return_value=None), \
+                patch.object(CertificateCreator, '__init__',
+                             return_value=None):
             return ProxyServer(host='localhost',
                                port=8080,
                                buffer_size=4096,
                                users=100)
 
+    def test_shared_cert_creator(self):
+        server = self.get_server()
+        self.assertIsInstance(server._cert_creator, CertificateCreator)
+
+    def test_cert_creator_without_root_ca(self):
+        with patch.object(PasswordCollector, '__init__', return_value=None), \
+                patch.object(CertificateCreator, '__init__',
+                             side_effect=FileNotExist('RootCA.crt')):
+            server = ProxyServer(host='localhost', port=8080,
+                                 buffer_size=4096)
+        self.assertIsNone(server._cert_creator)
+
+    @patch.object(PasswordCollector, 'stats', return_value={})
+    def test_stats(self, mock_collector_stats):
+        server = self.get_server()
+        server._cert_creator = None
+        self.assertEqual({'metrics', 'admission', 'dns', 'upstream_pool',
+                          'upstream_tls', 'cache', 'coalescing',
+                          'credentials'},
+                         server.stats().keys())
+
+    @patch.object(CertificateCreator, 'start')
     @patch('asyncio.start_server')
-    async def test_run(self, mock_start_server):
+    async def test_run(self, mock_start_server, mock_start_creator):
         server = self.get_server()
         await server.run()
+        mock_start_creator.assert_called_once()
         mock_start_server.assert_called_once_with(
             client_connected_cb=server._handle_client,
             host='localhost',
             port=8080,
-            backlog=100)
+            backlog=100,
+            reuse_port=False,
+            limit=2 ** 16)
+
+    @unittest.skipUnless(hasattr(signal, 'SIGUSR1'), 'SIGUSR1 is missing')
+    @patch.object(SamplingProfiler, 'start')
+    @patch.object(CertificateCreator, 'start')
+    @patch('asyncio.start_server')
+    async def test_profile_on_signal(self, mock_start_server,
+                                     mock_start_creator, mock_profile):
+        server = self.get_server()
+        await server.run()
+        try:
+            os.kill(os.getpid(), signal.SIGUSR1)
+            await asyncio.sleep(0.05)
+        finally:
+            asyncio.get_running_loop().remove_signal_handler(signal.SIGUSR1)
+        mock_profile.assert_called_once_with()
 
     async def test_close(self):
         server = self.get_server()
@@ -36,7 +89,14 @@ class ServerAsyncTests(IsolatedAsyncioTestCase):
                           return_value=None) as mock_server, \
                 patch.object(Server, 'close') as mock_close_server, \
                 patch.object(Server, 'wait_closed') as mock_wait, \
-                patch.object(ProxyConnection, 'close') as mock_close_conn:
+                patch.object(ProxyConnection, 'close') as mock_close_conn, \
+                patch.object(UpstreamPool, 'close') as mock_close_pool, \
+                patch.object(CertificateCreator,
+                             'close') as mock_close_creator, \
+                patch.object(CertificateCreator, 'stats', return_value={}), \
+                patch.object(PasswordCollector, 'stats', return_value={}), \
+                patch.object(PasswordCollector,
+                             'close') as mock_close_collector:
             server._server = Server()
             await server.close()
 
@@ -46,6 +106,28 @@ class ServerAsyncTests(IsolatedAsyncioTestCase):
         mock_wait.assert_awaited()
         mock_close_conn.assert_called_once()
         mock_close_conn.assert_awaited()
+        mock_close_pool.assert_awaited_once()
+        mock_close_creator.assert_awaited_once()
+        mock_close_collector.assert_called_once()
+
+    @parameterized.expand([
+        ['busy', 'other', b'HTTP/1.1 503 '],
+        ['client_limit', '127.0.0.1', b'HTTP/1.1 429 '],
+    ])
+    async def test_handle_client_shed(self, _: str, holder: str,
+                                      expected: bytes):
+        server = self.get_server()
+        server._admission = AdmissionControl(max_connections=1, max_queue=0,
+                                             per_client=1)
+        await server._admission.admit(holder)
+        writer = MagicMock()
+        writer.get_extra_info.return_value = ('127.0.0.1', 50000)
+        with patch.object(ProxyConnection, '__init__') as mock_conn:
+            await server._handle_client(StreamReader(), writer)
+        mock_conn.assert_not_called()
+        self.assertTrue(writer.write.call_args.args[0].startswith(expected))
+        writer.close.assert_called_once()
+        self.assertEqual(1, server._admission.stats()['active'])
 
     async def test_handle_client(self):
         server = self.get_server()
@@ -65,7 +147,20 @@ class ServerAsyncTests(IsolatedAsyncioTestCase):
             client_writer=writer,
             buffer_size=4096,
             close_hook=server._set_clients.remove,
-            password_collector=server._password_collector
+            password_collector=server._password_collector,
+            upstream_pool=server._upstream_pool,
+            policy=server._policy,
+            tunnel_buffer_size=65536,
+            tunnel_idle_timeout=600.0,
+            cert_creator=server._cert_creator,
+            client_context=server._client_context,
+            cache=server._cache,
+            coalescer=server._coalescer,
+            socket_options=server._socket_options,
+            timeouts=server._timeouts,
+            metrics=server._metrics,
+            slow_request=None,
+            resolver=server._resolver
         )
         self.assertEqual(1, len(server._set_clients))
         mock_run.assert_called_once()
@@ -73,3 +168,6 @@ class ServerAsyncTests(IsolatedAsyncioTestCase):
         mock_hash.assert_called_once()
         mock_close.assert_called()
         mock_close.assert_awaited()
+        self.assertEqual(0, server._admission.stats()['active'])
+        self.assertEqual(1, server._metrics.connections)
+        self.assertEqual(0, server._metrics.active_connections)
@@ -1,14 +1,25 @@
+import asyncio
 import os
 import pathlib
 import ssl
+import tempfile
+import threading
 import unittest
-from unittest.mock import patch, MagicMock
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import patch, MagicMock, AsyncMock
 
 from cryptography import x509
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+from parameterized import parameterized
+from cryptography.x509.oid import NameOID
 
 import sslcert
 from common.filemanager import FileManager, save_file_at_dir
-from sslcert import CertificateCreator
+from sslcert import CertificateCreator, CertificateStore
+from sslcert import sslcreator as sslcreator_module
 
 
 class SSLCreatorTests(unittest.TestCase):
@@ -36,7 +47,7 @@ class SSLCreatorTests(unittest.TestCase):
         sslcreator = CertificateCreator(work_dir='testdir',
                                         ca_cert_file='',
                                         ca_key_file='')
-        sslcreator._cert = {'dns_name': 'files', 'dns_name1': 'files1'}
+        sslcreator._cert = OrderedDict(dns_name='files', dns_name1='files1')
         self.assertEqual(
             ('testdir/ssl/files.crt', 'testdir/ssl/files.key'),
             sslcreator._create_ssl(host='dns_name', cert_info={}))
@@ -55,7 +66,7 @@ class SSLCreatorTests(unittest.TestCase):
         sslcreator = CertificateCreator(work_dir='testdir',
                                         ca_cert_file='',
                                         ca_key_file='')
-        sslcreator._cert = {'dns_name1': 'files1'}
+        sslcreator._cert = OrderedDict(dns_name1='files1')
         self.assertEqual(
             ('testdir/ssl/filenames.crt', 'testdir/ssl/filenames.key'),
             sslcreator._create_ssl(
@@ -93,3 +104,247 @@ class SSLCreatorTests(unittest.TestCase):
         mock_loc.assert_called()
         mock_chain.assert_called()
         mock_exist.assert_called()
+
+
+class SSLContextCacheTests(IsolatedAsyncioTestCase):
+
+    @staticmethod
+    def get_creator(**kwargs) -> CertificateCreator:
+        store = MagicMock(spec=CertificateStore)
+        store.get.return_value = None
+        with patch.object(CertificateCreator, '_load_certs'):
+            creator = CertificateCreator(work_dir='', ca_cert_file='',
+                                         ca_key_file='', store=store,
+                                         **kwargs)
+        creator._load_sslcontext = MagicMock(
+            side_effect=lambda cert, key: MagicMock(name=cert))
+        return creator
+
+    async def test_get_sslcontext_cached(self):
+        creator = self.get_creator()
+        with patch.object(CertificateCreator, '_mint',
+                          return_value='serial') as mock_mint:
+            first = await creator.get_sslcontext('host', {})
+            self.assertIs(first, await creator.get_sslcontext('host', {}))
+        mock_mint.assert_awaited_once_with('host', {})
+        self.assertEqual({'host': 'serial'}, creator._cert)
+        creator._store.put.assert_called_once()
+        self.assertEqual(('host', ['host'], 'serial'),
+                         creator._store.put.call_args.args[:3])
+        self.assertEqual({'contexts': 1, 'context_hits': 1,
+                          'context_misses': 1, 'minting': 0,
+                          'minted': 1, 'spare_keys': 0}, creator.stats())
+
+    async def test_get_sslcontext_from_store(self):
+        creator = self.get_creator()
+        creator._store.get.return_value = 'serial'
+        with patch.object(CertificateCreator, '_mint') as mock_mint:
+            await creator.get_sslcontext(
+                'host', {'subjectAltName': [('DNS', 'alt')]})
+        mock_mint.assert_not_called()
+        creator._store.get.assert_called_once_with('host', ['alt', 'host'],
+                                                   'ecdsa')
+        creator._load_sslcontext.assert_called_once_with(
+            'ssl/serial.crt', 'ssl/serial.key')
+        self.assertEqual({'host': 'serial'}, creator._cert)
+
+    async def test_get_sslcontext_loaded_in_thread(self):
+        creator = self.get_creator()
+        threads = []
+        creator._load_sslcontext.side_effect = \
+            lambda cert, key: threads.append(threading.current_thread())
+        with patch.object(CertificateCreator, '_mint',
+                          return_value='serial'):
+            await creator.get_sslcontext('host', {})
+        [thread] = threads
+        self.assertIsNot(threading.current_thread(), thread)
+
+    async def test_get_sslcontext_deduplicated(self):
+        creator = self.get_creator()
+        minted = asyncio.Event()
+
+        async def mint(host, cert_info):
+            await minted.wait()
+            return 'serial'
+
+        with patch.object(CertificateCreator, '_mint',
+                          side_effect=mint) as mock_mint:
+            waiters = [asyncio.create_task(creator.get_sslcontext('host', {}))
+                       for _ in range(3)]
+            await asyncio.sleep(0)
+            self.assertEqual(1, creator.stats()['minting'])
+            minted.set()
+            contexts = await asyncio.gather(*waiters)
+        mock_mint.assert_awaited_once()
+        self.assertTrue(all(context is contexts[0] for context in contexts))
+        self.assertEqual(0, creator.stats()['minting'])
+
+    async def test_get_sslcontext_lru(self):
+        creator = self.get_creator(context_cache_size=2)
+        with patch.object(CertificateCreator, '_mint',
+                          side_effect=lambda host, cert: host):
+            for host in ('first', 'second', 'first', 'third'):
+                await creator.get_sslcontext(host, {})
+        self.assertEqual(['first', 'third'], list(creator._contexts))
+        # Filenames are only used when a context is created.
+        self.assertEqual(['second', 'third'], list(creator._cert))
+
+    @patch('sslcert.sslcreator.time.monotonic')
+    async def test_get_sslcontext_expired(self, mock_time):
+        creator = self.get_creator(context_ttl=10)
+        mock_time.return_value = 100.0
+        with patch.object(CertificateCreator, '_mint',
+                          return_value='serial'), \
+                patch.object(CertificateCreator, '_get_cert_filename',
+                             return_value='serial'):
+            first = await creator.get_sslcontext('host', {})
+            mock_time.return_value = 110.0
+            self.assertIsNot(first, await creator.get_sslcontext('host', {}))
+        self.assertEqual(2, creator._load_sslcontext.call_count)
+
+    async def test_mint_takes_spare_key(self):
+        creator = self.get_creator(spare_keys=1)
+        creator._executor = MagicMock()
+        creator._spare_keys.append(b'key')
+        loop = asyncio.get_running_loop()
+        with patch.object(loop, 'run_in_executor', new_callable=AsyncMock,
+                          return_value='serial') as mock_run, \
+                patch.object(CertificateCreator,
+                             '_refill_spare_keys') as mock_refill:
+            filename = await creator._mint(
+                'host', {'subjectAltName': [('DNS', 'alt')]})
+        self.assertEqual('serial', filename)
+        mock_run.assert_called_once_with(
+            creator._executor, sslcreator_module._mint_certificate,
+            'ssl/', 'host', ['alt', 'host'], 'ecdsa', b'key')
+        mock_refill.assert_called_once()
+        self.assertEqual(0, len(creator._spare_keys))
+
+
+class MintWorkerTests(unittest.TestCase):
+
+    def test_mint_certificate(self):
+        ca_key = sslcreator_module.generate_key()
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'CA')])
+        now = datetime.utcnow()
+        ca_cert = (
+            x509.CertificateBuilder()
+            .subject_name(name)
+            .issuer_name(name)
+            .public_key(ca_key.public_key())
+            .serial_number(1)
+            .not_valid_before(now)
+            .not_valid_after(now + timedelta(days=1))
+            .sign(ca_key, hashes.SHA256())
+        )
+        sslcreator_module._init_worker(
+            ca_cert.public_bytes(sslcreator_module.serialization.Encoding.PEM),
+            sslcreator_module.key_to_pem(ca_key))
+        with tempfile.TemporaryDirectory() as cert_dir:
+            filename = sslcreator_module._mint_certificate(
+                cert_dir, 'host', ['alt', 'host'], 'rsa',
+                sslcreator_module._generate_key_pem())
+            with open(os.path.join(cert_dir, f'{filename}.crt'), 'rb') as f:
+                cert = x509.load_pem_x509_certificate(f.read())
+            self.assertTrue(
+                os.path.exists(os.path.join(cert_dir, f'{filename}.key')))
+        self.assertEqual(str(cert.serial_number), filename)
+        self.assertEqual(ca_cert.subject, cert.issuer)
+        self.assertEqual(
+            ['alt', 'host'],
+            cert.extensions.get_extension_for_class(
+                x509.SubjectAlternativeName).value.get_values_for_type(
+                x509.DNSName))
+
+    @parameterized.expand([
+        ('rsa', rsa.RSAPublicKey),
+        ('ecdsa', ec.EllipticCurvePublicKey),
+    ])
+    def test_generate_certificate_key_algorithm(self, algorithm, key_class):
+        ca_key = sslcreator_module.generate_key('ecdsa')
+        ca_cert = MagicMock(subject=x509.Name(
+            [x509.NameAttribute(NameOID.COMMON_NAME, 'CA')]))
+        san = x509.SubjectAlternativeName([x509.DNSName('host')])
+        _, cert_pem, key_pem = sslcreator_module.generate_certificate(
+            ca_cert, ca_key, 'host', san, algorithm=algorithm)
+        cert = x509.load_pem_x509_certificate(cert_pem)
+        self.assertIsInstance(cert.public_key(), key_class)
+
+
+class ServerContextTests(unittest.TestCase):
+
+    def test_resumption(self):
+        with tempfile.TemporaryDirectory() as work_dir:
+            creator = self.get_creator(work_dir)
+            server_context = creator.create_sslcontext('host', {})
+            client_context = ssl.create_default_context(
+                cafile=os.path.join(work_dir, 'RootCA.crt'))
+
+            session = None
+            for _ in range(2):
+                client, server = self.handshake(client_context,
+                                                server_context, session)
+                session = client.session
+            self.assertTrue(client.session_reused)
+            cert = x509.load_der_x509_certificate(
+                client.getpeercert(binary_form=True))
+            self.assertIsInstance(cert.public_key(),
+                                  ec.EllipticCurvePublicKey)
+
+    def test_x25519_client(self):
+        with tempfile.TemporaryDirectory() as work_dir:
+            creator = self.get_creator(work_dir)
+            server_context = creator.create_sslcontext('host', {})
+            client_context = ssl.create_default_context(
+                cafile=os.path.join(work_dir, 'RootCA.crt'))
+            client_context.set_ecdh_curve('X25519')
+            client, _ = self.handshake(client_context, server_context, None)
+            self.assertEqual('TLSv1.3', client.version())
+
+    @staticmethod
+    def get_creator(work_dir: str) -> CertificateCreator:
+        ca_key = sslcreator_module.generate_key('ecdsa')
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'CA')])
+        now = datetime.utcnow()
+        ca_cert = (
+            x509.CertificateBuilder()
+            .subject_name(name)
+            .issuer_name(name)
+            .public_key(ca_key.public_key())
+            .serial_number(1)
+            .not_valid_before(now)
+            .not_valid_after(now + timedelta(days=1))
+            .add_extension(x509.BasicConstraints(ca=True,
+                                                 path_length=None),
+                           True)
+            .sign(ca_key, hashes.SHA256())
+        )
+        save_file_at_dir(work_dir, 'RootCA.crt', ca_cert.public_bytes(
+            sslcreator_module.serialization.Encoding.PEM))
+        save_file_at_dir(work_dir, 'RootCA.key',
+                         sslcreator_module.key_to_pem(ca_key))
+        return CertificateCreator(work_dir=work_dir)
+
+    @staticmethod
+    def handshake(client_context, server_context, session):
+        client_in, client_out = ssl.MemoryBIO(), ssl.MemoryBIO()
+        server_in, server_out = ssl.MemoryBIO(), ssl.MemoryBIO()
+        client = client_context.wrap_bio(client_in, client_out,
+                                         server_hostname='host',
+                                         session=session)
+        server = server_context.wrap_bio(server_in, server_out,
+                                         server_side=True)
+        for _ in range(10):
+            for obj in (client, server):
+                try:
+                    obj.do_handshake()
+                except ssl.SSLWantReadError:
+                    pass
+            server_in.write(client_out.read())
+            client_in.write(server_out.read())
+        # TLS 1.3 tickets arrive after the handshake.
+        try:
+            client.read(1)
+        except ssl.SSLWantReadError:
+            pass
+        return client, server
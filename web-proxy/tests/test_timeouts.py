@@ -0,0 +1,55 @@
+import asyncio
+from unittest import IsolatedAsyncioTestCase
+
+from proxy.errors import ConnectionTimeout
+from proxy.timeouts import Activity
+
+
+class ActivityTests(IsolatedAsyncioTestCase):
+
+    async def test_expires(self):
+        activity = Activity(timeout=0.01, phase='header')
+        with self.assertRaises(ConnectionTimeout) as error:
+            async with activity:
+                await asyncio.sleep(1)
+        self.assertTrue(activity.timed_out)
+        self.assertIn('header timeout', error.exception.message)
+
+    async def test_touch(self):
+        activity = Activity(timeout=0.03)
+        async with activity:
+            for _ in range(5):
+                await asyncio.sleep(0.01)
+                activity.touch()
+        self.assertFalse(activity.timed_out)
+        self.assertIsNone(activity._timer)
+
+    async def test_expect(self):
+        activity = Activity()
+        with self.assertRaises(ConnectionTimeout) as error:
+            async with activity:
+                await asyncio.sleep(0.02)
+                activity.expect(0.01, 'body')
+                await asyncio.sleep(1)
+        self.assertIn('body timeout', error.exception.message)
+
+    async def test_expect_without_timeout(self):
+        activity = Activity(timeout=0.01)
+        async with activity:
+            activity.expect(None, 'request')
+            await asyncio.sleep(0.03)
+        self.assertFalse(activity.timed_out)
+
+    async def test_other_cancellation(self):
+        activity = Activity(timeout=10)
+
+        async def watched():
+            async with activity:
+                await asyncio.sleep(1)
+
+        task = asyncio.create_task(watched())
+        await asyncio.sleep(0)
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        self.assertFalse(activity.timed_out)
@@ -0,0 +1,89 @@
+import os
+import ssl
+import tempfile
+import time
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes
+from cryptography.x509.oid import NameOID
+
+from common.filemanager import save_file_at_dir
+from proxy.tls import ClientSSLContext
+from sslcert import CertificateCreator
+from sslcert import sslcreator
+from tests.test_sslcreator import ServerContextTests
+
+
+class ClientSSLContextTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls._tmp = tempfile.TemporaryDirectory()
+        work_dir = cls._tmp.name
+        ca_key = sslcreator.generate_key('ecdsa')
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'CA')])
+        now = datetime.utcnow()
+        ca_cert = (
+            x509.CertificateBuilder()
+            .subject_name(name)
+            .issuer_name(name)
+            .public_key(ca_key.public_key())
+            .serial_number(1)
+            .not_valid_before(now)
+            .not_valid_after(now + timedelta(days=1))
+            .add_extension(x509.BasicConstraints(ca=True, path_length=None),
+                           True)
+            .sign(ca_key, hashes.SHA256())
+        )
+        cls.cafile = os.path.join(work_dir, 'RootCA.crt')
+        save_file_at_dir(work_dir, 'RootCA.crt', ca_cert.public_bytes(
+            sslcreator.serialization.Encoding.PEM))
+        save_file_at_dir(work_dir, 'RootCA.key', sslcreator.key_to_pem(ca_key))
+        creator = CertificateCreator(work_dir=work_dir)
+        cls.server_context = creator.create_sslcontext('host', {})
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._tmp.cleanup()
+
+    def connect(self, context: ClientSSLContext) -> ssl.SSLObject:
+        client, _ = ServerContextTests.handshake(context, self.server_context,
+                                                 session=None)
+        context.handshake_done('host', client)
+        return client
+
+    def test_resumption(self):
+        context = ClientSSLContext(cafile=self.cafile)
+        self.assertFalse(self.connect(context).session_reused)
+        self.assertTrue(self.connect(context).session_reused)
+        self.assertEqual({'sessions': 1, 'handshakes': 2, 'offered': 1,
+                          'resumed': 1}, context.stats())
+
+    def test_verify_hostname(self):
+        context = ClientSSLContext(cafile=self.cafile)
+        self.assertTrue(context.check_hostname)
+        self.assertEqual(ssl.CERT_REQUIRED, context.verify_mode)
+
+    def test_sessions_lru(self):
+        context = ClientSSLContext(cafile=self.cafile, max_sessions=2)
+        for host in ('first', 'second', 'third'):
+            context.save_session(host, MagicMock(
+                session=MagicMock(time=time.time(), timeout=300)))
+        self.assertIsNone(context._get_session('first'))
+        self.assertIsNotNone(context._get_session('third'))
+
+    def test_session_expired(self):
+        context = ClientSSLContext(cafile=self.cafile)
+        context.save_session('host', MagicMock(
+            session=MagicMock(time=time.time() - 400, timeout=300)))
+        self.assertIsNone(context._get_session('host'))
+        self.assertEqual(0, context.stats()['sessions'])
+
+    def test_save_without_session(self):
+        context = ClientSSLContext(cafile=self.cafile)
+        context.save_session('host', None)
+        context.save_session('host', MagicMock(session=None))
+        self.assertEqual(0, context.stats()['sessions'])
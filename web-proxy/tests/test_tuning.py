@@ -0,0 +1,90 @@
+import asyncio
+import socket
+import sys
+from unittest import IsolatedAsyncioTestCase, TestCase
+from unittest.mock import patch, MagicMock
+
+from proxy.tuning import SocketOptions, install_event_loop
+
+
+class SocketOptionsTests(TestCase):
+
+    def test_apply(self):
+        options = SocketOptions(nodelay=True, send_buffer=65536,
+                                receive_buffer=32768, keepalive_idle=60,
+                                keepalive_interval=10, keepalive_count=3)
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            options.apply(sock)
+            self.assertTrue(sock.getsockopt(socket.IPPROTO_TCP,
+                                            socket.TCP_NODELAY))
+            self.assertGreaterEqual(
+                sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF), 65536)
+            self.assertGreaterEqual(
+                sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF), 32768)
+            self.assertTrue(sock.getsockopt(socket.SOL_SOCKET,
+                                            socket.SO_KEEPALIVE))
+            if hasattr(socket, 'TCP_KEEPIDLE'):
+                self.assertEqual(60, sock.getsockopt(socket.IPPROTO_TCP,
+                                                     socket.TCP_KEEPIDLE))
+
+    def test_apply_defaults(self):
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            SocketOptions(nodelay=False).apply(sock)
+            self.assertFalse(sock.getsockopt(socket.IPPROTO_TCP,
+                                             socket.TCP_NODELAY))
+            self.assertFalse(sock.getsockopt(socket.SOL_SOCKET,
+                                             socket.SO_KEEPALIVE))
+
+    def test_apply_not_tcp(self):
+        sock = MagicMock(family=socket.AF_UNIX)
+        SocketOptions().apply(sock)
+        SocketOptions().apply(None)
+        sock.setsockopt.assert_not_called()
+
+    def test_apply_error(self):
+        sock = MagicMock(family=socket.AF_INET)
+        sock.setsockopt.side_effect = OSError('not supported')
+        SocketOptions(send_buffer=1024).apply(sock)
+        self.assertEqual(2, sock.setsockopt.call_count)
+
+
+class OpenConnectionTests(IsolatedAsyncioTestCase):
+
+    async def test_open_connection(self):
+        server = await asyncio.start_server(lambda r, w: w.close(),
+                                            host='127.0.0.1', port=0)
+        port = server.sockets[0].getsockname()[1]
+        options = SocketOptions(stream_limit=1024, keepalive_idle=30)
+        async with server:
+            reader, writer = await options.open_connection('127.0.0.1', port)
+            sock = writer.get_extra_info('socket')
+            self.assertTrue(sock.getsockopt(socket.SOL_SOCKET,
+                                            socket.SO_KEEPALIVE))
+            self.assertEqual(1024, reader._limit)
+            writer.close()
+            await writer.wait_closed()
+
+
+class EventLoopTests(TestCase):
+
+    def test_asyncio(self):
+        with patch('asyncio.set_event_loop_policy') as mock_policy:
+            self.assertEqual('asyncio', install_event_loop('asyncio'))
+        mock_policy.assert_not_called()
+
+    def test_uvloop(self):
+        uvloop = MagicMock()
+        with patch.dict(sys.modules, {'uvloop': uvloop}), \
+                patch('asyncio.set_event_loop_policy') as mock_policy:
+            self.assertEqual('uvloop', install_event_loop('auto'))
+        mock_policy.assert_called_once_with(
+            uvloop.EventLoopPolicy.return_value)
+
+    def test_uvloop_not_installed(self):
+        with patch.dict(sys.modules, {'uvloop': None}), \
+                self.assertLogs('tuning', 'WARNING'):
+            self.assertEqual('asyncio', install_event_loop('uvloop'))
+
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            install_event_loop('trio')
@@ -0,0 +1,80 @@
+import asyncio
+from asyncio import StreamReader, StreamWriter
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import MagicMock
+
+from proxy.timeouts import Activity
+from proxy.tunnel import pipe, splice
+
+
+class TunnelTests(IsolatedAsyncioTestCase):
+
+    @staticmethod
+    def get_reader(data: bytes) -> StreamReader:
+        reader = StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        return reader
+
+    @staticmethod
+    def get_writer() -> MagicMock:
+        writer = MagicMock(spec=StreamWriter)
+        writer.can_write_eof.return_value = True
+        writer.is_closing.return_value = False
+        return writer
+
+    @staticmethod
+    def written(writer: MagicMock) -> bytes:
+        return b''.join(call.args[0] for call in writer.write.call_args_list)
+
+    async def test_pipe(self):
+        writer = self.get_writer()
+        self.assertEqual(10, await pipe(self.get_reader(b'0123456789'),
+                                        writer, buffer_size=4))
+        self.assertEqual(b'0123456789', self.written(writer))
+        self.assertEqual(3, writer.write.call_count)
+        writer.write_eof.assert_called_once()
+
+    async def test_splice(self):
+        client_writer, target_writer = self.get_writer(), self.get_writer()
+        sent, received = await splice(
+            self.get_reader(b'request'), client_writer,
+            self.get_reader(b'response bytes'), target_writer,
+            buffer_size=65536)
+        self.assertEqual((7, 14), (sent, received))
+        self.assertEqual(b'request', self.written(target_writer))
+        self.assertEqual(b'response bytes', self.written(client_writer))
+
+    async def test_splice_exc(self):
+        client_writer, target_writer = self.get_writer(), self.get_writer()
+        target_writer.drain.side_effect = ConnectionResetError()
+        with self.assertRaises(ConnectionResetError):
+            await splice(self.get_reader(b'request'), client_writer,
+                         StreamReader(), target_writer, buffer_size=65536)
+
+    async def test_pipe_idle(self):
+        writer = self.get_writer()
+        activity = Activity(timeout=0.01)
+        self.assertEqual(0, await pipe(StreamReader(), writer,
+                                       buffer_size=4, activity=activity))
+        self.assertTrue(activity.timed_out)
+        writer.write_eof.assert_called_once()
+
+    async def test_splice_kept_by_one_direction(self):
+        client_writer, target_writer = self.get_writer(), self.get_writer()
+        target_reader = StreamReader()
+        activity = Activity(timeout=0.2)
+
+        async def stream():
+            for _ in range(5):
+                await asyncio.sleep(0.05)
+                target_reader.feed_data(b'tick')
+            target_reader.feed_eof()
+
+        feeder = asyncio.create_task(stream())
+        sent, received = await splice(StreamReader(), client_writer,
+                                      target_reader, target_writer,
+                                      buffer_size=65536, activity=activity)
+        await feeder
+        self.assertEqual((0, 20), (sent, received))
+        self.assertTrue(activity.timed_out)
@@ -0,0 +1,120 @@
+import queue
+from unittest import IsolatedAsyncioTestCase, TestCase
+from unittest.mock import patch, MagicMock, AsyncMock
+
+from features.collector import PasswordCollector, SharedPasswordCollector, \
+    UserData
+from proxy.server import ProxyServer
+from proxy.workers import Supervisor, _serve
+
+
+def get_process(alive=True) -> MagicMock:
+    process = MagicMock()
+    process.is_alive.return_value = alive
+    return process
+
+
+class SupervisorTests(TestCase):
+
+    @staticmethod
+    def get_supervisor(workers=2) -> Supervisor:
+        supervisor = Supervisor(workers=workers, host='localhost', port=8080)
+        supervisor._credentials = queue.Queue()
+        supervisor._reports = queue.Queue()
+        return supervisor
+
+    def test_start(self):
+        supervisor = self.get_supervisor()
+        process = get_process()
+        with patch.object(supervisor._context, 'Process',
+                          return_value=process) as mock_process:
+            supervisor._start(1)
+        self.assertEqual('worker-1', mock_process.call_args.kwargs['name'])
+        self.assertEqual({'host': 'localhost', 'port': 8080},
+                         mock_process.call_args.kwargs['args'][-1])
+        process.start.assert_called_once()
+        self.assertIs(process, supervisor._processes[1])
+
+    def test_watch_restarts_worker(self):
+        supervisor = self.get_supervisor()
+        supervisor._restart_delay = 0
+        supervisor._processes = [get_process(), get_process(alive=False)]
+        exited = supervisor._processes[1]
+        with patch('proxy.workers.wait', return_value=[exited.sentinel]), \
+                patch.object(Supervisor, '_start') as mock_start:
+            supervisor._watch(timeout=0)
+        exited.join.assert_called_once()
+        mock_start.assert_called_once_with(1)
+        self.assertEqual(1, supervisor.restarts)
+
+    def test_watch_when_stopping(self):
+        supervisor = self.get_supervisor()
+        supervisor._stopping = True
+        supervisor._processes = [get_process(alive=False), None]
+        with patch('proxy.workers.wait',
+                   return_value=[supervisor._processes[0].sentinel]), \
+                patch.object(Supervisor, '_start') as mock_start:
+            supervisor._watch(timeout=0)
+        mock_start.assert_not_called()
+
+    def test_stop_workers(self):
+        supervisor = self.get_supervisor()
+        stuck = get_process()
+        supervisor._processes = [get_process(alive=False), stuck]
+        supervisor._stop_workers(timeout=0)
+        supervisor._processes[0].terminate.assert_not_called()
+        stuck.terminate.assert_called_once()
+        stuck.kill.assert_called_once()
+
+    def test_collect_credentials(self):
+        supervisor = self.get_supervisor()
+        collector = MagicMock(spec=PasswordCollector)
+        supervisor._credentials.put({'user': 'name', 'host': 'example'})
+        supervisor._credentials.put(None)
+        supervisor._collect_credentials(collector)
+        collector.add_user.assert_called_once_with(
+            UserData({'user': 'name', 'host': 'example'}))
+
+    def test_stats(self):
+        supervisor = self.get_supervisor()
+        supervisor._processes = [get_process(), get_process(alive=False)]
+        supervisor.restarts = 3
+        supervisor._reports.put((0, {'cache': {'hits': 1, 'misses': 2}}))
+        supervisor._reports.put((1, {'cache': {'hits': 5, 'misses': 0}}))
+        supervisor._reports.put((0, {'cache': {'hits': 2, 'misses': 2}}))
+        supervisor._reports.put(None)
+        supervisor._collect_reports()
+        self.assertEqual({'cache': {'hits': 7, 'misses': 2},
+                          'workers': {'running': 1, 'restarts': 3}},
+                         supervisor.stats())
+
+
+class WorkerTests(IsolatedAsyncioTestCase):
+
+    @patch.object(ProxyServer, '__init__', return_value=None)
+    @patch.object(ProxyServer, 'run', new_callable=AsyncMock)
+    @patch.object(ProxyServer, 'close', new_callable=AsyncMock)
+    @patch.object(ProxyServer, 'stats', return_value={'cache': {'hits': 1}})
+    async def test_serve(self, mock_stats, mock_close, mock_run, mock_init):
+        credentials = queue.Queue()
+        reports = queue.Queue()
+        await _serve(1, credentials, reports, 60.0, {'port': 8080})
+        kwargs = mock_init.call_args.kwargs
+        self.assertTrue(kwargs['reuse_port'])
+        self.assertIsNone(kwargs['cert_gc_interval'])
+        self.assertEqual(8080, kwargs['port'])
+        self.assertIsInstance(kwargs['password_collector'],
+                              SharedPasswordCollector)
+        mock_run.assert_awaited_once()
+        mock_close.assert_awaited_once()
+        self.assertEqual((1, {'cache': {'hits': 1}}), reports.get_nowait())
+
+    @patch.object(ProxyServer, '__init__', return_value=None)
+    @patch.object(ProxyServer, 'run', new_callable=AsyncMock)
+    @patch.object(ProxyServer, 'close', new_callable=AsyncMock)
+    @patch.object(ProxyServer, 'stats', return_value={})
+    async def test_serve_first_worker_collects_garbage(self, mock_stats,
+                                                       mock_close, mock_run,
+                                                       mock_init):
+        await _serve(0, queue.Queue(), queue.Queue(), 60.0, {})
+        self.assertNotIn('cert_gc_interval', mock_init.call_args.kwargs)